@@ -10,9 +10,9 @@
 # extension of the cube, instrument, physical size of the target, and WCS header 
 # information.
 
-# NOTETOSELF: make sure that the conventions at http://docs.astropy.org/en/latest/development/codeguide.html#standard-output-warnings-and-errors 
-# are being followed. Maybe we can have a --verbose mode where extra
-# information gets printed to stdout.
+# Messages are reported through the logging module, following the conventions at
+# http://docs.astropy.org/en/latest/development/codeguide.html#standard-output-warnings-and-errors
+# The verbose parameter shows the details of every image.
 
 from __future__ import print_function, division
 
@@ -28,23 +28,57 @@ from iraf import artdata, immatch, imcoords
 
 import sys
 import getopt
+import copy
+
+import json
+import logging
+import time
+import threading
+import multiprocessing
+import Queue
+import BaseHTTPServer
+import SocketServer
 
 import glob
+import fnmatch
+import hashlib
+import fcntl
 
 import math
 
+import sqlite3
+import socket
+
 import os
+import tempfile
 
 from astropy.io import fits
+from astropy import wcs
 from astropy.nddata import make_kernel, convolve
 from astropy import units as u
 from astropy import constants
 import numpy as np
 
 import scipy, pylab
+from scipy import ndimage
 from matplotlib import rc
 
-import astropy.utils.console as console
+# IRAF tasks keep their parameters in shared state, so the IRAF steps of
+# different pipelines in the same process must not run at the same time.
+iraf_lock = threading.Lock()
+
+# The steps that process several images at the same time record their
+# completed units in the same run state.
+run_state_lock = threading.Lock()
+
+# Messages go to stdout as plain text unless configure_logging() is told
+# otherwise.
+logger = logging.getLogger('imagecube')
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.setFormatter(logging.Formatter('%(message)s'))
+logger.addHandler(log_handler)
+logger.setLevel(logging.INFO)
+logger.propagate = False
 
 NYQUIST_SAMPLING_RATE = 3.3
 """
@@ -165,6 +199,260 @@ From SPIRE Observer's Manual v2.4.
 
 """
 
+CALIBRATIONS = {
+    'IRAC': {
+        'pixelscale': {'keyword': 'PXSCAL1', 'unit': 'arcsec'},
+        'conversion': {'rule': 'surface_brightness', 'factor': MJY_PER_SR_TO_JY_PER_PIXEL},
+    },
+    'MIPS': {
+        'pixelscale': {'keyword': 'PLTSCALE', 'unit': 'arcsec'},
+        'conversion': {'rule': 'surface_brightness', 'factor': MJY_PER_SR_TO_JY_PER_PIXEL},
+    },
+    # The FUV filter is below 2000 AA, the NUV filter above.
+    'GALEX': {
+        'detection': {'keyword': 'INF0001', 'contains': 'galex'},
+        'conversion': {'rule': 'flux_per_angstrom', 'keyword': 'WAVELENG', 'thresholds': [[0.2, FUV_LAMBDA_CON]], 'default': NUV_LAMBDA_CON},
+    },
+    '2MASS': {
+        'detection': {'keyword': 'ORIGIN', 'contains': '2MASS'},
+        'conversion': {'rule': 'magnitude', 'keyword': 'FILTER', 'values': {'j': FVEGA_J, 'h': FVEGA_H, 'k': FVEGA_KS}, 'zero_point': 'MAGZP'},
+    },
+    'PACS': {
+        'conversion': {'rule': 'constant', 'factor': 1, 'bunit': 'jy/pixel'},
+    },
+    'SPIRE': {
+        'pixelscale': {'keyword': 'CDELT2', 'unit': 'deg'},
+        'conversion': {'rule': 'beam_area', 'keyword': 'WAVELENG', 'values': {'250': S250_BEAM_AREA, '350': S350_BEAM_AREA, '500': S500_BEAM_AREA}},
+    },
+}
+"""
+Code constant: CALIBRATIONS
+
+The calibration of each instrument, which can be extended or overridden
+with the calibrations parameter:
+
+detection: how the instrument is recognized when the header has no
+INSTRUME keyword, i.e. the header keyword whose value contains the given
+string.
+
+pixelscale: the header keyword holding the native pixelscale, and its unit.
+Without it, the pixelscale is read from CDELT2 (in degrees).
+
+conversion: the rule giving the factor that converts the image to Jy/pixel
+(see CONVERSION_RULES), with its parameters. The value of a rule that
+depends on the band is selected with the header keyword "keyword", either
+from the "values" table (keyed by the value in lower case, or formatted
+with %g for a number) or from "thresholds", a list of [upper bound, value]
+pairs, falling back to "default".
+
+"""
+
+DEFAULT_PIXELSCALE = {'keyword': 'CDELT2', 'unit': 'deg'}
+"""
+Code constant: DEFAULT_PIXELSCALE
+
+The pixelscale rule of instruments without one in CALIBRATIONS.
+
+"""
+
+QUEUE_LEASE_SECONDS = 600
+"""
+Code constant: QUEUE_LEASE_SECONDS
+
+Default time (in seconds) for which a worker holds a unit of the work queue
+without renewing its lease; a unit whose lease has expired, e.g. because its
+worker died, is given to another worker.
+
+"""
+
+QUEUE_POLL_SECONDS = 5
+"""
+Code constant: QUEUE_POLL_SECONDS
+
+Time (in seconds) a worker waits before looking for work again when all of
+the remaining units of the queue are running or waiting for others.
+
+"""
+
+QUEUE_STAGES = ['convert', 'register', 'convolve', 'resample', 'datacube', 'seds', 'regions']
+"""
+Code constant: QUEUE_STAGES
+
+The stages of the units of the work queue, in the order they are run. The
+first four are run for each image, the others for each target.
+
+"""
+
+PROGRESS_INTERVAL = 10
+"""
+Code constant: PROGRESS_INTERVAL
+
+Minimum time (in seconds) between two progress events of a long loop.
+
+"""
+
+COVERAGE_SAMPLES = 32
+"""
+Code constant: COVERAGE_SAMPLES
+
+Number of sample points along each side of the target box used to estimate
+the fraction of the target that is covered by an input image.
+
+"""
+
+COMPRESSION_TYPES = {'rice': 'RICE_1', 'gzip': 'GZIP_1'}
+"""
+Code constant: COMPRESSION_TYPES
+
+The FITS tile compression algorithms that can be selected with the
+compression parameter.
+
+"""
+
+IRAF_PIXEL_TYPES = {'float32': 'real', 'float64': 'double'}
+"""
+Code constant: IRAF_PIXEL_TYPES
+
+The IRAF pixel type of the artificial images used as registration and
+resampling grids, for each of the values of the precision parameter.
+
+"""
+
+NORMALIZED_CONVOLUTION_EPSILON = 1e-6
+"""
+Code constant: NORMALIZED_CONVOLUTION_EPSILON
+
+Smallest fraction of the kernel weight that must fall on valid (non-NaN)
+pixels for the FFT convolution to produce a value. Below this, the result
+would be dominated by the round-off errors of the FFTs.
+
+"""
+
+STEP_THROUGHPUT = {'convert': 2e7, 'register': 1e6, 'convolve': 5e6, 'resample': 1e6, 'datacube': 2e7}
+"""
+Code constant: STEP_THROUGHPUT
+
+Approximate number of output pixels per second produced by each step, used
+to estimate run times with the plan parameter. These are rough figures set
+by hand, not calibrated against measured runs: the actual throughput depends
+on the machine, the backend and the convolution method, and can differ from
+them by a large factor.
+
+"""
+
+SED_PLOT_SECONDS = 0.1
+"""
+Code constant: SED_PLOT_SECONDS
+
+Approximate time (in seconds) needed to plot and save the SED of a single
+pixel, used to estimate run times with the plan parameter.
+
+"""
+
+SED_PLOT_BYTES = 20000
+"""
+Code constant: SED_PLOT_BYTES
+
+Approximate size (in bytes) of the .eps file holding the SED of a single
+pixel, used to estimate disk usage with the plan parameter.
+
+"""
+
+COMPARISON_TOLERANCES = {'flux': 0.01, 'conservation': 0.01, 'residual': 0.05, 'offset': 0.1}
+"""
+Code constant: COMPARISON_TOLERANCES
+
+Default tolerances of the backend comparison: the relative difference of
+the total flux of the two backends' images, the largest relative difference
+between the total flux of either backend's image and that of the input
+image, the RMS of their per-pixel difference relative to the peak of the
+reference image, and the offset (in output pixels) between them.
+
+"""
+
+SYNTHETIC_BANDS = [(24.0, 2.45, 6.0), (70.0, 9.85, 18.0), (160.0, 16.0, 40.0)]
+"""
+Code constant: SYNTHETIC_BANDS
+
+The (wavelength in microns, pixelscale in arcsec, FWHM in arcsec) of the
+synthetic MIPS images written with the synthetic parameter.
+
+"""
+
+SED_POINT_BYTES = (40, 250)
+"""
+Code constant: SED_POINT_BYTES
+
+Approximate size (in bytes) of a single (x, y, wavelength, flux) point of
+the SEDs in the text file written by output_seds(), and in memory while the
+points are being sorted.
+
+"""
+
+UNCERTAINTY_EXTENSIONS = ['UNC', 'ERR', 'ERROR', 'SIGMA']
+"""
+Code constant: UNCERTAINTY_EXTENSIONS
+
+Names of the FITS extensions of an input file that are read as the
+uncertainty (1 sigma) image of the band with the uncertainties parameter.
+
+"""
+
+PYRAMID_MIN_SIZE = 32
+"""
+Code constant: PYRAMID_MIN_SIZE
+
+Pyramid levels of the data cube are added until both dimensions of the
+planes are at most this many pixels.
+
+"""
+
+STATISTICS_ACCURACY = 0.01
+"""
+Code constant: STATISTICS_ACCURACY
+
+Relative accuracy of the percentiles of the planes of the data cube, which
+are estimated from histograms with logarithmic bins.
+
+"""
+
+STATISTICS_PERCENTILES = [1, 5, 25, 50, 75, 95, 99]
+"""
+Code constant: STATISTICS_PERCENTILES
+
+Percentiles of the values of each plane of the data cube that are recorded
+with its statistics.
+
+"""
+
+BACKGROUND_SIGMA = 3.0
+"""
+Code constant: BACKGROUND_SIGMA
+
+Pixels further than this many standard deviations from the median of their
+tile are left out of the estimate of the background.
+
+"""
+
+BACKGROUND_ITERATIONS = 5
+"""
+Code constant: BACKGROUND_ITERATIONS
+
+Maximum number of rounds of sigma clipping of the pixels of each tile when
+estimating the background.
+
+"""
+
+QUICKLOOK_SIZE = 256
+"""
+Code constant: QUICKLOOK_SIZE
+
+The quick-look images of the planes of the data cube are averaged over
+blocks of pixels until both of their dimensions are at most this many
+pixels.
+
+"""
+
 def is_number(s):
     """
     Checks whether the input value is a number or not.
@@ -192,10 +480,17 @@ def print_usage():
     """
 
     print("""
-Usage: """ + sys.argv[0] + """ --dir <directory> --ang_size <angular_size> [--flux_conv] [--im_reg] [--im_ref <filename>] [--im_conv] [--fwhm <fwhm value>] [--im_regrid] [--seds] [--cleanup] [--help]  
+Usage: """ + sys.argv[0] + """ --dir <directory> --ang_size <angular_size> [--flux_conv] [--im_reg] [--im_ref <filename>] [--im_conv] [--fwhm <fwhm value>] [--im_regrid] [--seds] [--targets <filename>] [--catalog <filename>] [--build_catalog <archive directory>] [--instrument <name>] [--band <lower>,<upper>] [--min_coverage <fraction>] [--server <port>] [--max_jobs <number>] [--compression <rice|gzip>] [--quantize_level <level>] [--precision <float32|float64>] [--convolution_method <direct|fft>] [--kernel_coverage <fraction>] [--resume] [--max_memory <megabytes>] [--plan] [--backend <iraf|native>] [--synthetic <directory>] [--compare_backends] [--tolerances <name>=<value>,...] [--add_band <filename>] [--regions <filename>] [--query <ra>,<dec>|<filename>] [--pixel_coordinates] [--query_level <level>] [--pyramid] [--uncertainties] [--background <pixels>] [--calibrations <filename>] [--queue <filename> --enqueue|--worker|--queue_status] [--lease <seconds>] [--max_attempts <number>] [--check_queue] [--verbose] [--quiet] [--log_format <text|json>] [--cleanup] [--help]  
 
 dir: the path to the directory containing the <input FITS files> to be 
-processed
+processed. Gzipped files (.fits.gz) are decompressed once, in parallel, into
+<directory>/cache/; tile-compressed files (.fits.fz) are read directly.
+A file holding several images, in several extensions or along the third and
+further axes of a cube, gives one image per plane, named <name>_plane001,
+<name>_plane002, ... Each plane gets its own wavelength from the WAVELENG
+keyword of its extension, from a wavelength or frequency axis of the cube, or
+from the WAVEnnn keywords of a data cube written by imagecube. The planes are
+read one at a time, so large cubes are never fully loaded into memory.
 
 ang_size: the angular size of the object in arcsec
 
@@ -204,7 +499,8 @@ conversion to Jy/pixel.
 NOTE: If data are not GALEX, 2MASS, MIPS, IRAC, PACS, SPIRE, then the user
 should provide flux unit conversion factors to go from the image's native
 flux units to Jy/pixel. This information should be recorded in the header
-keyword FLUXCONV for each input image.
+keyword FLUXCONV for each input image, or the instrument can be described
+with the calibrations parameter.
 
 im_reg: it performs the registration of the input images to the reference
 image. The user should provide the reference image with the im_ref 
@@ -222,14 +518,269 @@ the PSF kernels with the following naming convention:
 For example: an input image named SI1.fits will have a corresponding
 kernel file named SI1_kernel.fits
 
-fwhm: the user provides the angular resolution in arcsec to which all images will be convolved with im_conv
+fwhm: the user provides the angular resolution in arcsec to which all images will be convolved with im_conv.
+If this parameter is not present, it is determined from the instruments and
+wavelengths of the input images.
 
 im_regrid: it performs regridding of the convolved images to a common
 pixel scale. The pixel scale is defined to be the fwhm divided by """ + `NYQUIST_SAMPLING_RATE` + """.
+The regridded images are stacked into <directory>/datacube/datacube.fits. The
+statistics of each plane (minimum, maximum, approximate percentiles, fraction
+of NaN pixels and total flux) are recorded in its header and in
+datacube_stats.json, and a quick-look image of each plane is written to
+<directory>/datacube/quicklook/.
 
 seds: it produces the spectral energy distribution on a pixel-by-pixel
 basis, on the regridded images.
 
+targets: a text file listing several targets covered by the same input
+images. Each line holds the target name, its RA and DEC (in degrees) and its
+angular size (in arcsec), separated by spaces or commas. The input images are
+read and converted only once; registration, convolution, resampling and SED
+creation are then run for every target, and the output files of each target
+are written under <directory>/targets/<target name>/.
+
+catalog: an SQLite catalog of input files, as created with build_catalog. If
+this parameter is present, the input files are selected from the catalog
+instead of being taken from the directory. Only files overlapping the box
+given by ra, dec and angular_size (when these are present) and matching the
+instrument and band parameters are selected.
+
+build_catalog: the top directory of an archive of FITS files. The headers of
+all of the files in the archive are read and their instrument, wavelength,
+native pixelscale and footprint are recorded in the catalog given with the
+catalog parameter; no processing is done. Running it again only reads files
+that were added or changed since the previous run.
+
+instrument: only select input files from this instrument from the catalog.
+
+band: only select input files from the catalog with a wavelength (in
+microns) between the given lower and upper values.
+
+min_coverage: the fraction of the target box (given by ra, dec and
+angular_size, or by the targets file) that an input image must cover to be
+processed. The coverage is determined from the header WCS before any image
+data is read, and is recorded in the COVERAGE header keyword. Images that do
+not overlap the target at all are always skipped.
+
+server: if this parameter is present, imagecube runs as a server listening on
+the given port of the local host, so that the cost of starting Python and
+IRAF is only paid once. Jobs are submitted by POSTing a JSON object of the
+form {"arguments": ["--directory", "<directory>", ...]} to /jobs, with the
+same parameters as on the command line. The status of all jobs, or of a
+single job, can be obtained with a GET request to /jobs or /jobs/<job id>.
+Each job runs in a child process forked from the server; a job whose
+parameters are invalid is reported as failed, with a non-zero exit_code.
+
+max_jobs: the number of jobs the server runs at the same time (default 1).
+Further jobs wait in a queue. With worker, the number of units a worker
+process runs at the same time.
+
+queue: the SQLite file of a work queue, which spreads the steps of a run
+over any number of worker processes on any number of hosts sharing the
+directories (and the queue file, which needs a file system with working
+locks). With enqueue, the run described by the other parameters is split
+into units, one per stage for each image (convert, register, convolve,
+resample) and for each target (datacube, seds, regions), and added to the
+queue with their dependencies; the common FWHM and centre of each target
+are determined at this time. With worker, units whose dependencies are done
+are claimed and run (each in a child process) until none are left. With
+queue_status, the number of units in each state and their mean run time
+are displayed. The registration, convolution and resampling steps are run
+image by image, so the fft convolution does not batch images together.
+
+lease: how long (in seconds) a worker may hold a unit without renewing its
+lease (default 600). Workers renew the lease of their units while they run,
+so this is only reached if the worker died; the unit is then run again.
+
+max_attempts: the number of times a unit of the queue is tried before it is
+marked as failed (default 3). The units that depend on it are marked as
+failed as well.
+
+check_queue: runs the conversion, registration, convolution and resampling
+steps on synthetic images written to a temporary directory through a work
+queue with max_jobs workers (at least 8), with the resume parameter, and
+checks that every unit succeeded on its first attempt. The script exits with
+an error if any unit failed or had to be tried again.
+
+compression: if this parameter is present, the converted, convolved,
+registered and resampled images and the data cube are written as
+tile-compressed FITS files, using either Rice or GZIP compression. The images
+are quantized before being compressed (see quantize_level), so the compression
+is lossy. Compressed images are decompressed in full when they are read.
+
+quantize_level: the quantization level used for floating point images with
+the compression parameter (default 16). Larger values preserve more of the
+precision of the data but compress less.
+
+precision: with float32, the images are kept in single precision throughout
+the conversion, registration, convolution, resampling, data cube and SED
+steps, which halves the memory and disk space needed. The convolution itself
+is still computed in double precision. The default, float64, leaves the
+images in whatever precision the individual steps produce.
+
+convolution_method: with direct (the default), the images are convolved
+directly, with NaN pixels interpolated over by the kernel. With fft, a
+normalized convolution is computed with FFTs instead: the image with its NaN
+pixels set to 0 and the map of valid pixels are both convolved with the
+kernel, and the first is divided by the second. Away from the image borders
+this gives the same result as the direct method, and is much faster for
+large kernels. Images that share the same pixel grid after registration are
+convolved together in a single batch of FFTs.
+
+kernel_coverage: with the fft convolution method, pixels for which less than
+this fraction of the kernel weight falls on valid pixels are set to NaN
+(default 0).
+
+resume: continue an interrupted run instead of starting again. With this
+parameter, a run records which steps it has completed for which image
+(including the SED plots), with the checksums of their input and output files,
+in run_state.json in the directory of each target. The steps whose files are
+all still present and unchanged are skipped, and the partial outputs of the
+steps that were interrupted are removed and redone. Without it, the record is
+reset and no checksums are computed, so only runs started with this
+parameter can be continued; all of the requested steps are run.
+
+max_memory: if this parameter is present, the conversion and convolution
+steps process several images at the same time, using at most about the given
+number of megabytes. The memory needed for each image is estimated from its
+dimensions, the precision and the size of the convolution kernel; the
+largest images are started first, and smaller ones fill the remaining
+budget. An image that needs more than the whole budget is processed on its
+own. Without this parameter, the images are processed one at a time.
+
+plan: if this parameter is present, only the headers of the input images are
+read, and the sizes of the images produced by each of the requested steps,
+the disk space and peak memory they need and a rough estimate of their run
+time are displayed. No processing is done. The run times are estimated from
+fixed, uncalibrated figures for the number of pixels each step processes per
+second, so they only give an order of magnitude. Without targets, the
+angular_size parameter is needed to plan the registration, convolution,
+resampling and SED steps.
+
+backend: with iraf (the default), the registration and resampling steps use
+the IRAF tasks mkpattern, ccsetwcs and wregister. With native, the images are
+instead reprojected directly onto the same grids with astropy.wcs and a
+bilinear interpolation, without needing IRAF. Pixels that fall outside of
+the input image are set to NaN rather than 0.
+
+synthetic: writes synthetic MIPS 24, 70 and 160 micron images of the same
+field of point sources into the given directory, and does no processing.
+The sources are at known positions, so the images can be used to check the
+processing steps without any archive data.
+
+compare_backends: runs the registration, convolution and resampling steps on
+the images of the directory (or, if no directory is given, on synthetic
+images written to a temporary directory, which is removed afterwards) twice:
+once with the iraf backend and the direct convolution method, and once with
+the native backend and the fft convolution method. Both runs of each step are
+given the same input images, and their output is written under
+<directory>/targets/compare_iraf/ and <directory>/targets/compare_native/.
+The time taken by each run, the
+total flux of the images before and after each step, the statistics of the
+per-pixel differences and the offset between the two outputs are displayed.
+The script exits with an error if any of the tolerances is exceeded, or if
+any of these values cannot be computed (e.g. if the outputs have no valid
+pixels in common).
+
+tolerances: the tolerances of compare_backends, as a comma-separated list of
+<name>=<value> pairs. The names are flux (the relative difference of the
+total flux of the two outputs, default """ + `COMPARISON_TOLERANCES['flux']` + """), conservation (the relative
+difference between the total flux of either output and that of the input,
+default """ + `COMPARISON_TOLERANCES['conservation']` + """), residual (the RMS of the per-pixel
+differences relative to the peak of the image, default """ + `COMPARISON_TOLERANCES['residual']` + """) and
+offset (in pixels, default """ + `COMPARISON_TOLERANCES['offset']` + """).
+
+add_band: adds a single image (a new band, or a new version of one of the
+bands) to the existing data cube of the directory, without reprocessing the
+other bands. The image is converted, registered, convolved and resampled on
+its own, and its plane is inserted into the data cube at the position of its
+wavelength, or replaces the plane of the band with the same file name. The
+wavelength and file name of each plane are recorded in the WAVEnnn and
+PLANEnnn keywords of the data cube. If the new band changes the common
+resolution (and so the kernels and the resampled grid of all of the bands),
+the data cube is left unchanged and the planes that would need to be
+reprocessed are listed instead. The angular size and centre of the new band
+are taken from the data cube, so the angular_size parameter is not needed.
+The pyramid and the cube of uncertainties of
+the data cube, if there are any, are updated as well; the plane of
+uncertainties of the new band is NaN unless the uncertainties parameter is
+given.
+
+regions: sums the flux of every band of the data cube over regions of the
+target, and writes the SEDs of the regions to <directory>/seds/region_seds.txt.
+The regions are given either as a FITS image of the same size as the planes of
+the data cube, in which each pixel holds the (positive integer) label of the
+region it belongs to, or as a text file in which each line holds a region
+name, its RA and DEC (in degrees) and its radius (in arcsec), followed by an
+inner radius (in arcsec) for an annulus, separated by spaces or commas.
+Apertures may overlap. NaN pixels are left out of the sums, and the number of
+pixels of each region that were used in each band is also written.
+
+query: displays the SED at one or more positions from the existing data cube,
+and does no processing. The position is given as <ra>,<dec> (in degrees), or
+a text file is given with one position per line, for batches of positions.
+The data cube is memory-mapped, so only the pixels at the requested
+positions are read. Positions outside of the data cube give NaN values.
+
+pixel_coordinates: with query, the positions are (0-based) x,y pixel
+coordinates of the data cube rather than RA and DEC.
+
+query_level: with query, the SEDs are read from this level of the pyramid of
+the data cube (see pyramid) instead of from the full resolution data cube.
+Pixel coordinates are then those of the level.
+
+pyramid: if this parameter is present, lower resolution copies of the data
+cube are added to its FITS file as extensions named LEVEL1, LEVEL2, ...
+Each level sums blocks of 2x2 pixels of the previous one, which conserves
+the flux (in Jy/pixel), and its WCS is adjusted to match. Levels are added
+until the planes are at most 32x32 pixels, so that viewers can read only the
+resolution they need.
+
+uncertainties: if this parameter is present, the uncertainties of the images
+are processed along with them. The uncertainty (1 sigma) image of a band is
+read from <name>_unc.fits next to the input file <name>.fits, or from an
+extension named UNC, ERR, ERROR or SIGMA of the input file; bands without
+one are processed as usual. The variances are propagated in the same pass
+as the images (scaled by the square of the conversion factor, convolved with
+the square of the kernel, and interpolated with the squares of the same
+weights), written next to each output file as <output>_var.fits, and the
+uncertainties are written as datacube/datacube_unc.fits with the planes of
+the data cube. This needs the native backend. The _unc files are never
+processed as bands of their own.
+
+background: the size (in pixels) of the tiles on which the background of
+each image is estimated, after its conversion to Jy/pixel. In every tile,
+the median of the pixels is taken after rejecting those further than """ + `BACKGROUND_SIGMA` + """
+standard deviations from it (repeatedly), tiles with too few valid pixels
+take the value of the nearest tile, and the mesh of tiles is median filtered
+over 3x3 tiles and interpolated with a bicubic spline. The background is
+subtracted from the converted image before it is written, so it is removed
+before registration and convolution. The tile size should be several times
+the size of the sources, so that they do not raise the background. The
+variances of the uncertainties parameter are not changed.
+
+calibrations: a JSON file describing the calibration of further instruments,
+or replacing that of the known ones, e.g.
+  {"MYCAM": {"pixelscale": {"keyword": "PIXSCALE", "unit": "arcsec"},
+             "conversion": {"rule": "surface_brightness", "factor": 2.3504e-5}}}
+The conversion rules are surface_brightness (factor times the pixel area in
+arcsec^2), beam_area (the pixel area over the beam area, selected by band),
+flux_per_angstrom, magnitude, constant, and keyword (the factor is read from
+a header keyword). An instrument without an INSTRUME keyword can be
+recognized with "detection": {"keyword": <keyword>, "contains": <string>}.
+
+verbose: if this parameter is present, the details of every image (file
+names, instruments, pixel scales, and the time taken and bytes written by
+each step) are displayed, and the IRAF tasks report what they do.
+
+quiet: if this parameter is present, only warnings and errors are displayed.
+
+log_format: text (the default) or json, in which case every message is a
+JSON object on its own line, with its time and level, and for the events
+of the processing steps, the event (start, end or progress), the stage, and
+the image, duration (in seconds), bytes written, or progress.
+
 cleanup: if this parameter is present, then output files from previous 
 executions of the script are removed and no processing is done.
 
@@ -279,50 +830,55 @@ def wavelength_to_microns(wavelength, unit):
 
     return return_value
 
-# NOTETOSELF: other keywords may be acceptable
 # NOTETOSELF: pass the filenames to this function as well so we know which file we are
 # on in case of problems.
-# NOTETOSELF: proper error checking needed.
-def get_instrument(header):
+def get_instrument(header, calibrations):
     """
     Determines which instrument the data in a FITS file came from.
-    This is done by checking certain keywords in the FITS header.
+    This is done by checking the INSTRUME keyword of the FITS header, and
+    otherwise the detection rules of the calibrations.
 
     Parameters
     ----------
     header: FITS file header
         The header of the FITS file to be checked.
+    calibrations: dict
+        The calibration of each instrument, as in CALIBRATIONS (see the
+        calibrations attribute of Config).
 
     Returns
     -------
     instrument: string
-        The instrument which the data in the FITS file came from.
+        The instrument which the data in the FITS file came from, or an
+        empty string if it is not known but the header provides a FLUXCONV
+        value or one of the detection keywords.
     """
-    instrument = ''
+
     # Check for INSTRUME keyword first
     if ('INSTRUME' in header):
-        instrument = header['INSTRUME']
-    # Then check for 'galex' in the INF0001 keyword
-    elif ('INF0001' in header):
-        if ('galex' in header['INF0001']):
-            instrument = 'GALEX'
-    # Finally, check to see if the 'ORIGIN' keyword has a value of '2MASS'
-    elif ('ORIGIN' in header):
-        if ('2MASS' in header['ORIGIN']):
-        #if (header['ORIGIN'] == '2MASS'):
-            instrument = '2MASS'
-    else:
-        print("could not determine instrument; please insert appropriate information in the header.")
+        return header['INSTRUME']
+
+    has_detection_keyword = False
+    for instrument in sorted(calibrations):
+        detection = calibrations[instrument].get('detection')
+        if (detection is None or detection['keyword'] not in header):
+            continue
+        has_detection_keyword = True
+        if (detection['contains'] in str(header[detection['keyword']])):
+            return instrument
+
+    if (not has_detection_keyword and 'FLUXCONV' not in header):
+        logger.error("could not determine instrument; please insert appropriate information in the header.")
         sys.exit()
-
-    return instrument
+    return ''
 
 # NOTETOSELF: this value should be returned in arcsec, so some additional checking will
 # be needed to ensure that the proper units are being used.
-def get_native_pixelscale(header, instrument):
+def get_native_pixelscale(header, instrument, calibrations):
     """
     Returns the native pixelscale of the given instrument. Depending on the
-    instrument, the pixelscale can be located in different header keywords.
+    instrument, the pixelscale can be located in different header keywords,
+    as given by the pixelscale rules of the calibrations.
 
     Parameters
     ----------
@@ -332,34 +888,154 @@ def get_native_pixelscale(header, instrument):
     instrument: string
         The instrument which the data in the FITS file came from
 
+    calibrations: dict
+        The calibration of each instrument, as in CALIBRATIONS.
+
     Returns
     -------
     pixelscale: float
-        The native pixelscale of the given instrument.
+        The native pixelscale of the given instrument, in arcsec.
     """
 
+    rule = calibrations.get(instrument, {}).get('pixelscale', DEFAULT_PIXELSCALE)
     pixelscale = 0
-    if (instrument == 'IRAC'):
-        pixelscale = abs(header['PXSCAL1'])
-    elif (instrument == 'MIPS'):
-        pixelscale = header['PLTSCALE']
-    elif (instrument == 'SPIRE'):
-        pixelscale = u.deg.to(u.arcsec, abs(header['CDELT2']))
-    else:
-        if ('CDELT2' in header):
-            pixelscale = u.deg.to(u.arcsec, abs(header['CDELT2']))
+    if (rule['keyword'] in header):
+        pixelscale = u.Unit(rule['unit']).to(u.arcsec, abs(header[rule['keyword']]))
 
     if (pixelscale == 0):
-        print("The native pixelscale is 0, so something may have gone wrong here.")
+        logger.warning("The native pixelscale is 0, so something may have gone wrong here.")
 
     return pixelscale
 
+def select_calibration_value(rule, header):
+    """
+    Returns the value of a conversion rule for the band of an image, as
+    described for CALIBRATIONS, or 0 if the band is not in the rule.
+    """
+
+    if (rule['keyword'] not in header):
+        return 0
+    value = header[rule['keyword']]
+    if ('values' in rule):
+        if (is_number(value)):
+            key = "%g" % value
+        else:
+            key = str(value).strip().lower()
+        return rule['values'].get(key, 0)
+    for upper_bound, selected_value in rule['thresholds']:
+        if (value < upper_bound):
+            return selected_value
+    return rule['default']
+
+def surface_brightness_conversion(rule, header, instrument, calibrations):
+    """
+    Conversion rule for images in surface brightness units, e.g. the MJy/sr
+    of Spitzer: the factor to Jy/arcsec^2 times the pixel area.
+    """
+
+    # NOTEOTSELF: This is a hardcoded value from what Sophia gave me.
+    # I would like to see if we could also obtain this from units.
+    return rule['factor'] * get_native_pixelscale(header, instrument, calibrations)**2
+
+def beam_area_conversion(rule, header, instrument, calibrations):
+    """
+    Conversion rule for images in Jy/beam, e.g. SPIRE: the pixel area over
+    the beam area (in arcsec^2) of the band.
+    """
+
+    beam_area = select_calibration_value(rule, header)
+    if (beam_area == 0):
+        return 0
+    return get_native_pixelscale(header, instrument, calibrations)**2 / beam_area
+
+def flux_per_angstrom_conversion(rule, header, instrument, calibrations):
+    """
+    Conversion rule for images in counts per second whose calibration gives
+    a flux in erg/s/cm^2/AA, e.g. GALEX: the calibration of the band times
+    lambda^2/c, in Jy.
+    """
+
+    wavelength = u.um.to(u.angstrom, header['WAVELENG'])
+    return ((JY_CONVERSION) * select_calibration_value(rule, header) * wavelength**2) / (constants.c.to('angstrom/s').value)
+
+def magnitude_conversion(rule, header, instrument, calibrations):
+    """
+    Conversion rule for images in data numbers with a magnitude zero point,
+    e.g. 2MASS: the flux (in Jy) of a zero magnitude source in the band,
+    scaled by the zero point. This comes from the definition of the
+    magnitude system.
+    """
+
+    return select_calibration_value(rule, header) * 10**(-0.4 * header[rule['zero_point']])
+
+def constant_conversion(rule, header, instrument, calibrations):
+    """
+    Conversion rule for images with a fixed factor, e.g. PACS, which is
+    already in Jy/pixel. The BUNIT keyword is checked if a unit is given.
+    """
+
+    if ('bunit' in rule and 'BUNIT' in header):
+        if (header['BUNIT'].lower() != rule['bunit']):
+            # NOTETOSELF: ask for more input here if necessary
+            logger.warning("Instrument is " + instrument + ", but " + rule['bunit'] + " is not being used in BUNIT.")
+    return rule['factor']
+
+def keyword_conversion(rule, header, instrument, calibrations):
+    """
+    Conversion rule for images whose header holds the factor itself, in the
+    given keyword.
+    """
+
+    return header.get(rule['keyword'], 0)
+
+CONVERSION_RULES = {
+    'surface_brightness': surface_brightness_conversion,
+    'beam_area': beam_area_conversion,
+    'flux_per_angstrom': flux_per_angstrom_conversion,
+    'magnitude': magnitude_conversion,
+    'constant': constant_conversion,
+    'keyword': keyword_conversion,
+}
+"""
+Code constant: CONVERSION_RULES
+
+The functions that compute the conversion factor of an image from the
+conversion rule of its instrument in CALIBRATIONS.
+
+"""
+
+def load_calibrations(filename, calibrations):
+    """
+    Adds the instruments of a JSON calibration file to a calibration
+    registry, replacing the calibration of instruments that are already
+    known. The file holds an object with the same structure as
+    CALIBRATIONS.
+
+    Parameters
+    ----------
+    filename: string
+        The name of the calibration file.
+    calibrations: dict
+        The registry to update, e.g. the calibrations of a Config; not
+        CALIBRATIONS itself, which other pipelines of the process share.
+
+    """
+
+    with open(filename) as f:
+        loaded_calibrations = json.load(f)
+    for instrument, calibration in loaded_calibrations.items():
+        if ('conversion' not in calibration or calibration['conversion'].get('rule') not in CONVERSION_RULES):
+            logger.error("Error: The calibration of " + instrument + " in " + filename + " needs a conversion rule among: " + ', '.join(sorted(CONVERSION_RULES)))
+            sys.exit()
+        calibrations[str(instrument)] = calibration
 
 # NOTETOSELF: if the instrument is not found, the user can provide the value themselves
-def get_conversion_factor(header, instrument):
+def get_conversion_factor(header, instrument, calibrations):
     """
     Returns the factor that is necessary to convert an image's native "flux 
-    units" to Jy/pixel.
+    units" to Jy/pixel, from the conversion rule of the instrument in the
+    calibrations. If there is none, or it does not cover the band of the
+    image, the value of the FLUXCONV header keyword is used.
 
     Parameters
     ----------
@@ -369,74 +1045,26 @@ def get_conversion_factor(header, instrument):
     instrument: string
         The instrument which the data in the FITS file came from
 
+    calibrations: dict
+        The calibration of each instrument, as in CALIBRATIONS.
+
     Returns
     -------
     conversion_factor: float
         The conversion factor that will convert the image's native "flux
-        units" to Jy/pixel.
+        units" to Jy/pixel, or 0 if it is not known.
     """
 
-    # Give a default value that can't possibly be valid; if this is still the value
-    # after running through all of the possible cases, then an error has occurred.
     conversion_factor = 0
+    if (instrument in calibrations):
+        rule = calibrations[instrument]['conversion']
+        conversion_factor = CONVERSION_RULES[rule['rule']](rule, header, instrument, calibrations)
+
+    if (conversion_factor == 0 and 'FLUXCONV' in header):
+        conversion_factor = header['FLUXCONV']
+    if (conversion_factor == 0):
+        logger.warning("No conversion factor is known for " + `instrument` + "; please record it in the FLUXCONV header keyword.")
 
-    if (instrument == 'IRAC'):
-        pixelscale = get_native_pixelscale(header, 'IRAC')
-        #print("Pixel scale: " + `pixelscale`)
-        # NOTEOTSELF: This is a hardcoded value from what Sophia gave me.
-        # I would like to see if we could also obtain this from units.
-        # The native "flux unit" is MJy/sr and we convert it to Jy/pixel
-        conversion_factor = (MJY_PER_SR_TO_JY_PER_PIXEL) * (pixelscale**2)
-
-    elif (instrument == 'MIPS'):
-        pixelscale = get_native_pixelscale(header, 'MIPS')
-        #print("Pixel scale: " + `pixelscale`)
-        conversion_factor = (MJY_PER_SR_TO_JY_PER_PIXEL) * (pixelscale**2)
-
-    elif (instrument == 'GALEX'):
-        wavelength = u.um.to(u.angstrom, header['WAVELENG'])
-        #print("Speed of light: " + `constants.c.to('um/s').value`)
-        f_lambda_con = 0
-        # I am using a < comparison here to account for the possibility that the given
-        # wavelength is not EXACTLY 1520 AA or 2310 AA
-        if (wavelength < 2000): 
-            f_lambda_con = FUV_LAMBDA_CON
-        else:
-            f_lambda_con = NUV_LAMBDA_CON
-        conversion_factor = ((JY_CONVERSION) * f_lambda_con * wavelength**2) / (constants.c.to('angstrom/s').value)
-        #print("lambda^2/c = " + `(wavelength**2) / (constants.c.to('angstrom/s').value)`)
-
-    # This calculation comes from the definition of the magnitude system.
-    elif (instrument == '2MASS'):
-        #print("MAGZP: " + `header['MAGZP']`)
-        fvega = 0
-        if (header['FILTER'] == 'j'):
-            fvega = FVEGA_J
-        elif (header['FILTER'] == 'h'):
-            fvega = FVEGA_H
-        elif (header['FILTER'] == 'k'):
-            fvega = FVEGA_KS
-        conversion_factor = fvega * 10**(-0.4 * header['MAGZP'])
-
-    elif (instrument == 'PACS'):
-        # Confirm that the data is already in Jy/pixel by checking the BUNIT header
-        # keyword
-        if ('BUNIT' in header):
-            if (header['BUNIT'].lower() != 'jy/pixel'):
-                # NOTETOSELF: ask for more input here if necessary
-                print("Instrument is PACS, but Jy/pixel is not being used in BUNIT.")
-        conversion_factor = 1;
-
-    elif (instrument == 'SPIRE'):
-        pixelscale = get_native_pixelscale(header, 'SPIRE')
-        wavelength = header['WAVELENG']
-        if (wavelength == 250):
-            conversion_factor = (pixelscale**2) / S250_BEAM_AREA
-        elif (wavelength == 350):
-            conversion_factor = (pixelscale**2) / S350_BEAM_AREA
-        elif (wavelength == 500):
-            conversion_factor = (pixelscale**2) / S500_BEAM_AREA
-    
     return conversion_factor
 
 # NOTETOSELF: I wonder if it might be best to force a type on the wavelength - e.g.
@@ -445,7 +1073,7 @@ def get_conversion_factor(header, instrument):
 # as 0 after all the cases have been checked.
 # NOTETOSELF: Would it be best to force the units to be microns? Check to see how this
 # would impact other functions first.
-def get_wavelength(header):
+def get_wavelength(header, calibrations):
     """
     Returns the wavelength and its units for a given FITS image.
 
@@ -453,6 +1081,8 @@ def get_wavelength(header):
     ----------
     header: FITS file header
         The header of the FITS file to be checked.
+    calibrations: dict
+        The calibration of each instrument, as in CALIBRATIONS.
 
     Returns
     -------
@@ -476,7 +1106,7 @@ def get_wavelength(header):
         # NOTETOSELF: Check the actual instrument to make sure that this should be in
         # microns.
         wavelength = header['FILTER']
-        instrument = get_instrument(header)
+        instrument = get_instrument(header, calibrations)
         if (instrument == '2MASS'):
             if (header['FILTER'].lower() == 'j'):
                 wavelength = WAVELENGTH_2MASS_J
@@ -516,7 +1146,7 @@ def wavelength_range(wavelengths, lower, upper):
     return return_value
 
 # NOTETOSELF: Sophia will be providing proper wavelength ranges to check here.
-def get_fwhm_value(images_with_headers):
+def get_fwhm_value(images_with_headers, calibrations):
     """
     Determines the fwhm value given the instrument and wavelength values
     that are present in all of the input images.
@@ -524,9 +1154,11 @@ def get_fwhm_value(images_with_headers):
 
     Parameters
     ----------
-    images_with_headers: zipped list structure
+    images_with_headers: list of ImageRecord
         A structure containing headers and image data for all FITS input
         images.
+    calibrations: dict
+        The calibration of each instrument, as in CALIBRATIONS.
 
     Returns
     -------
@@ -541,9 +1173,9 @@ def get_fwhm_value(images_with_headers):
     # This is done by creating a dictionary with instruments as the keys,
     # and a list of wavelengths from each instrument as values.
     for i in range(0, len(images_with_headers)):
-        instrument = get_instrument(images_with_headers[i][1])
+        instrument = get_instrument(images_with_headers[i].header, calibrations)
         # The [0] is here because we only need the wavelength, not the units as well.
-        wavelength = get_wavelength(images_with_headers[i][1])[0]
+        wavelength = get_wavelength(images_with_headers[i].header, calibrations)[0]
         if (instrument in instruments_with_wavelengths):
             instruments_with_wavelengths[instrument].append(wavelength)
         else:
@@ -570,692 +1202,5382 @@ def get_fwhm_value(images_with_headers):
 
     return fwhm
 
-def parse_command_line():
+def get_common_fwhm(images_with_headers, config):
+    """
+    Returns the FWHM value (in arcsec) to which all of the images are
+    convolved: the value of the fwhm parameter if present, and otherwise
+    the value given by get_fwhm_value().
+
+    Parameters
+    ----------
+    images_with_headers: list of ImageRecord
+        A structure containing headers and image data for all FITS input
+        images.
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    fwhm: float
+        The fwhm value.
+    """
+
+    if (config.fwhm != ''):
+        return config.fwhm
+    return get_fwhm_value(images_with_headers, config.calibrations)
+
+class ImageRecord(object):
+    """
+    An input image: its image data, its header, and the name (without the
+    .fit or .fits extension) from which the names of its output files are
+    derived.
+
+    The image data can also be read from a FITS file only when it is first
+    needed, which is how the processing steps describe the images they
+    have written. The planes of input files holding several images are
+    read from the input file every time their data is used, and are not
+    kept, so that only one of them is in memory at a time.
+
+    Parameters
+    ----------
+    data: numpy array
+        The image data, or None if it is to be read from path.
+    header: FITS file header
+        The header of the input image.
+    filename: string
+        The name of the input file, without its extension.
+    path: string
+        The FITS file from which the image data is read if data is None.
+    plane: tuple
+        The (HDU index, plane index, dimensions) of the image in the input
+        file path, as found by get_input_planes(), or None if path is an
+        output file.
+
+    """
+
+    def __init__(self, data, header, filename, path=None, plane=None):
+        self._data = data
+        self.header = header
+        self.filename = filename
+        self.path = path
+        self.plane = plane
+
+    @property
+    def data(self):
+        if (self._data is None and self.path is not None):
+            if (self.plane is None):
+                self._data = read_fits(self.path)[0]
+            elif (self.plane[1] is None):
+                self._data = read_input_plane(self.path, self.plane[:2])
+            else:
+                return read_input_plane(self.path, self.plane[:2])
+        return self._data
+
+    @property
+    def shape(self):
+        """
+        The dimensions of the image data, without reading it for the images
+        of input files.
+        """
+
+        if (self._data is None and self.plane is not None):
+            return self.plane[2]
+        return self.data.shape
+
+    def with_path(self, path):
+        """
+        Returns a record for the same input image whose image data is read
+        from the given FITS file, e.g. the output file of a processing step.
+        """
+
+        return ImageRecord(None, self.header, self.filename, path)
+
+class Config(object):
+    """
+    The parameters of a run of imagecube. The attributes have the same
+    names as the command line parameters described in print_usage(), and
+    have the same default values as when the parameters are not given.
+
+    Parameters
+    ----------
+    **kwargs
+        Values for any of the attributes, e.g.
+        Config(directory='ngc1569', phys_size=300., do_conversion=True).
+
+    """
+
+    def __init__(self, **kwargs):
+        self.phys_size = ''
+        self.directory = ''
+        self.ra_input = ''
+        self.dec_input = ''
+        self.main_reference_image = ''
+        self.convolution_reference_image = ''
+        self.targets_file = ''
+        # The name of the target being processed when a targets file is
+        # used; the output files of each target go to their own directory.
+        self.target_name = ''
+        self.catalog_file = ''
+        self.build_catalog_directory = ''
+        self.instrument_selection = ''
+        self.band_selection = None
+        self.min_coverage = 0
+        self.server_port = 0
+        self.max_jobs = 1
+        self.compression = ''
+        self.quantize_level = 16
+        self.precision = 'float64'
+        self.convolution_method = 'direct'
+        self.kernel_coverage = 0
+        self.resume = False
+        self.max_memory = 0
+        self.plan = False
+        self.backend = 'iraf'
+        self.synthetic_directory = ''
+        self.compare_backends = False
+        self.tolerances = dict(COMPARISON_TOLERANCES)
+        self.fwhm = ''
+        self.add_band_file = ''
+        self.regions_file = ''
+        self.query = ''
+        self.pixel_coordinates = False
+        self.pyramid = False
+        self.query_level = 0
+        self.uncertainties = False
+        self.background_tile = 0
+        self.calibrations_file = ''
+        # The calibration of each instrument: a copy of CALIBRATIONS, to
+        # which the calibrations file of this run is added, so that it does
+        # not affect the other pipelines of the process.
+        self.calibrations = dict(CALIBRATIONS)
+        self.queue_file = ''
+        self.enqueue = False
+        self.worker = False
+        self.queue_status = False
+        self.lease_seconds = QUEUE_LEASE_SECONDS
+        self.max_attempts = 3
+        self.check_queue = False
+        # The parameters as given, without those of the work queue, for the
+        # units of the queue.
+        self.arguments = []
+        self.verbose = False
+        self.quiet = False
+        self.log_format = 'text'
+        # Functions called with a dictionary for every event reported with
+        # log_event().
+        self.callbacks = []
+        self.conversion_factors = False
+        self.do_conversion = False
+        self.do_registration = False
+        self.do_convolution = False
+        self.do_resampling = False
+        self.do_seds = False
+        self.do_cleanup = False
+
+        for key, value in kwargs.items():
+            if (not hasattr(self, key)):
+                raise TypeError("Unknown imagecube parameter: " + key)
+            setattr(self, key, value)
+
+    def for_target(self, name, ra, dec, angular_size):
+        """
+        Returns a copy of the parameters for processing a single target of
+        a targets file.
+
+        Parameters
+        ----------
+        name: string
+            The name of the target.
+        ra, dec: float
+            The position (in degrees) of the target.
+        angular_size: float
+            The angular size (in arcsec) of the target.
+
+        Returns
+        -------
+        config: Config
+            The parameters to use for the target.
+        """
+
+        config = copy.copy(self)
+        config.target_name = name
+        config.ra_input = ra
+        config.dec_input = dec
+        config.phys_size = angular_size
+        return config
+
+def parse_command_line(arguments=None):
     """
     Parses the command line to obtain parameters.
 
+    Parameters
+    ----------
+    arguments: list
+        The parameters to parse. If not given, the parameters of the
+        command line the script was started with are used.
+
+    Returns
+    -------
+    config: Config
+        The parameters of the run.
     """
 
-    global phys_size
-    global directory
-    global conversion_factors
-    global do_conversion
-    global do_registration
-    global do_convolution
-    global do_resampling
-    global do_seds
-    global do_cleanup
-    global ra_input
-    global dec_input
-    global main_reference_image
-    global convolution_reference_image
+    config = Config()
+
+    if (arguments is None):
+        arguments = sys.argv[1:]
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "", ["directory=", "angular_size=", "conversion_factors", "conversion", "registration", "convolution", "resampling", "seds", "cleanup", "ra=", "dec=", "reference_image=", "convolution_reference_image=", "help"])
+        opts, args = getopt.getopt(arguments, "", ["directory=", "angular_size=", "conversion_factors", "conversion", "registration", "convolution", "resampling", "seds", "cleanup", "ra=", "dec=", "reference_image=", "convolution_reference_image=", "targets=", "catalog=", "build_catalog=", "instrument=", "band=", "min_coverage=", "server=", "max_jobs=", "compression=", "quantize_level=", "precision=", "convolution_method=", "kernel_coverage=", "resume", "max_memory=", "plan", "backend=", "synthetic=", "compare_backends", "tolerances=", "fwhm=", "add_band=", "regions=", "query=", "pixel_coordinates", "pyramid", "query_level=", "uncertainties", "background=", "calibrations=", "queue=", "enqueue", "worker", "queue_status", "lease=", "max_attempts=", "check_queue", "verbose", "quiet", "log_format=", "help"])
     except getopt.GetoptError:
-        print("An error occurred. Check your parameters and try again.")
+        logger.error("An error occurred. Check your parameters and try again.")
         sys.exit(2)
     for opt, arg in opts:
         if opt in ("--help"):
             print_usage()
             sys.exit()
         if opt in ("--angular_size"):
-            phys_size = float(arg)
+            config.phys_size = float(arg)
         if opt in ("--directory"):
-            directory = arg
-            if (not os.path.isdir(directory)):
-                print("Error: The directory cannot be found: " + directory)
+            config.directory = arg
+            if (not os.path.isdir(config.directory)):
+                logger.error("Error: The directory cannot be found: " + config.directory)
                 sys.exit()
         if opt in ("--conversion_factors"):
-            conversion_factors = True
+            config.conversion_factors = True
         if opt in ("--conversion"):
-            do_conversion = True
+            config.do_conversion = True
         if opt in ("--registration"):
-            do_registration = True
+            config.do_registration = True
         if opt in ("--convolution"):
-            do_convolution = True
+            config.do_convolution = True
         if opt in ("--resampling"):
-            do_resampling = True
+            config.do_resampling = True
         if opt in ("--seds"):
-            do_seds = True
+            config.do_seds = True
         if opt in ("--cleanup"):
-            do_cleanup = True
+            config.do_cleanup = True
         if opt in ("--ra"):
-            ra_input = float(arg)
+            config.ra_input = float(arg)
         if opt in ("--dec"):
-            dec_input = float(arg)
+            config.dec_input = float(arg)
         if opt in ("--reference_image"):
-            main_reference_image = arg
+            config.main_reference_image = arg
         if opt in ("--convolution_reference_image"):
-            convolution_reference_image = arg
+            config.convolution_reference_image = arg
+        if opt in ("--targets"):
+            config.targets_file = arg
+            if (not os.path.isfile(config.targets_file)):
+                logger.error("Error: The targets file cannot be found: " + config.targets_file)
+                sys.exit()
+        if opt in ("--catalog"):
+            config.catalog_file = arg
+        # A one-element tuple, as "--catalog" is also a substring of this name.
+        if opt in ("--build_catalog",):
+            config.build_catalog_directory = arg
+            if (not os.path.isdir(config.build_catalog_directory)):
+                logger.error("Error: The archive directory cannot be found: " + config.build_catalog_directory)
+                sys.exit()
+        if opt in ("--instrument"):
+            config.instrument_selection = arg
+        if opt in ("--band"):
+            band = arg.split(',')
+            if (len(band) != 2 or not all(is_number(x) for x in band)):
+                logger.error("Error: The band should be given as <lower>,<upper>: " + arg)
+                sys.exit()
+            config.band_selection = (float(band[0]), float(band[1]))
+        if opt in ("--min_coverage"):
+            config.min_coverage = float(arg)
+        if opt in ("--server"):
+            config.server_port = int(arg)
+        if opt in ("--max_jobs"):
+            config.max_jobs = int(arg)
+        if opt in ("--compression"):
+            config.compression = arg.lower()
+            if (config.compression not in COMPRESSION_TYPES):
+                logger.error("Error: The compression should be one of: " + ', '.join(sorted(COMPRESSION_TYPES)))
+                sys.exit()
+        if opt in ("--quantize_level"):
+            config.quantize_level = float(arg)
+        if opt in ("--precision"):
+            config.precision = arg.lower()
+            if (config.precision not in IRAF_PIXEL_TYPES):
+                logger.error("Error: The precision should be one of: " + ', '.join(sorted(IRAF_PIXEL_TYPES)))
+                sys.exit()
+        # A one-element tuple, as "--convolution" is also a substring of this name.
+        if opt in ("--convolution_method",):
+            config.convolution_method = arg.lower()
+            if (config.convolution_method not in ('direct', 'fft')):
+                logger.error("Error: The convolution method should be either direct or fft.")
+                sys.exit()
+        if opt in ("--kernel_coverage"):
+            config.kernel_coverage = float(arg)
+        if opt in ("--resume"):
+            config.resume = True
+        if opt in ("--max_memory"):
+            config.max_memory = float(arg)
+        if opt in ("--plan"):
+            config.plan = True
+        if opt in ("--backend"):
+            config.backend = arg.lower()
+            if (config.backend not in ('iraf', 'native')):
+                logger.error("Error: The backend should be either iraf or native.")
+                sys.exit()
+        if opt in ("--synthetic"):
+            config.synthetic_directory = arg
+        # A one-element tuple, as "--backend" is also a substring of this name.
+        if opt in ("--compare_backends",):
+            config.compare_backends = True
+        if opt in ("--tolerances"):
+            for tolerance in arg.split(','):
+                name, value = (tolerance.split('=') + [''])[:2]
+                if (name not in COMPARISON_TOLERANCES or not is_number(value)):
+                    logger.error("Error: The tolerances should be given as <name>=<value>, with names among: " + ', '.join(sorted(COMPARISON_TOLERANCES)))
+                    sys.exit()
+                config.tolerances[name] = float(value)
+        if opt in ("--fwhm"):
+            config.fwhm = float(arg)
+        if opt in ("--add_band"):
+            config.add_band_file = arg
+            if (not os.path.isfile(config.add_band_file)):
+                logger.error("Error: The file to add cannot be found: " + config.add_band_file)
+                sys.exit()
+        if opt in ("--regions"):
+            config.regions_file = arg
+            if (not os.path.isfile(config.regions_file)):
+                logger.error("Error: The regions file cannot be found: " + config.regions_file)
+                sys.exit()
+        if opt in ("--query"):
+            config.query = arg
+        if opt in ("--pixel_coordinates"):
+            config.pixel_coordinates = True
+        if opt in ("--pyramid"):
+            config.pyramid = True
+        if opt in ("--query_level",):
+            config.query_level = int(arg)
+        if opt in ("--uncertainties"):
+            config.uncertainties = True
+        if opt in ("--background"):
+            if (not is_number(arg) or int(float(arg)) < 2):
+                logger.error("Error: The background tile size should be a number of pixels of at least 2: " + arg)
+                sys.exit()
+            config.background_tile = int(float(arg))
+        if opt in ("--calibrations"):
+            config.calibrations_file = arg
+            if (not os.path.isfile(config.calibrations_file)):
+                logger.error("Error: The calibrations file cannot be found: " + config.calibrations_file)
+                sys.exit()
+            load_calibrations(config.calibrations_file, config.calibrations)
+        if opt in ("--queue"):
+            config.queue_file = arg
+        if opt in ("--enqueue"):
+            config.enqueue = True
+        if opt in ("--worker"):
+            config.worker = True
+        # A one-element tuple, as "--queue" is also a substring of this name.
+        if opt in ("--queue_status",):
+            config.queue_status = True
+        if opt in ("--lease"):
+            config.lease_seconds = float(arg)
+        if opt in ("--max_attempts"):
+            config.max_attempts = int(arg)
+        if opt in ("--check_queue"):
+            config.check_queue = True
+        if opt in ("--verbose"):
+            config.verbose = True
+        if opt in ("--quiet"):
+            config.quiet = True
+        if opt in ("--log_format"):
+            config.log_format = arg.lower()
+            if (config.log_format not in ('text', 'json')):
+                logger.error("Error: The log format should be either text or json.")
+                sys.exit()
+        if (opt not in ("--queue", "--enqueue", "--worker", "--queue_status", "--lease", "--max_attempts", "--check_queue", "--server", "--max_jobs")):
+            config.arguments.append(opt)
+            if (arg != ''):
+                config.arguments.append(arg)
+
+    if (config.uncertainties and config.backend != 'native'):
+        logger.error("Error: The uncertainties parameter needs the native backend, as IRAF cannot propagate the variances.")
+        sys.exit()
+
+    if (config.background_tile > 0 and not config.do_conversion):
+        logger.error("Error: The background parameter needs the conversion step, in which the background is subtracted.")
+        sys.exit()
+
+    if (config.build_catalog_directory != '' and config.catalog_file == ''):
+        logger.error("Error: The catalog parameter is needed with build_catalog.")
+        sys.exit()
+
+    configure_logging(config)
 
-    if (main_reference_image != ''):
+    if ((config.enqueue or config.worker or config.queue_status) and config.queue_file == ''):
+        logger.error("Error: The queue parameter is needed with enqueue, worker and queue_status.")
+        sys.exit()
+
+    if (config.main_reference_image != ''):
         try:
-            with open(directory + '/' + main_reference_image): pass
+            with open(config.directory + '/' + config.main_reference_image): pass
         except IOError:
-            print("The file " + main_reference_image + " could not be found in the directory " + directory)
+            logger.error("The file " + config.main_reference_image + " could not be found in the directory " + config.directory)
             sys.exit()
 
-    if (convolution_reference_image != ''):
+    if (config.convolution_reference_image != ''):
         try:
-            with open(directory + '/' + convolution_reference_image): pass
+            with open(config.directory + '/' + config.convolution_reference_image): pass
         except IOError:
-            print("The file " + convolution_reference_image + " could not be found in the directory " + directory)
+            logger.error("The file " + config.convolution_reference_image + " could not be found in the directory " + config.directory)
             sys.exit()
 
-def output_conversion_factors(images_with_headers):
+    return config
+
+def read_targets(filename):
     """
-    Prints a formatted list of instruments, wavelengths, and conversion
-    factors to Jy/pixel
+    Reads the list of targets to be extracted from the input images.
+    Lines starting with '#' are ignored.
 
     Parameters
     ----------
-    images_with_headers: zipped list structure
-        A structure containing headers and image data for all FITS input
-        images.
+    filename: string
+        The name of a text file in which each line holds a target name,
+        its RA and DEC (in degrees) and its angular size (in arcsec),
+        separated by spaces or commas.
 
+    Returns
+    -------
+    targets: list
+        A list of (name, ra, dec, angular_size) tuples.
     """
 
-    print("Instrument\tWavelength\tConversion factor (to Jy/pixel)")
-    for i in range(0, len(images_with_headers)):
-        wavelength = images_with_headers[i][1]['WAVELENG']
-        wavelength_units = images_with_headers[i][1].comments['WAVELENG']
-        instrument = get_instrument(images_with_headers[i][1])
-        conversion_factor = get_conversion_factor(images_with_headers[i][1], instrument)
-        print(instrument + '\t' + `wavelength` + '\t' + `conversion_factor`)
+    targets = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if (line == '' or line.startswith('#')):
+                continue
+            fields = line.replace(',', ' ').split()
+            if (len(fields) != 4 or not all(is_number(x) for x in fields[1:])):
+                logger.error("Could not parse the line '" + line + "' in the targets file " + filename)
+                sys.exit()
+            targets.append((fields[0], float(fields[1]), float(fields[2]), float(fields[3])))
+    return targets
 
-def convert_images(images_with_headers):
+class JsonFormatter(logging.Formatter):
     """
-    Converts all of the input images' native "flux units" to Jy/pixel
-    The converted values are stored in the list of arrays, 
-    converted_data, and they are also saved as new FITS images.
+    Formats log messages as JSON objects, including the fields of the
+    events reported with log_event().
+    """
+
+    def format(self, record):
+        message = {'time': record.created, 'level': record.levelname, 'message': record.getMessage()}
+        message.update(getattr(record, 'event', {}))
+        return json.dumps(message)
+
+def configure_logging(config):
+    """
+    Sets the level and format of the messages from the verbose, quiet and
+    log_format parameters.
 
     Parameters
     ----------
-    images_with_headers: zipped list structure
-        A structure containing headers and image data for all FITS input
-        images.
+    config: Config
+        The parameters of the run.
 
     """
 
-    print("Converting images")
-    for i in range(0, len(images_with_headers)):
-        instrument = get_instrument(images_with_headers[i][1])
-        conversion_factor = get_conversion_factor(images_with_headers[i][1], instrument)
+    if (config.verbose):
+        logger.setLevel(logging.DEBUG)
+    elif (config.quiet):
+        logger.setLevel(logging.WARNING)
+    else:
+        logger.setLevel(logging.INFO)
+    if (config.log_format == 'json'):
+        log_handler.setFormatter(JsonFormatter())
+    else:
+        log_handler.setFormatter(logging.Formatter('%(message)s'))
 
-        # Some manipulation of filenames and directories
-        original_filename = os.path.basename(images_with_headers[i][2])
-        original_directory = os.path.dirname(images_with_headers[i][2])
-        new_directory = original_directory + "/converted/"
-        converted_filename = new_directory + original_filename  + "_converted.fits"
-        if not os.path.exists(new_directory):
-            os.makedirs(new_directory)
+def log_event(config, event, stage, message=None, level=logging.INFO, **fields):
+    """
+    Reports an event of a processing step: it is logged, and passed to each
+    of the callbacks of the run as a dictionary holding the event, the stage
+    and the other fields.
+
+    Parameters
+    ----------
+    config: Config
+        The parameters of the run.
+    event: string
+        'start' or 'end' of a step, or of the processing of one image (with
+        an 'image' field), or 'progress' (with 'done' and 'total' fields).
+        The 'end' events have a 'duration' field (in seconds), and those of
+        images a 'bytes' field for the size of the files written.
+    stage: string
+        The name of the step.
+    message: string
+        The message to log; by default it is made from the fields.
+    level: int
+        The logging level of the message.
+
+    """
+
+    fields['event'] = event
+    fields['stage'] = stage
+    for callback in config.callbacks:
+        callback(dict(fields))
+    if (message is None):
+        message = stage + ": " + event
+        if ('image' in fields):
+            message += " " + os.path.basename(fields['image'])
+        if ('done' in fields):
+            message += " " + `fields['done']` + "/" + `fields['total']`
+        if ('duration' in fields):
+            message += " in %.2f s" % fields['duration']
+        if ('bytes' in fields):
+            message += ", %.1f MB written" % (fields['bytes'] / 1024.0**2)
+    logger.log(level, message, extra={'event': fields})
+
+def log_image_end(config, stage, image_filename, start, output_filenames):
+    """
+    Reports the end of the processing of one image by a step, with the time
+    since start and the size of the files written; see log_event().
+    """
+
+    log_event(config, 'end', stage, level=logging.DEBUG, image=image_filename, duration=time.time() - start, bytes=sum(os.path.getsize(f) for f in output_filenames if os.path.isfile(f)))
+
+class ProgressReporter(object):
+    """
+    Reports the progress of a long loop as progress events (see
+    log_event()), at most once every PROGRESS_INTERVAL seconds and at the
+    end of the loop.
+
+    Parameters
+    ----------
+    config: Config
+        The parameters of the run.
+    stage: string
+        The name of the step.
+    total: int
+        The number of iterations of the loop.
+
+    """
+
+    def __init__(self, config, stage, total):
+        self.config = config
+        self.stage = stage
+        self.total = total
+        self.last_report = time.time()
+
+    def update(self, done):
+        """
+        Records that done iterations of the loop are finished.
+        """
+
+        now = time.time()
+        if (done == self.total or now - self.last_report >= PROGRESS_INTERVAL):
+            self.last_report = now
+            log_event(self.config, 'progress', self.stage, done=done, total=self.total)
+
+def get_iraf_verbose():
+    """
+    Returns the value of the verbose parameter of the IRAF tasks: they only
+    report what they do with the verbose parameter of imagecube.
+    """
+
+    if (logger.isEnabledFor(logging.DEBUG)):
+        return "yes"
+    return "no"
+
+def get_target_directory(original_directory, config):
+    """
+    Returns the directory under which the output files of the current
+    target are written.
+
+    Parameters
+    ----------
+    original_directory: string
+        The directory the output files would be written to if only a
+        single target was being processed.
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    target_directory: string
+        original_directory itself when processing a single target, or
+        original_directory/targets/<target name> otherwise.
+    """
+
+    if (config.target_name == ''):
+        return original_directory
+    return original_directory + "/targets/" + config.target_name
+
+def get_scratch_filename(filename, config):
+    """
+    Returns the name of a file that is written to the directory of the
+    current target, so that neither targets nor runs on different
+    directories overwrite each other's files.
+
+    Parameters
+    ----------
+    filename: string
+        The base name of the file.
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    scratch_filename: string
+        The name of the file to use for the current target.
+    """
+
+    target_directory = get_target_directory(config.directory or '.', config)
+    if not os.path.exists(target_directory):
+        os.makedirs(target_directory)
+    return target_directory + '/' + filename
+
+def as_precision(data, config):
+    """
+    Returns the image data in single precision if this was requested with
+    the precision parameter. The data is not copied if it already is.
+
+    Parameters
+    ----------
+    data: numpy array
+        The image data.
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    data: numpy array
+        The image data in the requested precision.
+    """
+
+    if (config.precision == 'float32'):
+        return np.asarray(data, dtype=np.float32)
+    return data
+
+def write_fits(filename, data, header, config):
+    """
+    Writes an image to a FITS file. If compression was requested, the image
+    is written as a tile-compressed extension after an empty primary HDU.
+
+    Parameters
+    ----------
+    filename: string
+        The name of the FITS file to write.
+    data: numpy array
+        The image data.
+    header: FITS file header
+        The header of the image.
+    config: Config
+        The parameters of the run.
+
+    """
+
+    if (config.compression == ''):
+        fits.PrimaryHDU(data, header).writeto(filename, clobber=True)
+        return
+
+    compressed_hdu = fits.CompImageHDU(data, header, compression_type=COMPRESSION_TYPES[config.compression], quantize_level=config.quantize_level)
+    fits.HDUList([fits.PrimaryHDU(), compressed_hdu]).writeto(filename, clobber=True)
+
+def get_image_hdu(hdulist):
+    """
+    Returns the HDU holding the image written by write_fits(), whether or
+    not it was compressed.
+
+    Parameters
+    ----------
+    hdulist: HDUList
+        The opened FITS file.
+
+    Returns
+    -------
+    hdu: HDU
+        The HDU holding the image.
+    """
+
+    if (len(hdulist) > 1 and isinstance(hdulist[1], fits.CompImageHDU)):
+        return hdulist[1]
+    return hdulist[0]
+
+def read_fits(filename):
+    """
+    Reads an image written by write_fits() or by IRAF.
+
+    Parameters
+    ----------
+    filename: string
+        The name of the FITS file to read.
+
+    Returns
+    -------
+    data: numpy array
+        The image data.
+    header: FITS file header
+        The header of the image.
+    """
+
+    hdulist = fits.open(filename)
+    hdu = get_image_hdu(hdulist)
+    data = hdu.data
+    header = hdu.header
+    hdulist.close()
+    return data, header
+
+def get_variance_filename(filename):
+    """
+    Returns the name of the file holding the variance of an output image
+    (see the uncertainties parameter).
+    """
+
+    return os.path.splitext(filename)[0] + "_var.fits"
+
+def get_variance_files(input_filename, output_filename, config):
+    """
+    Returns the variance files that a processing step reads and writes
+    along with an image: with the uncertainties parameter, if the variance
+    of the step's input file exists.
+
+    Parameters
+    ----------
+    input_filename: string
+        The input file of the step.
+    output_filename: string
+        The output file of the step.
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    variance_inputs: list
+        The variance of the input file, or an empty list.
+    variance_outputs: list
+        The variance of the output file, or an empty list.
+    """
+
+    variance_input = get_variance_filename(input_filename)
+    if (config.uncertainties and os.path.isfile(variance_input)):
+        return [variance_input], [get_variance_filename(output_filename)]
+    return [], []
+
+def is_uncertainty_file(filename):
+    """
+    Checks whether a FITS file is the uncertainty image of an input file,
+    i.e. whether its name (without the extension) ends with _unc.
+    """
+
+    return strip_fits_extension(os.path.basename(filename)).endswith('_unc')
+
+def find_uncertainty_input(filename):
+    """
+    Finds the uncertainty image of an input image: the file <name>_unc.fits
+    (or .fit, possibly compressed), or else an extension of the input file
+    named in UNCERTAINTY_EXTENSIONS.
+
+    Parameters
+    ----------
+    filename: string
+        The name of the input file, without its extension.
+
+    Returns
+    -------
+    uncertainty_input: tuple
+        The (filename, extension name) of the uncertainty image, where the
+        extension name is None for a separate file; None if the image has
+        no uncertainties.
+    """
+
+    for uncertainty_filename in sorted(glob.glob(filename + "_unc.fit*")):
+        return (uncertainty_filename, None)
+    for input_filename in sorted(glob.glob(filename + ".fit*")):
+        hdulist = fits.open(get_input_path(input_filename))
+        names = [hdu.name for hdu in hdulist]
+        hdulist.close()
+        for name in UNCERTAINTY_EXTENSIONS:
+            if (name in names):
+                return (input_filename, name)
+    return None
+
+def read_uncertainty_input(uncertainty_input):
+    """
+    Reads the variance of an input image from its uncertainty image, as
+    found by find_uncertainty_input().
+
+    Returns
+    -------
+    variance: numpy array
+        The square of the uncertainty image, in double precision.
+    """
+
+    filename, extension = uncertainty_input
+    hdulist = fits.open(get_input_path(filename))
+    if (extension is None):
+        image_hdu = get_input_hdus(hdulist)[1]
+    else:
+        image_hdu = hdulist[extension]
+    variance = np.asarray(image_hdu.data, dtype=np.float64)**2
+    hdulist.close()
+    return variance
+
+def get_iraf_input(filename):
+    """
+    Returns the name of a file holding the given image that IRAF can read.
+    IRAF cannot read tile-compressed images, so these are written out
+    uncompressed next to the original first.
+
+    Parameters
+    ----------
+    filename: string
+        The name of a FITS file written by write_fits().
+
+    Returns
+    -------
+    iraf_filename: string
+        filename itself if the image is not compressed, or the name of an
+        uncompressed copy, which should be removed once IRAF is done with
+        it.
+    """
+
+    hdulist = fits.open(filename)
+    if (not isinstance(get_image_hdu(hdulist), fits.CompImageHDU)):
+        hdulist.close()
+        return filename
+    hdu = hdulist[1]
+    iraf_filename = os.path.splitext(filename)[0] + "_uncompressed.fits"
+    fits.PrimaryHDU(hdu.data, hdu.header).writeto(iraf_filename, clobber=True)
+    hdulist.close()
+    return iraf_filename
+
+def compress_fits(filename, config):
+    """
+    Rewrites an uncompressed FITS file written by IRAF as a tile-compressed
+    one, if compression was requested.
+
+    Parameters
+    ----------
+    filename: string
+        The name of the FITS file.
+    config: Config
+        The parameters of the run.
+
+    """
+
+    if (config.compression == ''):
+        return
+    data, header = read_fits(filename)
+    # The data may still be mapped from the file that is about to be
+    # overwritten.
+    write_fits(filename, np.array(data), header, config)
+
+def strip_fits_extension(filename):
+    """
+    Strips the .fit or .fits extension from a filename, along with the .gz
+    or .fz extension of a compressed file, so that the names of the output
+    files can be derived from it.
+    """
+
+    if (filename.endswith('.gz') or filename.endswith('.fz')):
+        filename = filename[:-3]
+    return os.path.splitext(filename)[0]
+
+def get_cached_filename(filename):
+    """
+    Returns the name of the decompressed copy of a gzipped input file,
+    which is kept in the cache/ subdirectory of the file's directory.
+    """
+
+    return os.path.dirname(filename) + "/cache/" + os.path.basename(filename)[:-len('.gz')]
+
+def get_input_path(filename):
+    """
+    Returns the name of the file from which an input image should be read:
+    its decompressed copy for a gzipped file that has been decompressed
+    with decompress_inputs(), or the file itself otherwise. Tile-compressed
+    (fpack) files are read directly, as their tiles are only decompressed
+    when the image data is accessed.
+    """
+
+    if (filename.endswith('.gz')):
+        cached_filename = get_cached_filename(filename)
+        if (os.path.isfile(cached_filename) and os.path.getmtime(cached_filename) >= os.path.getmtime(filename)):
+            return cached_filename
+    return filename
+
+def decompress_file(filename, cached_filename):
+    """
+    Writes the decompressed copy of a gzipped input file.
+    """
+
+    import gzip
+    import shutil
+
+    logger.debug("Decompressing " + filename)
+    cache_directory = os.path.dirname(cached_filename)
+    try:
+        os.makedirs(cache_directory)
+    except OSError:
+        # Another pipeline may have created it in the meantime.
+        if not os.path.isdir(cache_directory):
+            raise
+    source = gzip.open(filename, 'rb')
+    # Write to a temporary file of its own first, so that neither an
+    # interruption nor another pipeline decompressing the same file can
+    # leave a truncated copy in the cache; the rename replaces any copy
+    # written in the meantime in one step.
+    temp_file, temp_filename = tempfile.mkstemp(prefix=os.path.basename(cached_filename) + '.', suffix='.tmp', dir=cache_directory)
+    with os.fdopen(temp_file, 'wb') as f:
+        shutil.copyfileobj(source, f, 1024 * 1024)
+    source.close()
+    os.rename(temp_filename, cached_filename)
+
+def decompress_inputs(all_files, config):
+    """
+    Decompresses the gzipped input files that are not yet in the cache, in
+    parallel, so that they are only decompressed once rather than every
+    time they are opened.
+
+    Parameters
+    ----------
+    all_files: list
+        The names of the input FITS files.
+    config: Config
+        The parameters of the run.
+
+    """
+
+    tasks = []
+    for filename in all_files:
+        if (filename.endswith('.gz') and get_input_path(filename) == filename):
+            # Decompression streams the data, so only the number of threads
+            # limits how many files are decompressed at the same time.
+            tasks.append((0, decompress_file, (filename, get_cached_filename(filename))))
+    if (tasks != []):
+        MemoryScheduler(1, multiprocessing.cpu_count()).run(tasks)
+
+class BackgroundCall(object):
+    """
+    Calls a function in a background thread.
+
+    Parameters
+    ----------
+    function: function
+        The function to call.
+    arguments: tuple
+        The arguments to call it with.
+
+    """
+
+    def __init__(self, function, arguments):
+        self.queue = Queue.Queue(1)
+        thread = threading.Thread(target=self.run, args=(function, arguments))
+        thread.daemon = True
+        thread.start()
+
+    def run(self, function, arguments):
+        try:
+            self.queue.put((True, function(*arguments)))
+        except BaseException:
+            self.queue.put((False, sys.exc_info()))
+
+    def result(self):
+        """
+        Waits for the call to finish and returns its result, or raises its
+        exception.
+        """
+
+        succeeded, value = self.queue.get()
+        if (not succeeded):
+            raise value[0], value[1], value[2]
+        return value
+
+def prefetch(function, arguments_list):
+    """
+    Calls a function (e.g. read_fits()) for each of a list of arguments in
+    turn, and yields the results. While the caller works on one result, the
+    next one is computed in a background thread.
+
+    Parameters
+    ----------
+    function: function
+        The function to call.
+    arguments_list: list
+        The arguments of each call, as tuples.
+
+    """
+
+    if (arguments_list == []):
+        return
+    call = BackgroundCall(function, arguments_list[0])
+    for i in range(0, len(arguments_list)):
+        result = call.result()
+        if (i + 1 < len(arguments_list)):
+            call = BackgroundCall(function, arguments_list[i + 1])
+        yield result
+
+def get_input_hdus(hdulist):
+    """
+    Returns the header describing an input image and the HDU holding its
+    data.
+
+    Parameters
+    ----------
+    hdulist: HDUList
+        The opened input FITS file.
+
+    Returns
+    -------
+    header: FITS file header
+        The primary header, or the header of the compressed image for a
+        tile-compressed (fpack) file.
+    image_hdu: HDU
+        The HDU holding the image data.
+    """
+
+    header = hdulist[0].header
+    # Files holding more than one image are split by get_input_planes().
+    science_hdus = [i for i in range(0, len(hdulist)) if is_science_hdu(hdulist[i])]
+    if ('EXTEND' in header and 'DSETS___' in header):
+        image_hdu = hdulist[1]
+    elif (len(hdulist) > 1 and isinstance(hdulist[1], fits.CompImageHDU)):
+        image_hdu = hdulist[1]
+        header = image_hdu.header
+    elif (science_hdus != [] and science_hdus[0] > 0):
+        # An empty primary HDU followed by the image extension.
+        image_hdu = hdulist[science_hdus[0]]
+        header = get_extension_header(hdulist, science_hdus[0])
+    else:
+        image_hdu = hdulist[0]
+    return header, image_hdu
+
+def get_extension_header(hdulist, index):
+    """
+    Returns the header describing the images of an HDU of an input file:
+    for an extension, the primary header updated with the keywords of the
+    extension.
+    """
+
+    header = hdulist[index].header
+    if (index > 0):
+        header = hdulist[0].header.copy()
+        header.extend(hdulist[index].header, strip=True, update=True)
+    return header
+
+def is_science_hdu(hdu):
+    """
+    Checks whether an HDU of an input file holds images to be processed:
+    image HDUs with at least two axes, apart from uncertainty extensions
+    (see UNCERTAINTY_EXTENSIONS) and the pyramid levels of a data cube.
+    """
+
+    return (isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU, fits.CompImageHDU)) and hdu.header.get('NAXIS', 0) >= 2
+            and hdu.name not in UNCERTAINTY_EXTENSIONS and not hdu.name.startswith('LEVEL'))
+
+def get_hdu_shape(hdu):
+    """
+    Returns the dimensions of the data of an image HDU from its header, in
+    the order of the numpy array (the last axis first).
+    """
+
+    return tuple(hdu.header['NAXIS%d' % axis] for axis in range(hdu.header['NAXIS'], 0, -1))
+
+def get_plane_wavelength(header, naxis, index, plane_number):
+    """
+    Returns the wavelength of a plane of an input image with more than two
+    axes: the WAVEnnn keyword of a data cube written by imagecube, or else
+    the world coordinate of the plane along a wavelength (WAVE, AWAV) or
+    frequency (FREQ) axis.
+
+    Parameters
+    ----------
+    header: FITS file header
+        The header of the HDU holding the plane.
+    naxis: int
+        The number of axes of the HDU.
+    index: tuple
+        The index of the plane along the axes beyond the first two, in the
+        order of the numpy array.
+    plane_number: int
+        The number of the plane in the input file, starting from 1.
+
+    Returns
+    -------
+    wavelength: float
+        The wavelength in microns, or None if it cannot be determined.
+    """
+
+    if (('WAVE%03d' % plane_number) in header):
+        return header['WAVE%03d' % plane_number]
+    for axis in range(3, naxis + 1):
+        ctype = header.get('CTYPE%d' % axis, '')[:4]
+        if (ctype not in ('WAVE', 'AWAV', 'FREQ') or ('CRVAL%d' % axis) not in header):
+            continue
+        pixel = index[naxis - axis] + 1
+        delta = header.get('CDELT%d' % axis, header.get('CD%d_%d' % (axis, axis), 1.))
+        value = header['CRVAL%d' % axis] + (pixel - header.get('CRPIX%d' % axis, 1.)) * delta
+        if (ctype == 'FREQ'):
+            unit = header.get('CUNIT%d' % axis, 'Hz')
+        else:
+            unit = header.get('CUNIT%d' % axis, 'm')
+        return (value * u.Unit(unit.strip())).to(u.micron, equivalencies=u.spectral()).value
+    return None
+
+def get_plane_header(header, shape, index, plane_number):
+    """
+    Returns the header of one plane of an input image with more than two
+    axes, as a two dimensional image with its own wavelength.
+
+    Parameters
+    ----------
+    header: FITS file header
+        The header of the HDU holding the plane.
+    shape: tuple
+        The dimensions of the HDU, as returned by get_hdu_shape().
+    index: tuple
+        The index of the plane along the axes beyond the first two.
+    plane_number: int
+        The number of the plane in the input file, starting from 1.
+
+    Returns
+    -------
+    plane_header: FITS file header
+        The header of the plane, without the keywords of the other axes.
+    """
+
+    naxis = len(shape)
+    plane_header = header.copy()
+    wavelength = get_plane_wavelength(header, naxis, index, plane_number)
+    for axis in range(3, naxis + 1):
+        keywords = [prefix + `axis` for prefix in ('NAXIS', 'CTYPE', 'CRVAL', 'CRPIX', 'CDELT', 'CUNIT', 'CROTA')]
+        for other_axis in range(1, naxis + 1):
+            for prefix in ('CD', 'PC'):
+                keywords += [prefix + `axis` + '_' + `other_axis`, prefix + `other_axis` + '_' + `axis`]
+        for keyword in keywords:
+            if (keyword in plane_header):
+                del plane_header[keyword]
+    plane_header['NAXIS'] = 2
+    plane_header['NAXIS1'] = shape[-1]
+    plane_header['NAXIS2'] = shape[-2]
+    if (wavelength is not None):
+        plane_header['WAVELENG'] = (wavelength, 'micron')
+    plane_header['INPLANE'] = (plane_number, 'Plane of the input file')
+    return plane_header
+
+def get_input_planes(hdulist):
+    """
+    Returns every image of an input file: each plane of each HDU accepted
+    by is_science_hdu(), the planes being taken along the axes beyond the
+    first two. The header of an extension is that of the primary HDU
+    updated with the keywords of the extension, and each plane gets its
+    own wavelength from get_plane_wavelength() when it can be determined.
+    A single image is returned whole, whichever HDU holds it; a file
+    without any science HDU gives the header and HDU returned by
+    get_input_hdus().
+
+    Parameters
+    ----------
+    hdulist: HDUList
+        The opened input FITS file.
+
+    Returns
+    -------
+    planes: list
+        A list of (header, HDU index, plane index) tuples, where the plane
+        index is None for a file holding a single image.
+    """
+
+    science_hdus = [i for i in range(0, len(hdulist)) if is_science_hdu(hdulist[i])]
+    num_planes = sum(int(np.prod(get_hdu_shape(hdulist[i])[:-2])) for i in science_hdus)
+    if (science_hdus == []):
+        header, image_hdu = get_input_hdus(hdulist)
+        return [(header, hdulist.index(image_hdu), None)]
+    if (num_planes == 1):
+        return [(get_extension_header(hdulist, science_hdus[0]), science_hdus[0], None)]
+
+    planes = []
+    for i in science_hdus:
+        header = get_extension_header(hdulist, i)
+        shape = get_hdu_shape(hdulist[i])
+        for index in np.ndindex(*shape[:-2]):
+            planes.append((get_plane_header(header, shape, index, len(planes) + 1), i, index))
+    return planes
+
+def read_input_plane(filename, plane):
+    """
+    Reads one plane of an input file, as found by get_input_planes(). Only
+    that plane is read from uncompressed files.
+
+    Parameters
+    ----------
+    filename: string
+        The name of the input FITS file.
+    plane: tuple
+        The (HDU index, plane index) of the plane.
+
+    Returns
+    -------
+    data: numpy array
+        The image data of the plane.
+    """
+
+    hdulist = fits.open(get_input_path(filename))
+    hdu_index, index = plane
+    hdu = hdulist[hdu_index]
+    if (index is None):
+        data = hdu.data
+    elif (isinstance(hdu, fits.CompImageHDU)):
+        # The tiles of a compressed HDU are decompressed together.
+        data = np.array(hdu.data[index])
+    else:
+        data = hdu.section[index]
+    hdulist.close()
+    return data
+
+def get_file_checksum(filename):
+    """
+    Returns the MD5 checksum of a file, read in blocks so that large images
+    do not need to fit in memory.
+
+    Parameters
+    ----------
+    filename: string
+        The name of the file.
+
+    Returns
+    -------
+    checksum: string
+        The hexadecimal MD5 checksum of the file.
+    """
+
+    checksum = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+def get_run_state_filename(config):
+    """
+    Returns the name of the file in which the completed steps of the runs
+    on the current target are recorded.
+
+    Parameters
+    ----------
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    run_state_filename: string
+        The name of the run state file.
+    """
+
+    return get_scratch_filename('run_state.json', config)
+
+def load_run_state(config):
+    """
+    Reads the steps completed by previous runs on the current target.
+
+    Parameters
+    ----------
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    run_state: dict
+        The completed units, keyed by a name such as
+        "register:<filename>", as recorded by mark_unit_complete().
+    """
+
+    run_state_filename = get_run_state_filename(config)
+    if (not os.path.isfile(run_state_filename)):
+        return {}
+    try:
+        with open(run_state_filename) as f:
+            return json.load(f)
+    except ValueError:
+        logger.warning("The run state file " + run_state_filename + " could not be read; all of the steps will be redone.")
+        return {}
+
+def reset_run_state(config):
+    """
+    Forgets the steps completed by previous runs on the current target, so
+    that a later run with resume does not skip steps whose outputs are
+    about to be overwritten.
+
+    Parameters
+    ----------
+    config: Config
+        The parameters of the run.
+
+    """
+
+    run_state_filename = get_run_state_filename(config)
+    if (os.path.isfile(run_state_filename)):
+        os.remove(run_state_filename)
+
+def get_unit_settings(settings, config):
+    """
+    Returns the settings of a unit of work as they are recorded in the run
+    state, including the parameters that affect all of the output files.
+    """
+
+    return repr(tuple(settings) + (config.precision, config.compression, config.quantize_level))
+
+def is_unit_complete(run_state, unit, input_filenames, output_filenames, settings, config):
+    """
+    Checks whether a unit of work (one step for one image) was completed by
+    a previous run and can be skipped. This is only the case with the
+    resume parameter, if the unit was recorded with the same input files,
+    output files and settings, and none of these files is missing or has
+    changed since. Otherwise, any output files left by an interrupted run
+    are removed, as IRAF will not overwrite them.
+
+    Parameters
+    ----------
+    run_state: dict
+        The completed units, as returned by load_run_state().
+    unit: string
+        The name of the unit.
+    input_filenames: list
+        The files the unit reads.
+    output_filenames: list
+        The files the unit writes.
+    settings: tuple
+        The parameter values the outputs depend on.
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    complete: boolean
+        True if the unit can be skipped.
+    """
+
+    if (not config.resume):
+        return False
+
+    entry = run_state.get(unit)
+    complete = (entry is not None and entry['settings'] == get_unit_settings(settings, config) and sorted(entry['inputs']) == sorted(input_filenames) and sorted(entry['outputs']) == sorted(output_filenames))
+    if (complete):
+        for filename, checksum in list(entry['inputs'].items()) + list(entry['outputs'].items()):
+            if (not os.path.isfile(filename) or get_file_checksum(filename) != checksum):
+                logger.info("Redoing " + unit + ": " + filename + " is missing or has changed.")
+                complete = False
+                break
+    if (complete):
+        logger.debug("Skipping " + unit + ": it was completed by a previous run.")
+        return True
+
+    for filename in output_filenames:
+        if (os.path.isfile(filename)):
+            logger.warning("Removing incomplete output " + filename)
+            os.remove(filename)
+    return False
+
+def mark_unit_complete(run_state, unit, input_filenames, output_filenames, settings, config):
+    """
+    Records that a unit of work has been completed, together with the
+    checksums of its input and output files, and saves the run state. This
+    is only done with the resume parameter.
+
+    Parameters
+    ----------
+    run_state: dict
+        The completed units, as returned by load_run_state().
+    unit: string
+        The name of the unit.
+    input_filenames: list
+        The files the unit read.
+    output_filenames: list
+        The files the unit wrote.
+    settings: tuple
+        The parameter values the outputs depend on.
+    config: Config
+        The parameters of the run.
+
+    """
+
+    # Only runs with the resume parameter read the run state, so the
+    # checksums are not computed otherwise.
+    if (not config.resume):
+        return
+
+    entry = {
+        'settings': get_unit_settings(settings, config),
+        'inputs': dict((filename, get_file_checksum(filename)) for filename in input_filenames),
+        'outputs': dict((filename, get_file_checksum(filename)) for filename in output_filenames),
+    }
+    run_state_filename = get_run_state_filename(config)
+    with run_state_lock:
+        # The workers of a work queue run in separate processes that record
+        # their units in the same file, so it is locked while the units they
+        # recorded are read back and merged in.
+        with open(run_state_filename + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            run_state.update(load_run_state(config))
+            run_state[unit] = entry
+            # Write to a temporary file of this process first so that an
+            # interruption cannot leave a truncated run state behind.
+            temp_file, temp_filename = tempfile.mkstemp(prefix='run_state.json.', suffix='.tmp', dir=os.path.dirname(run_state_filename))
+            with os.fdopen(temp_file, 'w') as f:
+                json.dump(run_state, f, indent=1, sort_keys=True)
+            os.rename(temp_filename, run_state_filename)
+
+def get_image_footprint(header, naxis1, naxis2):
+    """
+    Returns the sky coordinates of the four corners of an image, using only
+    the WCS information in its header.
+
+    Parameters
+    ----------
+    header: FITS file header
+        The header containing the WCS of the image.
+    naxis1: int
+        The number of columns in the image.
+    naxis2: int
+        The number of rows in the image.
+
+    Returns
+    -------
+    footprint: numpy array
+        A (4, 2) array holding the RA and DEC (in degrees) of the image
+        corners.
+    """
+
+    corners = np.array([[0.5, 0.5], [naxis1 + 0.5, 0.5], [naxis1 + 0.5, naxis2 + 0.5], [0.5, naxis2 + 0.5]])
+    return wcs.WCS(header, naxis=2).all_pix2world(corners, 1)
+
+def describe_fits_file(filename, calibrations):
+    """
+    Reads the headers of a FITS file (but not its data) and extracts the
+    information that is recorded in the catalog of input files.
+
+    Parameters
+    ----------
+    filename: string
+        The name of the FITS file.
+    calibrations: dict
+        The calibration of each instrument, as in CALIBRATIONS.
+
+    Returns
+    -------
+    description: tuple
+        The instrument, the wavelength (in microns), the native pixelscale,
+        the image dimensions and the RA and DEC bounds of the image
+        footprint, in the order in which they are stored in the catalog.
+    """
+
+    hdulist = fits.open(filename)
+    # Use the same HDU as the one from which the image data is read in when
+    # processing the file.
+    header, image_hdu = get_input_hdus(hdulist)
+    naxis1 = image_hdu.header['NAXIS1']
+    naxis2 = image_hdu.header['NAXIS2']
+    hdulist.close()
+
+    # get_instrument() exits when the instrument cannot be determined, which
+    # should not stop the rest of the archive from being indexed.
+    try:
+        instrument = get_instrument(header, calibrations)
+        wavelength, wavelength_units = get_wavelength(header, calibrations)
+        wavelength = wavelength_to_microns(wavelength, wavelength_units)
+        pixelscale = get_native_pixelscale(header, instrument, calibrations)
+    except SystemExit:
+        instrument = ''
+        wavelength = 0
+        pixelscale = 0
+
+    footprint = get_image_footprint(header, naxis1, naxis2)
+    ra_values = footprint[:, 0]
+    # Footprints that straddle RA=0 are stored with a negative lower bound.
+    if (ra_values.max() - ra_values.min() > 180):
+        ra_values = np.where(ra_values > 180, ra_values - 360, ra_values)
+
+    return (instrument, float(wavelength), float(pixelscale), naxis1, naxis2,
+            float(ra_values.min()), float(ra_values.max()),
+            float(footprint[:, 1].min()), float(footprint[:, 1].max()))
+
+def get_coverage_fraction(header, naxis1, naxis2, ra, dec, size):
+    """
+    Estimates the fraction of a square target box that is covered by an
+    image, using only the WCS information in the image's header.
+
+    Parameters
+    ----------
+    header: FITS file header
+        The header containing the WCS of the image.
+    naxis1: int
+        The number of columns in the image.
+    naxis2: int
+        The number of rows in the image.
+    ra, dec: float
+        The centre of the target box (in degrees).
+    size: float
+        The angular size of the target box (in arcsec).
+
+    Returns
+    -------
+    coverage: float
+        The fraction (between 0 and 1) of the target box that falls inside
+        the image.
+    """
+
+    # Sample the target box on a regular grid of points in its own tangent
+    # plane and check which of them land inside the image.
+    box = wcs.WCS(naxis=2)
+    box.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    box.wcs.crval = [ra, dec]
+    box.wcs.crpix = [(COVERAGE_SAMPLES + 1) / 2, (COVERAGE_SAMPLES + 1) / 2]
+    sample_spacing = u.arcsec.to(u.deg, size) / COVERAGE_SAMPLES
+    box.wcs.cdelt = [-sample_spacing, sample_spacing]
+    y, x = np.mgrid[1:COVERAGE_SAMPLES + 1, 1:COVERAGE_SAMPLES + 1]
+    world = box.all_pix2world(np.column_stack((x.ravel(), y.ravel())), 1)
+
+    pixels = wcs.WCS(header, naxis=2).all_world2pix(world, 1)
+    inside = ((pixels[:, 0] >= 0.5) & (pixels[:, 0] < naxis1 + 0.5) &
+              (pixels[:, 1] >= 0.5) & (pixels[:, 1] < naxis2 + 0.5))
+    return float(np.mean(inside))
+
+def is_sufficient_coverage(coverage, config):
+    """
+    Checks whether an image covers enough of the target to be processed.
+
+    Parameters
+    ----------
+    coverage: float
+        The fraction of the target box covered by the image, as returned by
+        get_coverage_fraction().
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    Boolean
+        True if the image overlaps the target and covers at least
+        min_coverage of it, False otherwise.
+    """
+
+    return (coverage > 0 and coverage >= config.min_coverage)
+
+def get_target_boxes(filenames, targets, config):
+    """
+    Determines the boxes on the sky against which the coverage of the input
+    images is checked.
+
+    Parameters
+    ----------
+    filenames: list
+        The names of the input FITS files.
+    targets: list
+        A list of (name, ra, dec, angular_size) tuples, as returned by
+        read_targets(), or an empty list if a single target is processed.
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    target_boxes: list
+        A list of (ra, dec, angular_size) tuples. It is empty if the
+        position or size of the target is not known, in which case no
+        images should be skipped.
+    """
+
+    if (targets != []):
+        return [(ra, dec, angular_size) for name, ra, dec, angular_size in targets]
+
+    if (config.phys_size == ''):
+        return []
+
+    if (config.ra_input != '' and config.dec_input != ''):
+        return [(config.ra_input, config.dec_input, config.phys_size)]
+
+    # Only the headers are needed to determine the centre of the target.
+    images_with_headers = []
+    for f in filenames:
+        hdulist = fits.open(get_input_path(f))
+        images_with_headers.append(ImageRecord(None, get_input_hdus(hdulist)[0], f))
+        hdulist.close()
+    lngref_input, latref_input = get_target_center(images_with_headers, config)
+    if (np.isnan(lngref_input) or np.isnan(latref_input)):
+        logger.warning("The centre of the target could not be determined, so the coverage of the images will not be checked.")
+        return []
+    return [(lngref_input, latref_input, config.phys_size)]
+
+def build_catalog(archive_directory, catalog_filename, calibrations):
+    """
+    Scans a directory tree for FITS files and records their instrument,
+    wavelength, native pixelscale and footprint in an SQLite catalog.
+    Files whose modification time has not changed since the last scan are
+    not opened again, and files that have disappeared from the archive are
+    removed from the catalog.
+
+    Parameters
+    ----------
+    archive_directory: string
+        The top directory of the archive.
+    catalog_filename: string
+        The name of the SQLite file holding the catalog. It is created if it
+        does not exist yet.
+    calibrations: dict
+        The calibration of each instrument, as in CALIBRATIONS.
+
+    """
+
+    logger.info("Indexing " + archive_directory + " into " + catalog_filename)
+    connection = sqlite3.connect(catalog_filename)
+    connection.execute("CREATE TABLE IF NOT EXISTS files (filename TEXT PRIMARY KEY, mtime REAL, instrument TEXT, wavelength REAL, pixelscale REAL, naxis1 INTEGER, naxis2 INTEGER, ra_min REAL, ra_max REAL, dec_min REAL, dec_max REAL)")
+    connection.execute("CREATE INDEX IF NOT EXISTS files_wavelength ON files (wavelength)")
+    connection.execute("CREATE INDEX IF NOT EXISTS files_dec ON files (dec_min, dec_max)")
+
+    archive_directory = os.path.abspath(archive_directory)
+    known_mtimes = dict(connection.execute("SELECT filename, mtime FROM files WHERE filename LIKE ?", (archive_directory + '/%',)))
+
+    found_files = set()
+    num_indexed = 0
+    for root, dirnames, filenames in os.walk(archive_directory):
+        for name in fnmatch.filter(filenames, "*.fit*"):
+            if (is_uncertainty_file(name)):
+                continue
+            filename = os.path.join(root, name)
+            found_files.add(filename)
+            mtime = os.path.getmtime(filename)
+            if (known_mtimes.get(filename) == mtime):
+                continue
+            try:
+                description = describe_fits_file(filename, calibrations)
+            except Exception as e:
+                logger.warning("Could not index " + filename + ": " + str(e))
+                continue
+            connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (filename, mtime) + description)
+            num_indexed += 1
+
+    removed_files = [(f,) for f in known_mtimes if f not in found_files]
+    connection.executemany("DELETE FROM files WHERE filename = ?", removed_files)
+    connection.commit()
+    connection.close()
+    logger.info("Indexed " + `num_indexed` + " new or changed files, removed " + `len(removed_files)` + " missing files.")
+
+def select_catalog_files(catalog_filename, instrument='', band=None, ra=None, dec=None, size=None):
+    """
+    Selects input files from an SQLite catalog created by build_catalog().
+
+    Parameters
+    ----------
+    catalog_filename: string
+        The name of the SQLite file holding the catalog.
+    instrument: string
+        If not empty, only files from this instrument are selected.
+    band: tuple
+        If given, only files whose wavelength (in microns) lies between the
+        two values of the tuple are selected.
+    ra, dec: float
+        If given, only files whose footprint overlaps a box of the given
+        angular size (in arcsec) centred on these coordinates (in degrees)
+        are selected.
+    size: float
+        The angular size of the box used with ra and dec.
+
+    Returns
+    -------
+    filenames: list
+        The names of the selected files.
+    """
+
+    query = "SELECT filename, ra_min, ra_max FROM files WHERE 1"
+    parameters = []
+    if (instrument != ''):
+        query += " AND instrument = ?"
+        parameters.append(instrument)
+    if (band is not None):
+        query += " AND wavelength BETWEEN ? AND ?"
+        parameters.extend(band)
+    half_size = 0
+    if (ra is not None and dec is not None):
+        half_size = u.arcsec.to(u.deg, size) / 2
+        query += " AND dec_max >= ? AND dec_min <= ?"
+        parameters.extend((dec - half_size, dec + half_size))
+
+    connection = sqlite3.connect(catalog_filename)
+    rows = connection.execute(query + " ORDER BY filename", parameters).fetchall()
+    connection.close()
+
+    if (ra is None or dec is None):
+        return [row[0] for row in rows]
+
+    # The RA overlap is checked here rather than in SQL, so that footprints
+    # and boxes straddling RA=0 are handled.
+    ra_half_size = min(half_size / max(math.cos(math.radians(dec)), 1e-6), 180)
+    filenames = []
+    for filename, ra_min, ra_max in rows:
+        for offset in (-360, 0, 360):
+            if (ra_max + offset >= ra - ra_half_size and ra_min + offset <= ra + ra_half_size):
+                filenames.append(filename)
+                break
+    return filenames
+
+def output_conversion_factors(images_with_headers, calibrations):
+    """
+    Prints a formatted list of instruments, wavelengths, and conversion
+    factors to Jy/pixel
+
+    Parameters
+    ----------
+    images_with_headers: list of ImageRecord
+        A structure containing headers and image data for all FITS input
+        images.
+    calibrations: dict
+        The calibration of each instrument, as in CALIBRATIONS.
+
+    """
+
+    print("Instrument\tWavelength\tConversion factor (to Jy/pixel)")
+    for i in range(0, len(images_with_headers)):
+        wavelength = images_with_headers[i].header['WAVELENG']
+        wavelength_units = images_with_headers[i].header.comments['WAVELENG']
+        instrument = get_instrument(images_with_headers[i].header, calibrations)
+        conversion_factor = get_conversion_factor(images_with_headers[i].header, instrument, calibrations)
+        print(instrument + '\t' + `wavelength` + '\t' + `conversion_factor`)
+
+def estimate_unit_memory(step, shape, config, kernel_shape=(1, 1), num_images=1):
+    """
+    Estimates the memory needed to process images in one of the steps.
+
+    Parameters
+    ----------
+    step: string
+        Either 'convert' or 'convolve'.
+    shape: tuple
+        The (NAXIS2, NAXIS1) dimensions of the images.
+    config: Config
+        The parameters of the run.
+    kernel_shape: tuple
+        The dimensions of the convolution kernel.
+    num_images: int
+        The number of images processed together, for the batched fft
+        convolution.
+
+    Returns
+    -------
+    memory: int
+        The estimated number of bytes needed.
+    """
+
+    itemsize = np.dtype(config.precision).itemsize
+    pixels = shape[0] * shape[1]
+    if (step == 'convert'):
+        # The input image and the converted image, and their variances.
+        if (config.uncertainties):
+            return 2 * pixels * itemsize + 2 * pixels * 8
+        return 2 * pixels * itemsize
+    if (config.convolution_method == 'fft'):
+        # The input images, the filled images, the valid pixel maps, the
+        # two convolutions and the result, plus the padded images and their
+        # transforms for each of the two convolutions. The variances add an
+        # input, a third convolution and a result.
+        fft_shape = get_fft_shape(shape, kernel_shape)
+        fft_pixels = fft_shape[0] * fft_shape[1]
+        if (config.uncertainties):
+            return num_images * (pixels * (2 * itemsize + 8 * 6 + 1) + 3 * (fft_pixels * 8 + fft_pixels * 16))
+        return num_images * (pixels * (itemsize + 8 * 4 + 1) + 2 * (fft_pixels * 8 + fft_pixels * 16))
+    # The input and output images, and the double precision padded copies
+    # made by convolve(), and twice as much again for the variances.
+    padded_pixels = (shape[0] + kernel_shape[0]) * (shape[1] + kernel_shape[1])
+    if (config.uncertainties):
+        return 4 * pixels * itemsize + 7 * padded_pixels * 8
+    return 2 * pixels * itemsize + 3 * padded_pixels * 8
+
+class MemoryScheduler(object):
+    """
+    Runs tasks in threads so that the sum of their estimated memory stays
+    within a budget. The largest tasks are started first, so that they do
+    not hold up the end of the step, and the smaller ones fill whatever is
+    left of the budget. A task larger than the whole budget is run on its
+    own.
+
+    Parameters
+    ----------
+    budget: int
+        The number of bytes the running tasks may use.
+    max_workers: int
+        The largest number of tasks that run at the same time.
+
+    """
+
+    def __init__(self, budget, max_workers):
+        self.budget = budget
+        self.max_workers = max_workers
+        self.condition = threading.Condition()
+        self.used = 0
+        self.running = 0
+
+    def run(self, tasks):
+        """
+        Runs the tasks, given as (memory, function, arguments) tuples, and
+        returns their results in the same order. If a task fails, no new
+        tasks are started and its exception is raised once the running
+        tasks have finished.
+        """
+
+        results = [None] * len(tasks)
+        errors = []
+        threads = []
+        pending = sorted(range(len(tasks)), key=lambda i: tasks[i][0], reverse=True)
+        while (pending != [] and errors == []):
+            with self.condition:
+                while True:
+                    if (tasks[pending[0]][0] > self.budget):
+                        # Wait for the running tasks to finish, rather than
+                        # starting smaller tasks ahead of this one.
+                        fitting = pending[:1] if self.running == 0 else []
+                    else:
+                        fitting = [i for i in pending if self.used + tasks[i][0] <= self.budget]
+                    if (fitting != [] and self.running < self.max_workers):
+                        break
+                    self.condition.wait()
+                i = fitting[0]
+                pending.remove(i)
+                self.used += tasks[i][0]
+                self.running += 1
+            thread = threading.Thread(target=self.run_task, args=(i, tasks[i], results, errors))
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+        if (errors != []):
+            exc_info = errors[0]
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return results
+
+    def run_task(self, i, task, results, errors):
+        memory, function, arguments = task
+        try:
+            results[i] = function(*arguments)
+        except BaseException:
+            errors.append(sys.exc_info())
+        finally:
+            with self.condition:
+                self.used -= memory
+                self.running -= 1
+                self.condition.notify_all()
+
+def run_scheduled(tasks, config):
+    """
+    Runs the tasks of a step, either one after the other or, with the
+    max_memory parameter, with a MemoryScheduler.
+
+    Parameters
+    ----------
+    tasks: list
+        A list of (memory, function, arguments) tuples, where memory is the
+        estimated number of bytes needed to call function(*arguments).
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    results: list
+        The return values of the tasks, in the same order as the tasks.
+    """
+
+    if (config.max_memory == 0):
+        return [function(*arguments) for memory, function, arguments in tasks]
+    logger.info("Running " + `len(tasks)` + " tasks within " + `config.max_memory` + " MB")
+    scheduler = MemoryScheduler(int(config.max_memory * 1024 * 1024), multiprocessing.cpu_count())
+    return scheduler.run(tasks)
+
+def clipped_tile_medians(tiles):
+    """
+    Returns the sigma clipped median of each of a number of tiles (see
+    BACKGROUND_SIGMA and BACKGROUND_ITERATIONS), all of them being clipped
+    at the same time.
+
+    Parameters
+    ----------
+    tiles: numpy array
+        The pixels of each tile, as (tile, pixel); NaN pixels are skipped.
+
+    Returns
+    -------
+    medians: numpy array
+        The clipped median of each tile, or NaN for the tiles of which less
+        than half of the pixels are valid.
+    """
+
+    medians = np.zeros(tiles.shape[0]) * np.nan
+    valid_tiles = (np.isfinite(tiles).sum(axis=1) >= tiles.shape[1] / 2)
+    values = np.array(tiles[valid_tiles], dtype=np.float64)
+    if (values.shape[0] == 0):
+        return medians
+    for i in range(0, BACKGROUND_ITERATIONS):
+        median = np.nanmedian(values, axis=1)
+        deviation = np.nanstd(values, axis=1)
+        # NaN pixels compare as False, so they are never counted as clipped.
+        with np.errstate(invalid='ignore'):
+            clipped = (np.abs(values - median[:, np.newaxis]) > BACKGROUND_SIGMA * deviation[:, np.newaxis])
+        if (not clipped.any()):
+            break
+        values[clipped] = np.nan
+    medians[valid_tiles] = np.nanmedian(values, axis=1)
+    return medians
+
+def estimate_tile_row(image, y, tile):
+    """
+    Estimates the background of the tiles of one row of tiles of an image,
+    reading only its rows from the (possibly memory-mapped) image.
+
+    Parameters
+    ----------
+    image: numpy array
+        The image.
+    y: int
+        The first row of the tiles.
+    tile: int
+        The size of the tiles, in pixels.
+
+    Returns
+    -------
+    medians: numpy array
+        The background of each tile, as returned by clipped_tile_medians().
+    """
+
+    rows = np.asarray(image[y:y + tile], dtype=np.float64)
+    num_tiles = int(math.ceil(image.shape[1] / tile))
+    # The last row and column of tiles are padded with NaN.
+    padded = np.empty((tile, num_tiles * tile))
+    padded.fill(np.nan)
+    padded[:rows.shape[0], :rows.shape[1]] = rows
+    tiles = padded.reshape(tile, num_tiles, tile).transpose(1, 0, 2).reshape(num_tiles, tile * tile)
+    return clipped_tile_medians(tiles)
+
+def estimate_background(image, tile):
+    """
+    Estimates the background of an image on a mesh of tiles: the sigma
+    clipped median of each tile (the rows of tiles being processed in
+    parallel), tiles with too few valid pixels taking the value of the
+    nearest valid tile, and a 3x3 median filter over the tiles to remove
+    those raised by bright sources.
+
+    Parameters
+    ----------
+    image: numpy array
+        The image.
+    tile: int
+        The size of the tiles, in pixels.
+
+    Returns
+    -------
+    mesh: numpy array
+        The background of each tile, or None if no tile has enough valid
+        pixels.
+    """
+
+    tasks = [(0, estimate_tile_row, (image, y, tile)) for y in range(0, image.shape[0], tile)]
+    mesh = np.array(MemoryScheduler(1, multiprocessing.cpu_count()).run(tasks))
+    invalid = np.isnan(mesh)
+    if (invalid.all()):
+        return None
+    if (invalid.any()):
+        nearest = ndimage.distance_transform_edt(invalid, return_distances=False, return_indices=True)
+        mesh = mesh[tuple(nearest)]
+    return ndimage.median_filter(mesh, size=3, mode='nearest')
+
+def subtract_background(data, header, filename, config):
+    """
+    Estimates the background of an image with estimate_background() on
+    tiles of background_tile pixels, and subtracts it in place, interpolated
+    between the centres of the tiles with a bicubic spline, one row of tiles
+    at a time. The tile size and the mean background are recorded in the
+    BACKTILE and BACKMEAN keywords of the header.
+
+    Parameters
+    ----------
+    data: numpy array
+        The image, with one or more planes; it must be writeable.
+    header: FITS file header
+        The header of the image.
+    filename: string
+        The name of the image, for the messages.
+    config: Config
+        The parameters of the run.
+
+    """
+
+    tile = config.background_tile
+    background_means = []
+    for plane in data.reshape((-1,) + data.shape[-2:]):
+        mesh = estimate_background(plane, tile)
+        if (mesh is None):
+            logger.warning("The background of " + filename + " could not be estimated, as no tile has enough valid pixels; it is not subtracted.")
+            continue
+        coefficients = ndimage.spline_filter(mesh, order=3)
+        # The centre of tile i is at pixel (i + 0.5) * tile - 0.5.
+        x = (np.arange(plane.shape[1]) + 0.5) / tile - 0.5
+        for y in range(0, plane.shape[0], tile):
+            rows = plane[y:y + tile]
+            yy, xx = np.meshgrid((np.arange(y, y + rows.shape[0]) + 0.5) / tile - 0.5, x, indexing='ij')
+            background = ndimage.map_coordinates(coefficients, [yy, xx], order=3, mode='nearest', prefilter=False)
+            rows -= background
+        background_means.append(mesh.mean())
+    if (background_means != []):
+        header['BACKTILE'] = (tile, 'Tile size (pixels) of the subtracted background')
+        header['BACKMEAN'] = (float(np.mean(background_means)), 'Mean subtracted background (Jy/pixel)')
+
+def get_conversion_inputs(image, uncertainty_input):
+    """
+    Returns the files read by the conversion of an input image: its input
+    file and the file holding its uncertainty image, if any. Images given
+    without an input file (e.g. built in memory) have none.
+    """
+
+    input_filenames = []
+    for filename in [image.path] + ([uncertainty_input[0]] if uncertainty_input is not None else []):
+        if (filename is not None and filename not in input_filenames):
+            input_filenames.append(filename)
+    return input_filenames
+
+def convert_image(image, converted_filename, conversion_factor, run_state, config, uncertainty_input=None):
+    """
+    Converts a single image to Jy/pixel and saves it as a new FITS file,
+    along with its variance if it has an uncertainty image. The image data
+    is converted in place, so that the input record holds the converted
+    data without another copy being made.
+
+    Parameters
+    ----------
+    image: ImageRecord
+        The input image, whose header already holds the new BUNIT.
+    converted_filename: string
+        The name of the FITS file to write.
+    conversion_factor: float
+        The factor that converts the image to Jy/pixel.
+    run_state: dict
+        The completed units, as returned by load_run_state().
+    config: Config
+        The parameters of the run.
+    uncertainty_input: tuple
+        The uncertainty image, as returned by find_uncertainty_input(), or
+        None.
+
+    Returns
+    -------
+    converted_image: ImageRecord
+        The converted image, whose data is read from the converted FITS file
+        when it is first used.
+    """
+
+    start = time.time()
+    converted_data_array = as_precision(image.data, config)
+    # Integer images need a floating point copy, as does data that is still
+    # mapped read-only from the input file.
+    if (not np.issubdtype(converted_data_array.dtype, np.floating)):
+        converted_data_array = converted_data_array.astype(np.float64)
+    elif (not converted_data_array.flags.writeable):
+        converted_data_array = np.array(converted_data_array)
+    converted_data_array *= conversion_factor
+    if (config.background_tile > 0):
+        subtract_background(converted_data_array, image.header, image.filename, config)
+    logger.debug("Creating " + converted_filename)
+    write_fits(converted_filename, converted_data_array, image.header, config)
+    output_filenames = [converted_filename]
+    if (uncertainty_input is not None):
+        variance = read_uncertainty_input(uncertainty_input)
+        if (variance.shape != converted_data_array.shape):
+            logger.error("Error: The uncertainty image " + uncertainty_input[0] + " does not have the dimensions of " + image.filename)
+            sys.exit()
+        output_filenames.append(get_variance_filename(converted_filename))
+        write_fits(output_filenames[1], as_precision(variance * conversion_factor**2, config), image.header, config)
+    mark_unit_complete(run_state, "convert:" + image.filename, get_conversion_inputs(image, uncertainty_input), output_filenames, (conversion_factor, config.background_tile), config)
+    log_image_end(config, 'convert', image.filename, start, output_filenames)
+    return image.with_path(converted_filename)
+
+def convert_images(images_with_headers, config):
+    """
+    Converts all of the input images' native "flux units" to Jy/pixel
+    The converted values are returned as new image records, and they are
+    also saved as new FITS images.
+
+    Parameters
+    ----------
+    images_with_headers: list of ImageRecord
+        A structure containing headers and image data for all FITS input
+        images.
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    converted_images: list of ImageRecord
+        The converted images. Their image data is read from the converted
+        FITS files when it is first used.
+    """
+
+    stage_start = time.time()
+    log_event(config, 'start', 'convert', message="Converting images", images=len(images_with_headers))
+    run_state = load_run_state(config)
+    converted_images = [None] * len(images_with_headers)
+    tasks = []
+    task_indices = []
+    for i in range(0, len(images_with_headers)):
+        instrument = get_instrument(images_with_headers[i].header, config.calibrations)
+        conversion_factor = get_conversion_factor(images_with_headers[i].header, instrument, config.calibrations)
+
+        # Some manipulation of filenames and directories
+        original_filename = os.path.basename(images_with_headers[i].filename)
+        original_directory = os.path.dirname(images_with_headers[i].filename)
+        new_directory = original_directory + "/converted/"
+        converted_filename = new_directory + original_filename  + "_converted.fits"
+        if not os.path.exists(new_directory):
+            os.makedirs(new_directory)
+
+        images_with_headers[i].header['BUNIT'] = 'Jy/pixel'
+        images_with_headers[i].header['JYPXFACT'] = (conversion_factor, 'Factor to convert original BUNIT into Jy/pixel.')
+
+        uncertainty_input = None
+        output_filenames = [converted_filename]
+        if (config.uncertainties):
+            uncertainty_input = find_uncertainty_input(images_with_headers[i].filename)
+            if (uncertainty_input is None):
+                logger.warning("No uncertainty image was found for " + images_with_headers[i].filename)
+            else:
+                output_filenames.append(get_variance_filename(converted_filename))
+
+        unit = "convert:" + images_with_headers[i].filename
+        if (is_unit_complete(run_state, unit, get_conversion_inputs(images_with_headers[i], uncertainty_input), output_filenames, (conversion_factor, config.background_tile), config)):
+            converted_images[i] = images_with_headers[i].with_path(converted_filename)
+            continue
+
+        # Do a Jy/pixel unit conversion and save it as a new .fits file
+        memory = estimate_unit_memory('convert', images_with_headers[i].shape[-2:], config)
+        tasks.append((memory, convert_image, (images_with_headers[i], converted_filename, conversion_factor, run_state, config, uncertainty_input)))
+        task_indices.append(i)
+
+    for i, converted_image in zip(task_indices, run_scheduled(tasks, config)):
+        converted_images[i] = converted_image
+
+    log_event(config, 'end', 'convert', images=len(images_with_headers), duration=time.time() - stage_start)
+    return converted_images
+
+def get_target_center(images_with_headers, config):
+    """
+    Returns the RA and DEC to which the images will be registered. These
+    are the values given on the command line if present, and otherwise the
+    mean of the reference coordinates of the Herschel images.
+
+    Parameters
+    ----------
+    images_with_headers: list of ImageRecord
+        A structure containing headers and image data for all FITS input
+        images.
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    lngref_input: float
+        The RA (in degrees) of the centre of the target.
+    latref_input: float
+        The DEC (in degrees) of the centre of the target.
+    """
+
+    if (config.ra_input != ''):
+        lngref_input = config.ra_input
+    else:
+        lngref_input = get_herschel_mean(images_with_headers, 'CRVAL1', config.calibrations)
+
+    if (config.dec_input != ''):
+        latref_input = config.dec_input
+    else:
+        latref_input = get_herschel_mean(images_with_headers, 'CRVAL2', config.calibrations)
+
+    return lngref_input, latref_input
+
+def get_herschel_mean(images_with_headers, keyword, calibrations):
+    """
+    Checks all of the FITS images with data from Herschel instruments
+    (currently PACS and SPIRE) and returns the mean value of the given
+    FITS header keyword from all the relevant images.
+
+    Parameters
+    ----------
+    images_with_headers: list of ImageRecord
+        A structure containing headers and image data for all FITS input
+        images.
+    keyword: string
+        The header keyword for which the mean value will be calculated.
+    calibrations: dict
+        The calibration of each instrument, as in CALIBRATIONS.
+
+    Returns
+    -------
+    return_value: float
+        The mean of the values of the given header keyword for all images
+        with data from Herschel instruments.
+    """
+
+    logger.debug("get_herschel_mean(" + keyword + ")")
+    values = []
+    return_value = 0
+    for i in range(0, len(images_with_headers)):
+        instrument = get_instrument(images_with_headers[i].header, calibrations)
+        if (instrument == 'PACS' or instrument == 'SPIRE'):
+            value = images_with_headers[i].header[keyword]
+            values.append(value)
+    return_value = np.mean(values)
+    return return_value
+
+# NOTETOSELF: try to do this from the converted_data array first.
+# If that fails, then we can always just read in the _converted.fits files that were
+# also created by convert_images().
+# NOTETOSELF: Sophia told me that we need the single RA/dec value that gets used
+# later (in the resampling step, I believe) in this step as well.
+def make_grid_header(size, pixelscale, lngref, latref):
+    """
+    Returns the header of the grid an image is registered or resampled to.
+    This is the same grid as the artificial image created with mkpattern
+    and ccsetwcs in register_images() and resample_images().
+
+    Parameters
+    ----------
+    size: float
+        The number of pixels along each side of the grid.
+    pixelscale: float
+        The pixelscale (in arcsec) of the grid.
+    lngref, latref: float
+        The RA and DEC (in degrees) of the centre of the grid.
+
+    Returns
+    -------
+    header: FITS file header
+        The header describing the grid.
+    """
+
+    header = fits.Header()
+    header['NAXIS'] = 2
+    header['NAXIS1'] = int(size)
+    header['NAXIS2'] = int(size)
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRVAL1'] = lngref
+    header['CRVAL2'] = latref
+    header['CRPIX1'] = size / 2
+    header['CRPIX2'] = size / 2
+    header['CDELT1'] = -pixelscale / 3600
+    header['CDELT2'] = pixelscale / 3600
+    header['CUNIT1'] = 'deg'
+    header['CUNIT2'] = 'deg'
+    header['RADESYS'] = 'FK5'
+    header['EQUINOX'] = 2000.
+    return header
+
+def reproject_image(data, header, grid_header, flux_conserve=False, variance=None):
+    """
+    Reprojects an image onto a new grid with a bilinear interpolation. This
+    is the native equivalent of the IRAF wregister task. The variance of the
+    image can be reprojected along with it, with the same interpolation
+    weights.
+
+    Parameters
+    ----------
+    data: numpy array
+        The image data.
+    header: FITS file header
+        The header of the image, holding its WCS.
+    grid_header: FITS file header
+        The header of the new grid, as returned by make_grid_header().
+    flux_conserve: boolean
+        If True, the values are scaled by the ratio of the pixel areas of
+        the grid and of the image, so that the total flux is conserved.
+    variance: numpy array
+        The variance of the image, or None.
+
+    Returns
+    -------
+    reprojected_data: numpy array
+        The reprojected image. Pixels that fall outside of the input image
+        are NaN.
+    reprojected_header: FITS file header
+        The header of the input image, with its WCS replaced by that of the
+        grid.
+    reprojected_variance: numpy array
+        The reprojected variance; only returned if variance is given.
+    """
+
+    image_wcs = wcs.WCS(header, naxis=2)
+    grid_wcs = wcs.WCS(grid_header)
+    y, x = np.mgrid[0:grid_header['NAXIS2'], 0:grid_header['NAXIS1']]
+    ra, dec = grid_wcs.wcs_pix2world(x.ravel(), y.ravel(), 0)
+    image_x, image_y = image_wcs.wcs_world2pix(ra, dec, 0)
+    del x, y, ra, dec
+    reprojected_data = ndimage.map_coordinates(np.asarray(data, dtype=np.float64), [image_y, image_x], order=1, mode='constant', cval=np.nan)
+    reprojected_data = reprojected_data.reshape(grid_header['NAXIS2'], grid_header['NAXIS1'])
+    if (flux_conserve):
+        scale = abs(np.linalg.det(grid_wcs.pixel_scale_matrix) / np.linalg.det(image_wcs.pixel_scale_matrix))
+    else:
+        scale = 1.
+    reprojected_data *= scale
+
+    if (variance is not None):
+        # The interpolated value is a weighted sum of the four neighbouring
+        # pixels, so its variance is their variances weighted by the squares
+        # of the same weights.
+        variance = np.asarray(variance, dtype=np.float64)
+        image_y = np.where(np.isfinite(image_y), image_y, -1)
+        image_x = np.where(np.isfinite(image_x), image_x, -1)
+        y0 = np.floor(image_y)
+        x0 = np.floor(image_x)
+        reprojected_variance = np.zeros(len(image_y))
+        for dy, weight_y in ((0, 1 - (image_y - y0)), (1, image_y - y0)):
+            for dx, weight_x in ((0, 1 - (image_x - x0)), (1, image_x - x0)):
+                pixel_y = np.clip(y0 + dy, 0, variance.shape[0] - 1).astype(int)
+                pixel_x = np.clip(x0 + dx, 0, variance.shape[1] - 1).astype(int)
+                reprojected_variance += (weight_y * weight_x)**2 * variance[pixel_y, pixel_x]
+        reprojected_variance = reprojected_variance.reshape(reprojected_data.shape) * scale**2
+        reprojected_variance[np.isnan(reprojected_data)] = np.nan
+
+    reprojected_header = header.copy()
+    for keyword in ('CD1_1', 'CD1_2', 'CD2_1', 'CD2_2', 'PC1_1', 'PC1_2', 'PC2_1', 'PC2_2', 'CROTA1', 'CROTA2'):
+        if (keyword in reprojected_header):
+            del reprojected_header[keyword]
+    for keyword in grid_header:
+        if (not keyword.startswith('NAXIS')):
+            reprojected_header[keyword] = grid_header[keyword]
+    if (variance is not None):
+        return reprojected_data, reprojected_header, reprojected_variance
+    return reprojected_data, reprojected_header
+
+def register_images(images_with_headers, config):
+    """
+    Registers all of the images to a common WCS
+
+    Parameters
+    ----------
+    images_with_headers: list of ImageRecord
+        A structure containing headers and image data for all FITS input
+        images.
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    registered_images: list of ImageRecord
+        The registered images. Their image data is read from the registered
+        FITS files when it is first used.
+    """
+
+    stage_start = time.time()
+    log_event(config, 'start', 'register', message="Registering images", images=len(images_with_headers))
+    logger.debug("phys_size: " + `config.phys_size`)
+    phys_size = config.phys_size
+
+    lngref_input, latref_input = get_target_center(images_with_headers, config)
+
+    run_state = load_run_state(config)
+    registered_images = []
+    for i in range(0, len(images_with_headers)):
+        start = time.time()
+
+        native_pixelscale = get_native_pixelscale(images_with_headers[i].header, get_instrument(images_with_headers[i].header, config.calibrations), config.calibrations)
+        logger.debug("Native pixel scale: " + `native_pixelscale`)
+        logger.debug("Instrument: " + `get_instrument(images_with_headers[i].header, config.calibrations)`)
+        logger.debug("BUNIT: " + `images_with_headers[i].header.get('BUNIT')`)
+
+        original_filename = os.path.basename(images_with_headers[i].filename)
+        original_directory = os.path.dirname(images_with_headers[i].filename)
+        new_directory = get_target_directory(original_directory, config) + "/registered/"
+        artificial_filename = new_directory + original_filename + "_pixelgrid.fits"
+        registered_filename = new_directory + original_filename  + "_registered.fits"
+        input_directory = original_directory + "/converted/"
+        input_filename = input_directory + original_filename  + "_converted.fits"
+        logger.debug("Artificial filename: " + artificial_filename)
+        logger.debug("Registered filename: " + registered_filename)
+        logger.debug("Input filename: " + input_filename)
+        if not os.path.exists(new_directory):
+            os.makedirs(new_directory)
+
+        unit = "register:" + images_with_headers[i].filename
+        settings = (phys_size, lngref_input, latref_input, config.backend)
+        variance_inputs, variance_outputs = get_variance_files(input_filename, registered_filename, config)
+        if (config.backend == 'native'):
+            output_filenames = [registered_filename] + variance_outputs
+        else:
+            output_filenames = [artificial_filename, registered_filename]
+        if (is_unit_complete(run_state, unit, [input_filename] + variance_inputs, output_filenames, settings, config)):
+            registered_images.append(images_with_headers[i].with_path(registered_filename))
+            continue
+
+        if (config.backend == 'native'):
+            grid_header = make_grid_header(phys_size/native_pixelscale, native_pixelscale, lngref_input, latref_input)
+            image_data, header = read_fits(input_filename)
+            if (variance_inputs != []):
+                registered_data, registered_header, registered_variance = reproject_image(image_data, header, grid_header, variance=read_fits(variance_inputs[0])[0])
+                write_fits(variance_outputs[0], as_precision(registered_variance, config), registered_header, config)
+            else:
+                registered_data, registered_header = reproject_image(image_data, header, grid_header)
+            logger.debug("Creating " + registered_filename)
+            write_fits(registered_filename, as_precision(registered_data, config), registered_header, config)
+            mark_unit_complete(run_state, unit, [input_filename] + variance_inputs, output_filenames, settings, config)
+            log_image_end(config, 'register', images_with_headers[i].filename, start, output_filenames)
+            registered_images.append(images_with_headers[i].with_path(registered_filename))
+            continue
+
+        iraf_input_filename = get_iraf_input(input_filename)
+
+        with iraf_lock:
+            # First we create an artificial fits image
+            # unlearn some iraf tasks
+            iraf.unlearn('mkpattern')
+
+            # create an artificial image to which we will register the FITS image.
+            artdata.mkpattern(input=artificial_filename, output=artificial_filename, pattern="constant", pixtype=IRAF_PIXEL_TYPES[config.precision], ndim=2, ncols=phys_size/native_pixelscale, nlines=phys_size/native_pixelscale)
+            #note that in the exact above line, the "ncols" and "nlines" should be wisely chosen, depending on the input images - they provide the pixel-grid 
+            #for each input fits image, we will create the corresponding artificial one - therefore we can tune these values such that we cover, for instance, XXarcsecs of the target - so the best is that user provides us with such a value
+
+            # Then, we tag the desired WCS in this fake image:
+            # unlearn some iraf tasks
+            iraf.unlearn('ccsetwcs')
+
+            # tag the desired WCS in the artificial image.
+            iraf.ccsetwcs(images=artificial_filename, database="", solution="", xref=(phys_size/native_pixelscale)/2, yref=(phys_size/native_pixelscale)/2, xmag=native_pixelscale, ymag=native_pixelscale, xrotati=0.,yrotati=0.,lngref=lngref_input, latref=latref_input, lngunit="degrees", latunit="degrees", transpo="no", project="tan", coosyst="j2000", update="yes", pixsyst="logical", verbose=get_iraf_verbose())
+            #note that the "xref" and "yref" are actually half the above "ncols", "nlines", respectively, so that we center each image
+            #note also that "xmag" and "ymag" is the pixel-scale, which in the current step ought to be the same as the native pixel-scale of the input image, for each input image - so we check the corresponding header value in each image
+            #note that "lngref" and "latref" can be grabbed by the fits header, it is actually the center of the target (e.g. ngc1569)
+            #note that we should make sure that the coordinate system is in coosyst="j2000" by checking the header info, otherwise we need to adjust that
+
+            # Then, register the fits file of interest to the WCS of the fake fits file
+            # unlearn some iraf tasks
+            iraf.unlearn('wregister')
+
+            # register the science fits image
+            iraf.wregister(input=iraf_input_filename, reference=artificial_filename, output=registered_filename, fluxconserve="no")
+
+        if (iraf_input_filename != input_filename):
+            os.remove(iraf_input_filename)
+        compress_fits(registered_filename, config)
+        mark_unit_complete(run_state, unit, [input_filename], output_filenames, settings, config)
+        log_image_end(config, 'register', images_with_headers[i].filename, start, output_filenames)
+
+        registered_images.append(images_with_headers[i].with_path(registered_filename))
+
+    log_event(config, 'end', 'register', images=len(images_with_headers), duration=time.time() - stage_start)
+    return registered_images
+
+# NOTETOSELF: This function requires a PSF kernel. Not sure where it should go, but
+# here it is just in case we still need it. It is NOT ready to be run yet.
+def convolve_images_psf(images_with_headers):
+    logger.info("Convolving images (not implemented yet)")
+
+    for i in range(0, len(images_with_headers)):
+
+        original_filename = os.path.basename(images_with_headers[i].filename)
+        original_directory = os.path.dirname(images_with_headers[i].filename)
+        new_directory = original_directory + "/convolved/"
+        #artificial_filename = new_directory + original_filename + "_pixelgrid.fits"
+        #registered_filename = new_directory + original_filename  + "_registered.fits"
+        input_directory = original_directory + "/registered/"
+        input_filename = input_directory + original_filename  + "_registered.fits"
+        logger.debug("Artificial filename: " + artificial_filename)
+        logger.debug("Registered filename: " + registered_filename)
+        logger.debug("Input filename: " + input_filename)
+        if not os.path.exists(new_directory):
+            os.makedirs(new_directory)
+
+        #reading the science image:
+        science_image = fits.getdata(input_filename)
+
+        # if using a kernel image, then we first regrid the kernel to the same as in the science image, and we re-center the kernel:
+
+        # create a fake image "apixel_kernel.fits"
+        # the original kernel has a grid of 3645*3645 pixels and centered at (1822, 1822)
+        # ncols = nlines = initial_number_of_rows * initial_pixelsize_of_the_kernel  / science_image_pixelsize
+        # in the current case: 3645* 0.25 (arcsecs per pixel) / 2 (arcsecs per pixel) = 455.62
+        artdata.mkpattern(input="apixel_kernel.fits", output="apixel_kernel.fits", pattern="constant", option="replace",v1=0., v2=1., size=1, title="", pixtype="real", ndim=2, ncols=455,nlines=455,n3=1, n4=1, n5=1, n6=1, n7=1, header="")
+
+        #Then, tag the desired WCS in this fake image:
+        #
+        # unlearn some iraf tasks
+        iraf.unlearn('ccsetwcs')
+        #xref = yref = ncols/2 = nlines/2
+        #xmag, ymag = pixel scale of science image
+        iraf.ccsetwcs(images="apixel_kernel.fits", database="", solution="", xref=227.5, yref=227.5, xmag=2, ymag=2, xrotati=0.,yrotati=0.,lngref=0, latref=0, lngunit="hours", latunit="degrees", transpo="no", project="tan", coosyst="j2000", update="yes", pixsyst="logical", verbose=get_iraf_verbose())
+
+        # Then, register the fits file of interest to the WCS of the fake fits file
+        #
+        # unlearn some iraf tasks
+        iraf.unlearn('wregister')
+
+        iraf.wregister(input="Kernel_HiRes_PACS_70_to_SPIRE_500.fits", reference="apixel_kernel.fits", output="Kernel_P70_2_S500.fits", fluxconserve="yes")
+
+        # then we get the data from the kernel
+        kernel_image = pyfits.getdata('Kernel_P70_2_S500.fits')
+
+        #several ways to do the convolution, but is best to use number 3 or 4:
+
+        #3. 
+        result3 = astropy.nddata.convolution.convolve.convolve(science_image, kernel_image) # got a segmentation fault - it needs an odd number of columns/rows for the kernel
+        pyfits.writeto('science_image_convolved_3.fits',result3)
+
+        #4. 
+        result4 = normalized_convolve(science_image, kernel_image) # FFT convolution, ignoring the NaN pixels
+        pyfits.writeto('science_image_convolved_4.fits',result4) 
+
+def get_fft_size(n):
+    """
+    Returns the smallest FFT length of at least n whose only prime factors
+    are 2, 3 and 5, for which FFTs are fast.
+
+    Parameters
+    ----------
+    n: int
+        The minimum length.
+
+    Returns
+    -------
+    size: int
+        The FFT length.
+    """
+
+    size = n
+    while True:
+        m = size
+        for factor in (2, 3, 5):
+            while (m % factor == 0):
+                m //= factor
+        if (m == 1):
+            return size
+        size += 1
+
+def get_fft_shape(image_shape, kernel_shape):
+    """
+    Returns the shape of the zero-padded arrays used to convolve an image
+    with a kernel through FFTs without wrapping around the image edges.
+
+    Parameters
+    ----------
+    image_shape: tuple
+        The shape of the image.
+    kernel_shape: tuple
+        The shape of the kernel.
+
+    Returns
+    -------
+    fft_shape: tuple
+        The shape of the padded arrays.
+    """
+
+    return tuple(get_fft_size(n + k - 1) for n, k in zip(image_shape, kernel_shape))
+
+def fft_convolve_same(image, kernel_fft, fft_shape, kernel_shape):
+    """
+    Convolves an image (or a stack of images along the last two axes) with
+    a kernel whose FFT has already been computed, and returns the part of
+    the result that lines up with the image.
+
+    Parameters
+    ----------
+    image: numpy array
+        The image, or a stack of images.
+    kernel_fft: numpy array
+        The real FFT of the kernel, computed with the shape fft_shape.
+    fft_shape: tuple
+        The shape of the padded arrays, as returned by get_fft_shape().
+    kernel_shape: tuple
+        The shape of the kernel.
+
+    Returns
+    -------
+    result: numpy array
+        The convolved image, with the same shape as image.
+    """
+
+    image_fft = np.fft.rfft2(image, fft_shape)
+    image_fft *= kernel_fft
+    result = np.fft.irfft2(image_fft, fft_shape)
+    y0 = (kernel_shape[0] - 1) // 2
+    x0 = (kernel_shape[1] - 1) // 2
+    return result[..., y0:y0 + image.shape[-2], x0:x0 + image.shape[-1]]
+
+def normalized_convolve(image, kernel, min_coverage=0):
+    """
+    Convolves an image containing NaN pixels with a kernel using FFTs. The
+    NaN pixels are ignored: the image with its NaN pixels set to 0 and the
+    map of valid pixels are both convolved with the kernel, and the first
+    result is divided by the second. Away from the borders of the image,
+    this is the same as the direct convolution with NaN interpolation.
+
+    Parameters
+    ----------
+    image: numpy array
+        The image to convolve.
+    kernel: numpy array
+        The convolution kernel.
+    min_coverage: float
+        Pixels for which less than this fraction of the kernel weight falls
+        on valid pixels of the image are set to NaN.
+
+    Returns
+    -------
+    result: numpy array
+        The convolved image, in double precision.
+    """
+
+    return batched_normalized_convolve(image[np.newaxis], [kernel], min_coverage)[0]
+
+def batched_normalized_convolve(image_stack, kernels, min_coverage=0, variance_stack=None):
+    """
+    Convolves a stack of images that share the same pixel grid, each with
+    its own kernel, in the same way as normalized_convolve(). The FFTs of
+    the whole stack are computed at once, which is faster than convolving
+    the images one at a time.
+
+    The variances of the images can be propagated in the same pass: the
+    variance of a convolved pixel is the convolution of the variances with
+    the square of the kernel, divided by the square of the same weight map.
+
+    Parameters
+    ----------
+    image_stack: numpy array
+        The images to convolve, stacked along the first axis.
+    kernels: list
+        The convolution kernel of each image. Kernels of different sizes
+        are padded to a common size.
+    min_coverage: float
+        Pixels for which less than this fraction of the kernel weight falls
+        on valid pixels of the image are set to NaN.
+    variance_stack: numpy array
+        The variances of the images, or None.
+
+    Returns
+    -------
+    result: numpy array
+        The convolved images, in double precision.
+    variance: numpy array
+        The variances of the convolved images; only returned if
+        variance_stack is given.
+    """
+
+    # Pad the kernels symmetrically to a common (odd) shape so that they
+    # stay centred.
+    kernel_shape = (max(k.shape[0] for k in kernels), max(k.shape[1] for k in kernels))
+    padded_kernels = np.zeros((len(kernels),) + kernel_shape)
+    for i in range(0, len(kernels)):
+        dy = (kernel_shape[0] - kernels[i].shape[0]) // 2
+        dx = (kernel_shape[1] - kernels[i].shape[1]) // 2
+        padded_kernels[i, dy:dy + kernels[i].shape[0], dx:dx + kernels[i].shape[1]] = kernels[i]
+
+    fft_shape = get_fft_shape(image_stack.shape[-2:], kernel_shape)
+    kernel_ffts = np.fft.rfft2(padded_kernels, fft_shape)
+    kernel_sums = padded_kernels.sum(axis=(1, 2))[:, np.newaxis, np.newaxis]
+
+    weights = np.isfinite(image_stack)
+    filled = np.where(weights, image_stack, 0).astype(np.float64)
+    convolved = fft_convolve_same(filled, kernel_ffts, fft_shape, kernel_shape)
+    del filled
+    if (variance_stack is not None):
+        filled = np.where(weights & np.isfinite(variance_stack), variance_stack, 0).astype(np.float64)
+        convolved_variance = fft_convolve_same(filled, np.fft.rfft2(padded_kernels**2, fft_shape), fft_shape, kernel_shape)
+        del filled
+    weight = fft_convolve_same(weights.astype(np.float64), kernel_ffts, fft_shape, kernel_shape)
+    del weights
+
+    valid = weight > max(min_coverage, NORMALIZED_CONVOLUTION_EPSILON) * kernel_sums
+    result = np.empty(image_stack.shape)
+    result.fill(np.nan)
+    result[valid] = convolved[valid] / weight[valid]
+    if (variance_stack is not None):
+        variance = np.empty(image_stack.shape)
+        variance.fill(np.nan)
+        variance[valid] = convolved_variance[valid] / weight[valid]**2
+        return result, variance
+    return result
+
+def convolve_variance(image, variance, kernel):
+    """
+    Propagates the variance of an image through the direct convolution of
+    the image with a kernel, which ignores the NaN pixels of the image.
+
+    Parameters
+    ----------
+    image: numpy array
+        The image that is convolved.
+    variance: numpy array
+        The variance of the image.
+    kernel: numpy array
+        The convolution kernel.
+
+    Returns
+    -------
+    convolved_variance: numpy array
+        The variance of the convolved image, in double precision.
+    """
+
+    valid = np.isfinite(image)
+    filled = np.where(valid & np.isfinite(variance), variance, 0).astype(np.float64)
+    weight = convolve(valid.astype(np.float64), kernel, normalize_kernel=False)
+    convolved = convolve(filled, kernel**2, normalize_kernel=False)
+    covered = weight > NORMALIZED_CONVOLUTION_EPSILON * kernel.sum()
+    convolved_variance = np.empty(image.shape)
+    convolved_variance.fill(np.nan)
+    convolved_variance[covered] = convolved[covered] / weight[covered]**2
+    return convolved_variance
+
+def write_convolved_image(image, conv_result, header, convolved_filename, fwhm_input, config):
+    """
+    Saves the result of the convolution of an image as a new FITS file.
+
+    Parameters
+    ----------
+    image: ImageRecord
+        The input image that was convolved.
+    conv_result: numpy array
+        The convolved image data.
+    header: FITS file header
+        The header of the registered image that was convolved.
+    convolved_filename: string
+        The name of the FITS file to write.
+    fwhm_input: float
+        The FWHM value used in the convolution.
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    convolved_image: ImageRecord
+        The convolved image.
+    """
+
+    header['FWHM'] = (fwhm_input, 'The FWHM value used in the convolution step.')
+    logger.debug("Creating " + convolved_filename)
+    write_fits(convolved_filename, conv_result, header, config)
+    return ImageRecord(conv_result, image.header, image.filename, convolved_filename)
+
+def convolve_batch(batch, images_with_headers, fwhm_input, run_state, settings, config):
+    """
+    Convolves a batch of images and saves the results as new FITS files.
+    With the fft convolution method, the images of a batch share the same
+    pixel grid and are convolved together; with the direct method, a
+    batch holds a single image.
+
+    Parameters
+    ----------
+    batch: list
+        A list of (index, input filename, convolved filename, kernel)
+        tuples, where index is the position of the image in
+        images_with_headers.
+    images_with_headers: list of ImageRecord
+        The images being convolved.
+    fwhm_input: float
+        The FWHM value used in the convolution.
+    run_state: dict
+        The completed units, as returned by load_run_state().
+    settings: tuple
+        The parameter values recorded in the run state.
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    convolved_images: list
+        A list of (index, ImageRecord) tuples for the convolved images.
+    """
+
+    # NOTETOSELF: there has been a loss of data from the data cubes at an earlier
+    # step. The presence of 'EXTEND' and 'DSETS___' keywords in the header no
+    # longer means that there is any data in hdulist[1].data. I am using a
+    # workaround for now, but this needs to be looked at.
+    start = time.time()
+    registered = [read_fits(entry[1]) for entry in batch]
+    variance_files = [get_variance_files(entry[1], entry[2], config) for entry in batch]
+    # Images without a variance get a NaN one, which is not written.
+    variances = None
+    if (any(variance_inputs != [] for variance_inputs, variance_outputs in variance_files)):
+        variances = []
+        for j in range(0, len(batch)):
+            if (variance_files[j][0] != []):
+                variances.append(read_fits(variance_files[j][0][0])[0])
+            else:
+                variances.append(np.zeros(registered[j][0].shape) * np.nan)
+    if (config.convolution_method == 'fft'):
+        if (len(batch) > 1):
+            logger.debug("Convolving " + `len(batch)` + " images on a " + `registered[0][0].shape[1]` + "x" + `registered[0][0].shape[0]` + " pixel grid together")
+        stack = np.array([entry[0] for entry in registered])
+        if (variances is not None):
+            conv_results, conv_variances = batched_normalized_convolve(stack, [entry[3] for entry in batch], config.kernel_coverage, np.array(variances))
+        else:
+            conv_results = batched_normalized_convolve(stack, [entry[3] for entry in batch], config.kernel_coverage)
+        del stack
+    else:
+        conv_results = [convolve(registered[0][0], batch[0][3])]
+        if (variances is not None):
+            conv_variances = [convolve_variance(registered[0][0], variances[0], batch[0][3])]
+
+    convolved_images = []
+    for j in range(0, len(batch)):
+        i, input_filename, convolved_filename, kernel = batch[j]
+        variance_inputs, variance_outputs = variance_files[j]
+        # Do the convolution and save it as a new .fits file
+        conv_result = as_precision(conv_results[j], config)
+        convolved_images.append((i, write_convolved_image(images_with_headers[i], conv_result, registered[j][1], convolved_filename, fwhm_input, config)))
+        if (variance_outputs != []):
+            write_fits(variance_outputs[0], as_precision(conv_variances[j], config), registered[j][1], config)
+        mark_unit_complete(run_state, "convolve:" + images_with_headers[i].filename, [input_filename] + variance_inputs, [convolved_filename] + variance_outputs, settings, config)
+        # The images of a batch are convolved together, so they share the
+        # duration of the batch.
+        log_image_end(config, 'convolve', images_with_headers[i].filename, start, [convolved_filename] + variance_outputs)
+    return convolved_images
+
+def convolve_images(images_with_headers, config):
+    """
+    Convolves all of the images to a common resolution using a simple
+    gaussian kernel.
+
+    With the fft convolution method, the images that share the same pixel
+    grid after registration (e.g. all of the bands of one instrument) are
+    convolved together with batched_normalized_convolve().
+
+    Parameters
+    ----------
+    images_with_headers: list of ImageRecord
+        A structure containing headers and image data for all FITS input
+        images.
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    convolved_images: list of ImageRecord
+        The convolved images.
+    """
+
+    stage_start = time.time()
+    log_event(config, 'start', 'convolve', message="Convolving images", images=len(images_with_headers))
+    fwhm_input = get_common_fwhm(images_with_headers, config)
+    logger.debug("fwhm_input = " + `fwhm_input`)
+
+    run_state = load_run_state(config)
+    settings = (fwhm_input, config.convolution_method, config.kernel_coverage)
+    convolved_images = [None] * len(images_with_headers)
+    # With the fft method, the images are convolved in batches that share
+    # the same pixel grid; with the direct method, one at a time.
+    batches = {}
+    batch_keys = []
+    for i in range(0, len(images_with_headers)):
+
+        native_pixelscale = get_native_pixelscale(images_with_headers[i].header, get_instrument(images_with_headers[i].header, config.calibrations), config.calibrations)
+        sigma_input = fwhm_input / (2* math.sqrt(2*math.log (2) ) * native_pixelscale)
+        logger.debug("Native pixel scale: " + `native_pixelscale`)
+        logger.debug("Instrument: " + `get_instrument(images_with_headers[i].header, config.calibrations)`)
+
+        original_filename = os.path.basename(images_with_headers[i].filename)
+        original_directory = os.path.dirname(images_with_headers[i].filename)
+        new_directory = get_target_directory(original_directory, config) + "/convolved/"
+        convolved_filename = new_directory + original_filename  + "_convolved.fits"
+        input_directory = get_target_directory(original_directory, config) + "/registered/"
+        input_filename = input_directory + original_filename  + "_registered.fits"
+        logger.debug("Convolved filename: " + convolved_filename)
+        logger.debug("Input filename: " + input_filename)
+        if not os.path.exists(new_directory):
+            os.makedirs(new_directory)
+
+        variance_inputs, variance_outputs = get_variance_files(input_filename, convolved_filename, config)
+        if (is_unit_complete(run_state, "convolve:" + images_with_headers[i].filename, [input_filename] + variance_inputs, [convolved_filename] + variance_outputs, settings, config)):
+            convolved_images[i] = images_with_headers[i].with_path(convolved_filename)
+            continue
+
+        gaus_kernel_inp = make_kernel([3,3], kernelwidth=sigma_input, kerneltype='gaussian', trapslope=None, force_odd=True)
+
+        # Only the header is needed to find the pixel grid of the image.
+        hdulist = fits.open(input_filename)
+        image_header = get_image_hdu(hdulist).header
+        batch_key = (image_header['NAXIS2'], image_header['NAXIS1'], native_pixelscale)
+        hdulist.close()
+        if (config.convolution_method != 'fft'):
+            batch_key = batch_key + (i,)
+        if (batch_key not in batches):
+            batches[batch_key] = []
+            batch_keys.append(batch_key)
+        batches[batch_key].append((i, input_filename, convolved_filename, gaus_kernel_inp))
+
+    tasks = []
+    for batch_key in batch_keys:
+        batch = batches[batch_key]
+        kernel_shape = (max(entry[3].shape[0] for entry in batch), max(entry[3].shape[1] for entry in batch))
+        memory = estimate_unit_memory('convolve', batch_key[:2], config, kernel_shape, len(batch))
+        tasks.append((memory, convolve_batch, (batch, images_with_headers, fwhm_input, run_state, settings, config)))
+
+    for batch_results in run_scheduled(tasks, config):
+        for i, convolved_image in batch_results:
+            convolved_images[i] = convolved_image
+
+    log_event(config, 'end', 'convolve', images=len(images_with_headers), duration=time.time() - stage_start)
+    return convolved_images
+
+def get_data_cube_filename(config):
+    """
+    Returns the name of the data cube of the current target.
+    """
+
+    return get_target_directory(config.directory, config) + "/datacube/" + 'datacube.fits'
+
+def get_uncertainty_cube_filename(config):
+    """
+    Returns the name of the cube of uncertainties of the data cube of the
+    current target (see the uncertainties parameter).
+    """
+
+    return get_target_directory(config.directory, config) + "/datacube/" + 'datacube_unc.fits'
+
+def get_data_cube_planes(header):
+    """
+    Returns the band held by each plane of a data cube.
+
+    Parameters
+    ----------
+    header: FITS file header
+        The header of the data cube.
+
+    Returns
+    -------
+    planes: list
+        A list of (wavelength, name) tuples, one for each plane, from the
+        WAVEnnn and PLANEnnn keywords.
+    """
+
+    planes = []
+    while (('PLANE%03d' % (len(planes) + 1)) in header):
+        planes.append((header['WAVE%03d' % (len(planes) + 1)], header['PLANE%03d' % (len(planes) + 1)]))
+    return planes
+
+def set_data_cube_planes(header, planes):
+    """
+    Records the band held by each plane of a data cube in the WAVEnnn and
+    PLANEnnn keywords of its header.
+
+    Parameters
+    ----------
+    header: FITS file header
+        The header of the data cube.
+    planes: list
+        A list of (wavelength, name) tuples, one for each plane.
+
+    """
+
+    for i in range(1, len(get_data_cube_planes(header)) + 1):
+        del header['WAVE%03d' % i]
+        del header['PLANE%03d' % i]
+    for i in range(0, len(planes)):
+        header['WAVE%03d' % (i + 1)] = (planes[i][0], 'Wavelength (micron) of plane ' + `i + 1`)
+        header['PLANE%03d' % (i + 1)] = (planes[i][1], 'Input image of plane ' + `i + 1`)
+
+def block_sum(cube):
+    """
+    Sums blocks of 2x2 pixels of every plane of a data cube. Planes with an
+    odd number of rows or columns are padded with NaN. NaN pixels are
+    skipped in the sums; a block without any valid pixel is NaN.
+
+    Parameters
+    ----------
+    cube: numpy array
+        The data cube, as (plane, y, x).
+
+    Returns
+    -------
+    summed_cube: numpy array
+        The data cube with half the number of rows and columns (rounded up).
+    """
+
+    num_planes, ny, nx = cube.shape
+    padded = np.empty((num_planes, ny + ny % 2, nx + nx % 2), dtype=cube.dtype)
+    padded.fill(np.nan)
+    padded[:, :ny, :nx] = cube
+    blocks = padded.reshape(num_planes, padded.shape[1] // 2, 2, padded.shape[2] // 2, 2)
+    valid = np.isfinite(blocks)
+    summed_cube = np.where(valid, blocks, 0).sum(axis=(2, 4))
+    summed_cube[valid.sum(axis=(2, 4)) == 0] = np.nan
+    return summed_cube.astype(cube.dtype)
+
+def get_pyramid_header(header, level):
+    """
+    Returns the header of a pyramid level of a data cube, whose pixels are
+    2**level times larger than those of the data cube.
+
+    Parameters
+    ----------
+    header: FITS file header
+        The header of the data cube.
+    level: int
+        The pyramid level.
+
+    Returns
+    -------
+    level_header: FITS file header
+        The header of the level, with the WCS adjusted to its pixels.
+    """
+
+    level_header = header.copy()
+    factor = 2**level
+    for axis in ['1', '2']:
+        # The center of the first block of pixels is at pixel (factor + 1) / 2
+        # of the data cube.
+        level_header['CRPIX' + axis] = (header['CRPIX' + axis] - 0.5) / factor + 0.5
+        if ('CDELT' + axis in header):
+            level_header['CDELT' + axis] = header['CDELT' + axis] * factor
+        for other_axis in ['1', '2']:
+            if ('CD' + axis + '_' + other_axis in header):
+                level_header['CD' + axis + '_' + other_axis] = header['CD' + axis + '_' + other_axis] * factor
+    level_header['PYRLEVEL'] = (level, 'Blocks of 2**PYRLEVEL pixels of the data cube.')
+    return level_header
+
+def write_data_cube_pyramid(datacube_filename, cube, header, config):
+    """
+    Appends the pyramid levels of a data cube to its FITS file, as
+    extensions named LEVEL1, LEVEL2, ... (see the pyramid parameter).
+
+    Parameters
+    ----------
+    datacube_filename: string
+        The name of the FITS file holding the data cube.
+    cube: numpy array
+        The data cube.
+    header: FITS file header
+        The header of the data cube.
+    config: Config
+        The parameters of the run.
+
+    """
+
+    hdulist = fits.open(datacube_filename, mode='append')
+    level = 0
+    while (max(cube.shape[1:]) > PYRAMID_MIN_SIZE):
+        level += 1
+        cube = block_sum(cube)
+        level_header = get_pyramid_header(header, level)
+        if (config.compression == ''):
+            level_hdu = fits.ImageHDU(as_precision(cube, config), level_header, name='LEVEL' + `level`)
+        else:
+            level_hdu = fits.CompImageHDU(as_precision(cube, config), level_header, name='LEVEL' + `level`, compression_type=COMPRESSION_TYPES[config.compression], quantize_level=config.quantize_level)
+        hdulist.append(level_hdu)
+        logger.debug("Pyramid level " + `level` + ": " + `cube.shape[2]` + "x" + `cube.shape[1]` + " pixels")
+    hdulist.close()
+
+def get_pyramid_levels(datacube_filename):
+    """
+    Returns the number of pyramid levels stored with a data cube.
+
+    Parameters
+    ----------
+    datacube_filename: string
+        The name of the FITS file holding the data cube.
+
+    Returns
+    -------
+    num_levels: int
+        The number of levels, or 0 if the data cube has no pyramid.
+    """
+
+    hdulist = fits.open(datacube_filename)
+    num_levels = len([hdu for hdu in hdulist if hdu.name.startswith('LEVEL')])
+    hdulist.close()
+    return num_levels
+
+class StreamingStatistics(object):
+    """
+    Accumulates the statistics of the values of an image, which can be
+    given in any number of chunks, without keeping them: the number of
+    values and of NaN values, their minimum, maximum and sum, and
+    histograms from which percentiles are estimated. The bins of the
+    histograms are logarithmic in the absolute value, so that an estimated
+    percentile is within STATISTICS_ACCURACY of the true value relative to
+    it, whatever the range of the values.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.num_nan = 0
+        self.num_zero = 0
+        self.total = 0.0
+        self.minimum = np.nan
+        self.maximum = np.nan
+        self.gamma = (1 + STATISTICS_ACCURACY) / (1 - STATISTICS_ACCURACY)
+        # Bin k holds the absolute values between gamma**(k - 1) and
+        # gamma**k.
+        self.positive = {}
+        self.negative = {}
+
+    def update(self, values):
+        """
+        Adds a chunk of values (a numpy array of any shape).
+        """
+
+        values = np.asarray(values, dtype=np.float64).ravel()
+        valid = values[np.isfinite(values)]
+        self.num_nan += values.size - valid.size
+        if (valid.size == 0):
+            return
+        self.count += valid.size
+        self.total += valid.sum()
+        self.minimum = np.nanmin([self.minimum, valid.min()])
+        self.maximum = np.nanmax([self.maximum, valid.max()])
+        self.num_zero += np.count_nonzero(valid == 0)
+        for absolute_values, histogram in [(valid[valid > 0], self.positive), (-valid[valid < 0], self.negative)]:
+            bins, counts = np.unique(np.ceil(np.log(absolute_values) / np.log(self.gamma)).astype(np.int64), return_counts=True)
+            for k, n in zip(bins, counts):
+                histogram[k] = histogram.get(k, 0) + n
+
+    def percentile(self, q):
+        """
+        Returns an estimate of the q-th percentile (between 0 and 100) of
+        the values, or NaN if there are no valid values.
+        """
+
+        if (self.count == 0):
+            return np.nan
+        # The bins in increasing order of the values, with the value at
+        # the middle of each bin.
+        middle = 2 / (1 + self.gamma)
+        bins = [(-middle * self.gamma**k, self.negative[k]) for k in sorted(self.negative, reverse=True)]
+        bins.append((0.0, self.num_zero))
+        bins += [(middle * self.gamma**k, self.positive[k]) for k in sorted(self.positive)]
+        rank = q / 100.0 * (self.count - 1)
+        cumulative = 0
+        for value, n in bins:
+            cumulative += n
+            if (cumulative > rank):
+                break
+        return float(np.clip(value, self.minimum, self.maximum))
+
+    def as_dict(self):
+        """
+        Returns the statistics as a dictionary, with None for the values
+        that are not defined.
+        """
+
+        def defined(value):
+            return float(value) if np.isfinite(value) else None
+
+        num_values = self.count + self.num_nan
+        return {'min': defined(self.minimum),
+                'max': defined(self.maximum),
+                'mean': defined(self.total / self.count if self.count > 0 else np.nan),
+                'total_flux': self.total,
+                'nan_fraction': defined(self.num_nan / num_values if num_values > 0 else np.nan),
+                'percentiles': dict(('p' + `q`, defined(self.percentile(q))) for q in STATISTICS_PERCENTILES)}
+
+def get_statistics_filename(config):
+    """
+    Returns the name of the JSON file holding the statistics of the planes
+    of the data cube of the current target.
+    """
+
+    return get_target_directory(config.directory, config) + "/datacube/" + 'datacube_stats.json'
+
+def get_quicklook_filenames(planes, config):
+    """
+    Returns the names of the quick-look PNG images of the planes of the
+    data cube of the current target.
+
+    Parameters
+    ----------
+    planes: list
+        A list of (wavelength, name) tuples, one for each plane.
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    quicklook_filenames: list of strings
+        The name of the quick-look image of each plane.
+    """
+
+    return [get_target_directory(config.directory, config) + "/datacube/quicklook/" + name + ".png" for wavelength, name in planes]
+
+def block_mean(image, factor):
+    """
+    Averages blocks of factor x factor pixels of an image, skipping NaN
+    pixels. The image is padded with NaN to a multiple of factor.
+    """
+
+    ny, nx = image.shape
+    padded = np.empty((ny + (-ny) % factor, nx + (-nx) % factor))
+    padded.fill(np.nan)
+    padded[:ny, :nx] = image
+    blocks = padded.reshape(padded.shape[0] // factor, factor, padded.shape[1] // factor, factor)
+    valid = np.isfinite(blocks)
+    counts = valid.sum(axis=(1, 3))
+    sums = np.where(valid, blocks, 0).sum(axis=(1, 3))
+    means = np.zeros(sums.shape) * np.nan
+    means[counts > 0] = sums[counts > 0] / counts[counts > 0]
+    return means
+
+def summarize_plane(plane):
+    """
+    Computes the statistics and the quick-look image of a plane of the data
+    cube, reading its values once, a block of rows at a time.
+
+    Parameters
+    ----------
+    plane: numpy array
+        The image of the plane.
+
+    Returns
+    -------
+    statistics: StreamingStatistics
+        The statistics of the plane.
+    quicklook: numpy array
+        The plane averaged over blocks of pixels, with at most
+        QUICKLOOK_SIZE pixels along each dimension.
+    """
+
+    factor = int(math.ceil(max(plane.shape) / QUICKLOOK_SIZE))
+    statistics = StreamingStatistics()
+    quicklook_rows = []
+    for y in range(0, plane.shape[0], factor):
+        rows = plane[y:y + factor]
+        statistics.update(rows)
+        quicklook_rows.append(block_mean(rows, factor))
+    return statistics, np.vstack(quicklook_rows)
+
+def set_data_cube_statistics(header, statistics):
+    """
+    Records the statistics of each plane of a data cube in the DMINnnn,
+    DMAXnnn, DMEDnnn, FLUXnnn and NANFnnn keywords of its header.
+
+    Parameters
+    ----------
+    header: FITS file header
+        The header of the data cube.
+    statistics: list of StreamingStatistics
+        The statistics of each plane.
+
+    """
+
+    i = 1
+    while (('FLUX%03d' % i) in header):
+        for keyword in ['DMIN', 'DMAX', 'DMED', 'FLUX', 'NANF']:
+            del header[keyword + '%03d' % i]
+        i += 1
+    for i in range(0, len(statistics)):
+        summary = statistics[i].as_dict()
+        # Undefined values are left out, as FITS headers cannot hold NaN.
+        for keyword, value, comment in [('DMIN', summary['min'], 'Minimum'), ('DMAX', summary['max'], 'Maximum'), ('DMED', summary['percentiles']['p50'], 'Approximate median'), ('FLUX', summary['total_flux'], 'Total flux (Jy)'), ('NANF', summary['nan_fraction'], 'Fraction of NaN pixels')]:
+            if (value is not None):
+                header[keyword + '%03d' % (i + 1)] = (value, comment + ' of plane ' + `i + 1`)
+
+def write_data_cube_summary(planes, statistics, quicklooks, config):
+    """
+    Writes the statistics of the planes of the data cube of the current
+    target to a JSON file, and their quick-look images to PNG files (see
+    get_statistics_filename() and get_quicklook_filenames()). The
+    quick-look images are scaled between the 1st and 99th percentiles of
+    their plane.
+
+    Parameters
+    ----------
+    planes: list
+        A list of (wavelength, name) tuples, one for each plane.
+    statistics: list of StreamingStatistics
+        The statistics of each plane.
+    quicklooks: list of numpy arrays
+        The quick-look image of each plane.
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    output_filenames: list of strings
+        The names of the files written.
+    """
+
+    statistics_filename = get_statistics_filename(config)
+    summaries = []
+    for i in range(0, len(planes)):
+        summary = statistics[i].as_dict()
+        summary['plane'] = i + 1
+        summary['wavelength'] = planes[i][0]
+        summary['name'] = planes[i][1]
+        summaries.append(summary)
+    with open(statistics_filename, 'w') as f:
+        json.dump(summaries, f, indent=1, sort_keys=True)
+
+    quicklook_filenames = get_quicklook_filenames(planes, config)
+    if (not os.path.exists(os.path.dirname(quicklook_filenames[0]))):
+        os.makedirs(os.path.dirname(quicklook_filenames[0]))
+    for i in range(0, len(planes)):
+        lower = statistics[i].percentile(1)
+        upper = statistics[i].percentile(99)
+        if (not np.isfinite(lower) or upper <= lower):
+            lower, upper = 0.0, 1.0
+        pylab.imsave(quicklook_filenames[i], quicklooks[i], vmin=lower, vmax=upper, cmap='gray', origin='lower')
+    return [statistics_filename] + quicklook_filenames
+
+def create_data_cube(images_with_headers, config):
+    """
+    Creates a data cube from the provided images.
+
+
+    Parameters
+    ----------
+    images_with_headers: list of ImageRecord
+        A structure containing headers and image data for all FITS input
+        images.
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    datacube_filename: string
+        The name of the FITS file holding the data cube.
+
+    Notes
+    -----
+    Currently we are just using the header of the first input image.
+    This should be changed to something more appropriate.
+    """
+    stage_start = time.time()
+    log_event(config, 'start', 'datacube', message="Creating a data cube.", images=len(images_with_headers))
+
+    new_directory = get_target_directory(config.directory, config) + "/datacube/"
+    logger.debug("New directory: " + new_directory)
+    if not os.path.exists(new_directory):
+        os.makedirs(new_directory)
+
+    resampled_filenames = []
+    for i in range(0, len(images_with_headers)):
+        original_filename = os.path.basename(images_with_headers[i].filename)
+        original_directory = os.path.dirname(images_with_headers[i].filename)
+        resampled_filenames.append(get_target_directory(original_directory, config) + "/resampled/" + original_filename  + "_resampled.fits")
+
+    datacube_filename = get_data_cube_filename(config)
+    planes = [(images_with_headers[i].header['WAVELENG'], os.path.basename(images_with_headers[i].filename)) for i in range(0, len(images_with_headers))]
+    # The uncertainties are stacked in a second cube, with NaN planes for
+    # the bands without a variance.
+    variance_filenames = []
+    output_filenames = [datacube_filename, get_statistics_filename(config)] + get_quicklook_filenames(planes, config)
+    if (config.uncertainties):
+        variance_filenames = [get_variance_filename(f) for f in resampled_filenames if os.path.isfile(get_variance_filename(f))]
+        if (variance_filenames != []):
+            output_filenames.append(get_uncertainty_cube_filename(config))
+    run_state = load_run_state(config)
+    if (is_unit_complete(run_state, "datacube", resampled_filenames + variance_filenames, output_filenames, (config.pyramid,), config)):
+        return datacube_filename
+
+    # The data cube is allocated once, from the first plane, and filled as
+    # each plane is read; its statistics and quick-look images are computed
+    # at the same time, so the data cube is not read again to make them.
+    cube = None
+    header = None
+    statistics = []
+    quicklooks = []
+    for i, (image, image_header) in enumerate(prefetch(read_fits, [(resampled_filename,) for resampled_filename in resampled_filenames])):
+        image = as_precision(image, config)
+        if (cube is None):
+            cube = np.empty((len(resampled_filenames),) + image.shape, dtype=image.dtype)
+            header = image_header
+        cube[i] = image
+        plane_statistics, quicklook = summarize_plane(cube[i])
+        statistics.append(plane_statistics)
+        quicklooks.append(quicklook)
+
+    header['FWHM'] = (get_common_fwhm(images_with_headers, config), 'The FWHM value used in the convolution step.')
+    set_data_cube_planes(header, planes)
+    set_data_cube_statistics(header, statistics)
+    write_fits(datacube_filename, cube, header, config)
+    write_data_cube_summary(planes, statistics, quicklooks, config)
+    if (config.pyramid):
+        write_data_cube_pyramid(datacube_filename, cube, header, config)
+    if (variance_filenames != []):
+        # The data cube has been written, so its array is reused for the
+        # uncertainties rather than allocating a second cube.
+        uncertainties = cube
+        for i in range(0, len(resampled_filenames)):
+            if (get_variance_filename(resampled_filenames[i]) in variance_filenames):
+                uncertainties[i] = np.sqrt(read_fits(get_variance_filename(resampled_filenames[i]))[0])
+            else:
+                uncertainties[i] = np.nan
+        logger.debug("Creating " + get_uncertainty_cube_filename(config))
+        write_fits(get_uncertainty_cube_filename(config), uncertainties, header, config)
+    mark_unit_complete(run_state, "datacube", resampled_filenames + variance_filenames, output_filenames, (config.pyramid,), config)
+    log_event(config, 'end', 'datacube', duration=time.time() - stage_start, bytes=sum(os.path.getsize(f) for f in output_filenames))
+    return datacube_filename
+
+def resample_images(images_with_headers, config, create_cube=True):
+    """
+    Resamples all of the images to a common pixel grid.
+
+    Parameters
+    ----------
+    images_with_headers: list of ImageRecord
+        A structure containing headers and image data for all FITS input
+        images.
+    config: Config
+        The parameters of the run.
+    create_cube: boolean
+        If True, a data cube of the resampled images is created with
+        create_data_cube().
+
+    Returns
+    -------
+    resampled_images: list of ImageRecord
+        The resampled images. Their image data is read from the resampled
+        FITS files when it is first used.
+    """
+
+    stage_start = time.time()
+    log_event(config, 'start', 'resample', message="Resampling images.", images=len(images_with_headers))
+
+    fwhm_input = get_common_fwhm(images_with_headers, config)
+    logger.debug("fwhm: " + `fwhm_input`)
+    # parameter1 & parameter2 depend on the "fwhm" of the convolution step, and following the Nyquist sampling rate. 
+    parameter1 = config.phys_size / (fwhm_input / NYQUIST_SAMPLING_RATE) 
+    logger.debug("ncols, nlines: " + `parameter1`)
+    parameter2 = parameter1
+    grid_filename = get_scratch_filename("grid_final_resample.fits", config)
+
+    lngref_input, latref_input = get_target_center(images_with_headers, config)
+
+    if (config.backend == 'native'):
+        grid_header = make_grid_header(parameter1, fwhm_input/NYQUIST_SAMPLING_RATE, lngref_input, latref_input)
+    else:
+        with iraf_lock:
+            # First we create an artificial fits image, 
+            # The difference with the registration step is that the artificial image is now created only once, and it is common for all the input_images_convolved (or imput_images_gaussian_convolved)
+            # unlearn some iraf tasks
+            iraf.unlearn('mkpattern')
+
+            # create a fake image "grid_final_resample.fits", to which we will register all fits images
+            artdata.mkpattern(input=grid_filename, output=grid_filename, pattern="constant", pixtype=IRAF_PIXEL_TYPES[config.precision], ndim=2, ncols=parameter1, nlines=parameter2)
+
+            # Then, we tag the desired WCS in this fake image:
+            # unlearn some iraf tasks
+            iraf.unlearn('ccsetwcs')
+
+            # tag the desired WCS in the fake image "apixel.fits"
+            # NOTETOSELF: in the code Sophia gave me, lngunit was given as "hours", but I have
+            # changed it to "degrees".
+            iraf.ccsetwcs(images=grid_filename, database="", solution="", xref=parameter1/2, yref=parameter2/2, xmag=fwhm_input/NYQUIST_SAMPLING_RATE, ymag=fwhm_input/NYQUIST_SAMPLING_RATE, xrotati=0.,yrotati=0.,lngref=lngref_input, latref=latref_input, lngunit="degrees", latunit="degrees", transpo="no", project="tan", coosyst="j2000", update="yes", pixsyst="logical", verbose=get_iraf_verbose())
+
+    run_state = load_run_state(config)
+    settings = (fwhm_input, config.phys_size, lngref_input, latref_input, config.backend)
+    resampled_images = []
+    for i in range(0, len(images_with_headers)):
+        start = time.time()
+        original_filename = os.path.basename(images_with_headers[i].filename)
+        original_directory = os.path.dirname(images_with_headers[i].filename)
+        new_directory = get_target_directory(original_directory, config) + "/resampled/"
+        resampled_filename = new_directory + original_filename  + "_resampled.fits"
+        input_directory = get_target_directory(original_directory, config) + "/convolved/"
+        input_filename = input_directory + original_filename  + "_convolved.fits"
+        logger.debug("Resampled filename: " + resampled_filename)
+        logger.debug("Input filename: " + input_filename)
+        if not os.path.exists(new_directory):
+            os.makedirs(new_directory)
+
+        unit = "resample:" + images_with_headers[i].filename
+        variance_inputs, variance_outputs = get_variance_files(input_filename, resampled_filename, config)
+        if (is_unit_complete(run_state, unit, [input_filename] + variance_inputs, [resampled_filename] + variance_outputs, settings, config)):
+            resampled_images.append(images_with_headers[i].with_path(resampled_filename))
+            continue
+
+        if (config.backend == 'native'):
+            image_data, header = read_fits(input_filename)
+            if (variance_inputs != []):
+                resampled_data, resampled_header, resampled_variance = reproject_image(image_data, header, grid_header, flux_conserve=True, variance=read_fits(variance_inputs[0])[0])
+                write_fits(variance_outputs[0], as_precision(resampled_variance, config), resampled_header, config)
+            else:
+                resampled_data, resampled_header = reproject_image(image_data, header, grid_header, flux_conserve=True)
+            logger.debug("Creating " + resampled_filename)
+            write_fits(resampled_filename, as_precision(resampled_data, config), resampled_header, config)
+            mark_unit_complete(run_state, unit, [input_filename] + variance_inputs, [resampled_filename] + variance_outputs, settings, config)
+            log_image_end(config, 'resample', images_with_headers[i].filename, start, [resampled_filename] + variance_outputs)
+            resampled_images.append(images_with_headers[i].with_path(resampled_filename))
+            continue
+
+        iraf_input_filename = get_iraf_input(input_filename)
+
+        with iraf_lock:
+            # Then, register the fits file of interest to the WCS of the fake fits file
+            # unlearn some iraf tasks
+            iraf.unlearn('wregister')
+
+            # register the science fits image
+            iraf.wregister(input=iraf_input_filename, reference=grid_filename, output=resampled_filename, fluxconserve="yes")
+
+        if (iraf_input_filename != input_filename):
+            os.remove(iraf_input_filename)
+        compress_fits(resampled_filename, config)
+        # The run state is saved after every image, so that an interrupted
+        # resampling can be resumed.
+        mark_unit_complete(run_state, unit, [input_filename], [resampled_filename], settings, config)
+        log_image_end(config, 'resample', images_with_headers[i].filename, start, [resampled_filename])
+
+        resampled_images.append(images_with_headers[i].with_path(resampled_filename))
+
+    log_event(config, 'end', 'resample', images=len(images_with_headers), duration=time.time() - stage_start)
+    if (create_cube):
+        create_data_cube(images_with_headers, config)
+
+    return resampled_images
+
+def add_band(filename, config):
+    """
+    Adds a single image to the existing data cube, or replaces the plane of
+    the band with the same file name, without reprocessing the other bands.
+    If the new band changes the common FWHM, the data cube is left
+    unchanged and the planes that are invalidated are listed.
+
+    Parameters
+    ----------
+    filename: string
+        The name of the FITS file to add.
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    added: boolean
+        True if the data cube was updated.
+    """
+
+    datacube_filename = get_data_cube_filename(config)
+    if (not os.path.isfile(datacube_filename)):
+        logger.error("Error: There is no data cube to add the band to: " + datacube_filename)
+        sys.exit()
+    cube_data, cube_header = read_fits(datacube_filename)
+    # The data may still be mapped from the file that is about to be
+    # overwritten.
+    cube_data = np.array(cube_data)
+    planes = get_data_cube_planes(cube_header)
+    if (planes == [] or 'FWHM' not in cube_header):
+        logger.error("Error: The data cube " + datacube_filename + " does not record the bands of its planes; it should be created again.")
+        sys.exit()
+
+    # The new band is processed on the grid of the data cube, so the angular
+    # size is that of the run that created it. The resampled grid has its
+    # reference pixel at the middle of its (fractional) width, which gives
+    # the size exactly, where the whole number of pixels would not.
+    if ('CRPIX1' in cube_header and 'CDELT1' in cube_header):
+        phys_size = 2 * float(cube_header['CRPIX1']) * abs(float(cube_header['CDELT1'])) * 3600
+        if (config.phys_size != '' and abs(config.phys_size - phys_size) > 1e-6 * phys_size):
+            logger.warning("The angular_size parameter (" + `config.phys_size` + ") is ignored: the data cube has an angular size of " + `phys_size` + " arcsec.")
+    elif (config.phys_size != ''):
+        phys_size = config.phys_size
+    else:
+        logger.error("Error: The angular size of the data cube " + datacube_filename + " cannot be determined; give it with the angular_size parameter.")
+        sys.exit()
+
+    # The common FWHM depends on the instruments and wavelengths of all of
+    # the bands, which only needs their headers.
+    band_name = os.path.basename(strip_fits_extension(filename))
+    plane_names = [name for wavelength, name in planes]
+    images_with_headers = []
+    for i in find_input_files(config):
+        images_with_headers += [image for image in open_input_images(i, [], config) if os.path.basename(image.filename) in plane_names and os.path.basename(image.filename) != band_name]
+    band_images = open_input_images(filename, [], config)
+    if (len(band_images) != 1):
+        logger.error("Error: A single band can be added at a time, but " + filename + " holds " + `len(band_images)` + " images.")
+        sys.exit()
+    images_with_headers += band_images
+    fwhm_input = get_common_fwhm(images_with_headers, config)
+    if (fwhm_input != cube_header['FWHM']):
+        logger.warning("Adding " + band_name + " changes the FWHM from " + `cube_header['FWHM']` + " to " + `fwhm_input` + ", which changes the convolution kernels and the resampled grid of all of the bands.")
+        logger.warning("The data cube has not been changed. The following planes are invalidated:")
+        for i in range(0, len(planes)):
+            logger.warning("  plane " + `i + 1` + ": " + planes[i][1] + " (" + `planes[i][0]` + " micron)")
+        logger.warning("Run the registration, convolution and resampling steps again for all of the bands.")
+        return False
+
+    # Process the new band on the grid of the existing data cube.
+    band_config = copy.copy(config)
+    band_config.fwhm = cube_header['FWHM']
+    band_config.phys_size = phys_size
+    band_config.ra_input = cube_header['CRVAL1']
+    band_config.dec_input = cube_header['CRVAL2']
+    band_images = read_images([filename], [], band_config)
+    band_images = convert_images(band_images, band_config)
+    band_images = register_images(band_images, band_config)
+    band_images = convolve_images(band_images, band_config)
+    band_images = resample_images(band_images, band_config, create_cube=False)
+    band_data = as_precision(band_images[0].data, config)
+    if (band_data.shape != cube_data.shape[1:]):
+        logger.warning("The resampled " + band_name + " has " + `band_data.shape[1]` + "x" + `band_data.shape[0]` + " pixels, but the planes of the data cube have " + `cube_data.shape[2]` + "x" + `cube_data.shape[1]` + "; check the angular_size parameter.")
+        logger.warning("The data cube has not been changed.")
+        return False
+
+    replaced_plane = None
+    if (band_name in plane_names):
+        replaced_plane = plane_names.index(band_name)
+        logger.info("Replacing plane " + `replaced_plane + 1` + " (" + band_name + ") of the data cube")
+        cube_data = np.delete(cube_data, replaced_plane, axis=0)
+        del planes[replaced_plane]
+    wavelength = band_images[0].header['WAVELENG']
+    position = len([plane for plane in planes if plane[0] <= wavelength])
+    logger.info("Inserting " + band_name + " (" + `wavelength` + " micron) as plane " + `position + 1` + " of the data cube")
+    cube_data = np.insert(cube_data, position, band_data, axis=0)
+    planes.insert(position, (wavelength, band_name))
+    # The data cube is already in memory, so its statistics and quick-look
+    # images are made again from it.
+    summaries = [summarize_plane(plane) for plane in cube_data]
+    statistics = [summary[0] for summary in summaries]
+    quicklooks = [summary[1] for summary in summaries]
+    set_data_cube_planes(cube_header, planes)
+    set_data_cube_statistics(cube_header, statistics)
+    # The pyramid of an existing data cube is rebuilt rather than left stale.
+    has_pyramid = (get_pyramid_levels(datacube_filename) > 0)
+    write_fits(datacube_filename, as_precision(cube_data, config), cube_header, config)
+    if (config.pyramid or has_pyramid):
+        write_data_cube_pyramid(datacube_filename, cube_data, cube_header, config)
+    write_data_cube_summary(planes, statistics, quicklooks, config)
+
+    # Like the pyramid, an existing cube of uncertainties is kept in step
+    # with the data cube. The new plane is NaN if the band has no variance;
+    # the variance is only propagated with the uncertainties parameter, and
+    # any variance file left by an earlier run would be stale otherwise.
+    uncertainty_cube_filename = get_uncertainty_cube_filename(config)
+    if (os.path.isfile(uncertainty_cube_filename)):
+        uncertainties = np.array(read_fits(uncertainty_cube_filename)[0])
+        if (replaced_plane is not None):
+            uncertainties = np.delete(uncertainties, replaced_plane, axis=0)
+        band_uncertainty = np.zeros(band_data.shape) * np.nan
+        if (config.uncertainties and os.path.isfile(get_variance_filename(band_images[0].path))):
+            band_uncertainty = np.sqrt(read_fits(get_variance_filename(band_images[0].path))[0])
+        uncertainties = np.insert(uncertainties, position, band_uncertainty, axis=0)
+        write_fits(uncertainty_cube_filename, as_precision(uncertainties, config), cube_header, config)
+    return True
+
+def output_seds(images_with_headers, config):
+    """
+    Makes the SEDs.
+
+    Parameters
+    ----------
+    images_with_headers: list of ImageRecord
+        A structure containing headers and image data for all FITS input
+        images.
+    config: Config
+        The parameters of the run.
+
+    """
+
+    #print("Outputting SEDs.")
+    stage_start = time.time()
+
+    all_image_data = []
+    wavelengths = []
+    input_filenames = []
+
+    num_wavelengths = len(images_with_headers)
+
+    for i in range(0, num_wavelengths):
+        original_filename = os.path.basename(images_with_headers[i].filename)
+        original_directory = os.path.dirname(images_with_headers[i].filename)
+        new_directory = get_target_directory(original_directory, config) + "/seds/"
+        input_directory = get_target_directory(original_directory, config) + "/resampled/"
+        input_filename = input_directory + original_filename  + "_resampled.fits"
+        input_filenames.append(input_filename)
+        wavelength = get_wavelength(images_with_headers[i].header, config.calibrations)[0]
+        wavelengths.append(wavelength)
+        #print("Input filename: " + input_filename)
+        if not os.path.exists(new_directory):
+            os.makedirs(new_directory)
+
+    sed_filename = get_scratch_filename('test.out', config)
+    # The SED of each pixel of the resampled grid is plotted to a file of
+    # its own.
+    num_rows, num_columns = read_fits(input_filenames[0])[0].shape[-2:]
+    output_filenames = [sed_filename] + [new_directory + `j` + '_' + `k` + '_sed.eps' for j in range(0, num_rows) for k in range(0, num_columns)]
+    run_state = load_run_state(config)
+    if (is_unit_complete(run_state, "seds", input_filenames, output_filenames, (), config)):
+        return
+
+    # Load the data for each image and append it to a master list of
+    # all image data.
+    for image_data, header in prefetch(read_fits, [(f,) for f in input_filenames]):
+        all_image_data.append(as_precision(image_data, config))
 
-        # Do a Jy/pixel unit conversion and save it as a new .fits file
-        converted_data_array = images_with_headers[i][0] * conversion_factor
-        converted_data.append(converted_data_array)
-        images_with_headers[i][1]['BUNIT'] = 'Jy/pixel'
-        images_with_headers[i][1]['JYPXFACT'] = (conversion_factor, 'Factor to convert original BUNIT into Jy/pixel.')
-        hdu = fits.PrimaryHDU(converted_data_array, images_with_headers[i][1])
-        print("Creating " + converted_filename)
-        hdu.writeto(converted_filename, clobber=True)
+    sed_data = []
+
+    for i in range(0, num_wavelengths):
+        #print(`wavelengths[i]`)
+        for j in range(len(all_image_data[i])):
+            for k in range(len(all_image_data[i][j])):
+                sed_data.append((int(j), int(k), wavelengths[i], all_image_data[i][j][k]))
+                #print("(" + `j` + "," + `k` + ")" + '\t' + `all_image_data[i][j][k]` + ' ' + `wavelengths[i]`)
+
+    #print(`sorted(sed_data)`)
+    data = np.copy(sorted(sed_data))
+    #np.savetxt('test.out', data, delimiter=',')
+    np.savetxt(sed_filename, data, fmt='%d,%d,%f,%f', header='x, y, wavelength (um), flux units (Jy/pixel)')
+    #print("len(data): " + `len(data)`)
+    num_seds = int(len(data) / num_wavelengths)
+    #print("Number of SEDs to create: " + `num_seds`)
+    # just the wavelengths:
+    #print(`data[:,2]`)
+    # just the z-values:
+    #print(`data[:,3]`)
+    # for one wavelength:
+    #print(`data[:,2][0:num_wavelengths]`)
+    #print(`data[:,3][0:num_wavelengths]`)
 
-def get_herschel_mean(images_with_headers, keyword):
+    # for all wavelengths:
+    log_event(config, 'start', 'seds', message="Creating SEDs", total=num_seds)
+    progress = ProgressReporter(config, 'seds', num_seds)
+    for i in range(0, num_seds):
+    #for i in range(0, 5):
+        #print(`i`)
+
+        # change to the desired fonts
+        rc('font', family='Times New Roman')
+        rc('text', usetex=True)
+            
+        # wavelength
+        #a = data[:,2] 								
+        wavelength_values = data[:,2][i*num_wavelengths:(i+1)*num_wavelengths]
+        # flux
+        #b = data[:,1]/1e20							
+        #b = data[:,2]
+        flux_values = data[:,3][i*num_wavelengths:(i+1)*num_wavelengths]
+        #b = data[:,3][i:i+num_wavelengths]
+        x_values = data[:,0][i*num_wavelengths:(i+1)*num_wavelengths]
+        y_values = data[:,1][i*num_wavelengths:(i+1)*num_wavelengths]
+
+        #print("\tx-values (" + `i*num_wavelengths` + "," + `(i+1)*num_wavelengths` + "): " + `x_values`)
+        #print("\ty-values (" + `i*num_wavelengths` + "," + `(i+1)*num_wavelengths` + "): " + `y_values`)
+        #print("\tWavelength (" + `i*num_wavelengths` + "," + `(i+1)*num_wavelengths` + "): " + `wavelength_values`)
+        #print("\tFlux (" + `i*num_wavelengths` + "," + `(i+1)*num_wavelengths` + "): " + `flux_values`)
+
+        #for w in range(0, num_wavelengths):
+            #print(`x_values[w]` + "\t" + `y_values[w]` + "\t" + `wavelength_values[w]` + "\t" + `flux_values[w]`)
+
+        # figure(1)
+        pylab.figure(i)
+        pylab.scatter(wavelength_values,flux_values)
+
+        # axes specific
+        pylab.xlabel(r'log(Wavelength) (um)')					
+        pylab.ylabel(r'Flux (Jy/pixel)')
+        pylab.rc('axes', labelsize=14, linewidth=2, labelcolor='black')
+        pylab.semilogx()
+        pylab.axis([min(wavelength_values),max(wavelength_values),min(flux_values),max(flux_values)])
+
+        pylab.hold(True)
+
+        # load the second data set
+        #data2 = np.loadtxt('Te/SPEC_4.out', comments='%',usecols = (1,2)) 	
+        #a2 = data2[:,0]
+        #b2 = data2[:,1]/1e20
+
+        # overplot in figure(1)
+        #pylab.plot(a2,b2, 'r:',  markersize=3.0, linewidth=2.0, label='Te')	
+
+        # load the third data set
+        #data3 = np.loadtxt('Teff/SPEC_4.out', comments='%',usecols = (1,2)) 	
+        #a3 = data3[:,0]
+        #b3 = data3[:,1]/1e20
+
+        # overplot in figure(1)
+        #pylab.plot(a3,b3, 'b-.',  markersize=3.0, linewidth=2.0, label='Teff')	
+
+        pylab.legend()
+        pylab.savefig(new_directory + `int(x_values[0])` + '_' + `int(y_values[0])` + '_sed.eps')
+        #pylab.show()
+        progress.update(i + 1)
+
+    mark_unit_complete(run_state, "seds", input_filenames, output_filenames, (), config)
+    log_event(config, 'end', 'seds', duration=time.time() - stage_start)
+
+def read_regions(filename):
     """
-    Checks all of the FITS images with data from Herschel instruments
-    (currently PACS and SPIRE) and returns the mean value of the given
-    FITS header keyword from all the relevant images.
+    Reads a list of sky apertures and annuli. Lines starting with '#' are
+    ignored.
+
+    Parameters
+    ----------
+    filename: string
+        The name of a text file in which each line holds a region name,
+        its RA and DEC (in degrees) and its radius (in arcsec), optionally
+        followed by an inner radius (in arcsec), separated by spaces or
+        commas.
+
+    Returns
+    -------
+    regions: list
+        A list of (name, ra, dec, radius, inner_radius) tuples, where
+        inner_radius is 0 for a circular aperture.
+    """
+
+    regions = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if (line == '' or line.startswith('#')):
+                continue
+            fields = line.replace(',', ' ').split()
+            if (len(fields) not in (4, 5) or not all(is_number(x) for x in fields[1:])):
+                logger.error("Could not parse the line '" + line + "' in the regions file " + filename)
+                sys.exit()
+            inner_radius = 0.
+            if (len(fields) == 5):
+                inner_radius = float(fields[4])
+            regions.append((fields[0], float(fields[1]), float(fields[2]), float(fields[3]), inner_radius))
+    return regions
+
+def get_region_members(filename, header, shape):
+    """
+    Determines which pixels of the data cube grid belong to each region.
+
+    Parameters
+    ----------
+    filename: string
+        Either a FITS label map or a text file of apertures, as described
+        in print_usage().
+    header: FITS file header
+        The header of the data cube, holding its WCS.
+    shape: tuple
+        The (NAXIS2, NAXIS1) dimensions of the planes of the data cube.
+
+    Returns
+    -------
+    names: list
+        The names of the regions.
+    pixels: numpy array
+        The flat indices of the pixels of all of the regions.
+    labels: numpy array
+        The index (into names) of the region of each of these pixels. A
+        pixel that belongs to several apertures appears once for each.
+    """
+
+    if (filename.lower().endswith('.fits') or filename.lower().endswith('.fit')):
+        label_map = read_fits(filename)[0]
+        if (label_map.shape != shape):
+            logger.error("Error: The label map " + filename + " has " + `label_map.shape[1]` + "x" + `label_map.shape[0]` + " pixels, but the data cube has " + `shape[1]` + "x" + `shape[0]` + ".")
+            sys.exit()
+        label_map = np.nan_to_num(np.asarray(label_map)).astype(int).ravel()
+        pixels = np.flatnonzero(label_map > 0)
+        values, labels = np.unique(label_map[pixels], return_inverse=True)
+        return ["region" + `value` for value in values], pixels, labels
+
+    # Rasterize the apertures on the grid from the sky position of each
+    # pixel centre.
+    regions = read_regions(filename)
+    y, x = np.mgrid[0:shape[0], 0:shape[1]]
+    ra, dec = wcs.WCS(header, naxis=2).wcs_pix2world(x.ravel(), y.ravel(), 0)
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    all_pixels = []
+    all_labels = []
+    for i in range(0, len(regions)):
+        name, region_ra, region_dec, radius, inner_radius = regions[i]
+        # The haversine formula, which is accurate at small separations.
+        separation = 2 * np.arcsin(np.sqrt(np.sin((dec - math.radians(region_dec)) / 2)**2 + np.cos(dec) * math.cos(math.radians(region_dec)) * np.sin((ra - math.radians(region_ra)) / 2)**2))
+        separation = np.degrees(separation) * 3600
+        members = np.flatnonzero((separation <= radius) & (separation >= inner_radius))
+        if (len(members) == 0):
+            logger.warning("Region " + name + " does not contain any pixels of the data cube.")
+        all_pixels.append(members)
+        all_labels.append(np.zeros(len(members), dtype=int) + i)
+    return [region[0] for region in regions], np.concatenate(all_pixels), np.concatenate(all_labels)
+
+def sum_regions(cube, pixels, labels, num_regions):
+    """
+    Sums every plane of a data cube over regions with a single bincount over
+    (plane, region) pairs, rather than a loop over the regions.
+
+    Parameters
+    ----------
+    cube: numpy array
+        The data cube.
+    pixels: numpy array
+        The flat indices of the pixels of all of the regions, as returned
+        by get_region_members().
+    labels: numpy array
+        The region of each of these pixels.
+    num_regions: int
+        The number of regions.
+
+    Returns
+    -------
+    sums: numpy array
+        The sum of the valid pixels of each region (second axis) in each
+        plane (first axis).
+    counts: numpy array
+        The number of valid pixels that were summed.
+    """
+
+    num_planes = cube.shape[0]
+    values = cube.reshape(num_planes, -1)[:, pixels]
+    valid = np.isfinite(values)
+    index = (labels[np.newaxis, :] + num_regions * np.arange(num_planes)[:, np.newaxis]).ravel()
+    sums = np.bincount(index, weights=np.where(valid, values, 0).ravel(), minlength=num_planes * num_regions)
+    counts = np.bincount(index, weights=valid.ravel(), minlength=num_planes * num_regions)
+    return sums.reshape(num_planes, num_regions), counts.reshape(num_planes, num_regions).astype(int)
+
+def output_region_seds(images_with_headers, config):
+    """
+    Sums the flux of every band of the data cube over the regions of the
+    regions parameter, and writes the SEDs of the regions as a table with
+    one line per region.
+
+    Parameters
+    ----------
+    images_with_headers: list of ImageRecord
+        A structure containing headers and image data for all FITS input
+        images.
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    table_filename: string
+        The name of the file holding the table.
+    """
+
+    stage_start = time.time()
+    log_event(config, 'start', 'regions', message="Summing the SEDs of regions.")
+    cube, header = read_fits(get_data_cube_filename(config))
+    planes = get_data_cube_planes(header)
+    if (planes != []):
+        wavelengths = [wavelength for wavelength, name in planes]
+    else:
+        wavelengths = [image.header['WAVELENG'] for image in images_with_headers]
+
+    names, pixels, labels = get_region_members(config.regions_file, header, cube.shape[1:])
+    sums, counts = sum_regions(cube, pixels, labels, len(names))
+
+    new_directory = get_target_directory(config.directory, config) + "/seds/"
+    if not os.path.exists(new_directory):
+        os.makedirs(new_directory)
+    table_filename = new_directory + "region_seds.txt"
+    logger.info("Creating " + table_filename)
+    with open(table_filename, 'w') as f:
+        f.write("# region, " + ', '.join(`wavelength` + " um (Jy)" for wavelength in wavelengths) + ", " + ', '.join(`wavelength` + " um (pixels)" for wavelength in wavelengths) + "\n")
+        for i in range(0, len(names)):
+            f.write(names[i] + "," + ','.join("%g" % value for value in sums[:, i]) + "," + ','.join("%d" % value for value in counts[:, i]) + "\n")
+    log_event(config, 'end', 'regions', duration=time.time() - stage_start, regions=len(names))
+    return table_filename
+
+def read_positions(query):
+    """
+    Reads the positions of an SED query.
+
+    Parameters
+    ----------
+    query: string
+        Either a position given as "<a>,<b>", or the name of a text file
+        with one such position per line (separated by a comma or spaces).
+        Lines starting with '#' are ignored.
+
+    Returns
+    -------
+    positions: numpy array
+        The positions, with one (a, b) pair per row.
+    """
+
+    if (os.path.isfile(query)):
+        with open(query) as f:
+            lines = [line.strip() for line in f if line.strip() != '' and not line.strip().startswith('#')]
+    else:
+        lines = [query]
+    positions = []
+    for line in lines:
+        fields = line.replace(',', ' ').split()
+        if (len(fields) != 2 or not all(is_number(x) for x in fields)):
+            logger.error("Could not parse the position '" + line + "'")
+            sys.exit()
+        positions.append((float(fields[0]), float(fields[1])))
+    return np.array(positions)
+
+def query_seds(datacube_filename, positions, pixel_coordinates=False, level=0):
+    """
+    Returns the SEDs at a batch of positions of a data cube. The data cube
+    is memory-mapped, so that only the requested pixels are read.
+
+    Parameters
+    ----------
+    datacube_filename: string
+        The name of the data cube, as written by create_data_cube().
+    positions: numpy array
+        The positions, with one (RA, DEC) pair (in degrees) per row, or one
+        (x, y) pair of 0-based pixel coordinates if pixel_coordinates is
+        True.
+    pixel_coordinates: boolean
+        Whether the positions are pixel coordinates.
+    level: int
+        The pyramid level to read the SEDs from, or 0 for the data cube
+        itself.
+
+    Returns
+    -------
+    wavelengths: list
+        The wavelength (in microns) of each plane of the data cube.
+    seds: numpy array
+        The SED at each position (one per row). The SEDs of positions
+        outside of the data cube are NaN.
+    """
+
+    hdulist = fits.open(datacube_filename, memmap=True)
+    if (level == 0):
+        hdu = get_image_hdu(hdulist)
+    elif ('LEVEL' + `level` in [extension.name for extension in hdulist]):
+        hdu = hdulist['LEVEL' + `level`]
+    else:
+        logger.error("Error: The data cube " + datacube_filename + " has no pyramid level " + `level`)
+        sys.exit()
+    header = hdu.header
+    cube = hdu.data
+    planes = get_data_cube_planes(header)
+    wavelengths = [wavelength for wavelength, name in planes]
+
+    positions = np.atleast_2d(positions)
+    if (pixel_coordinates):
+        x, y = positions[:, 0], positions[:, 1]
+    else:
+        x, y = wcs.WCS(header, naxis=2).wcs_world2pix(positions[:, 0], positions[:, 1], 0)
+    x = np.floor(x + 0.5).astype(int)
+    y = np.floor(y + 0.5).astype(int)
+    inside = (x >= 0) & (x < cube.shape[2]) & (y >= 0) & (y < cube.shape[1])
+
+    seds = np.empty((len(positions), cube.shape[0]))
+    seds.fill(np.nan)
+    # A single fancy index reads only the requested pixels from the map.
+    seds[inside] = cube[:, y[inside], x[inside]].T
+    hdulist.close()
+    return wavelengths, seds
+
+def output_sed_query(config):
+    """
+    Displays the SEDs at the positions of the query parameter, as one line
+    of comma-separated values per position.
+
+    Parameters
+    ----------
+    config: Config
+        The parameters of the run.
+
+    """
+
+    positions = read_positions(config.query)
+    wavelengths, seds = query_seds(get_data_cube_filename(config), positions, config.pixel_coordinates, config.query_level)
+    if (config.pixel_coordinates):
+        columns = ["x", "y"]
+    else:
+        columns = ["ra", "dec"]
+    print("# " + ', '.join(columns + [`wavelength` + " um (Jy/pixel)" for wavelength in wavelengths]))
+    for i in range(0, len(positions)):
+        print(','.join(["%.8g" % value for value in positions[i]] + ["%g" % value for value in seds[i]]))
+
+def process_targets(images_with_headers, targets, config):
+    """
+    Runs the registration, convolution, resampling and SED steps for each
+    of several targets covered by the same (already converted) input
+    images.
+
+    Parameters
+    ----------
+    images_with_headers: list of ImageRecord
+        A structure containing headers and image data for all FITS input
+        images.
+    targets: list
+        A list of (name, ra, dec, angular_size) tuples, as returned by
+        read_targets().
+    config: Config
+        The parameters of the run.
+
+    """
+
+    for name, ra, dec, angular_size in targets:
+        logger.info("Processing target " + name)
+        target_config = config.for_target(name, ra, dec, angular_size)
+        if (not target_config.resume):
+            reset_run_state(target_config)
+
+        # Only the images that cover this target are processed for it.
+        target_images = []
+        for image in images_with_headers:
+            coverage = get_coverage_fraction(image.header, image.shape[-1], image.shape[-2], ra, dec, angular_size)
+            if (is_sufficient_coverage(coverage, target_config)):
+                target_images.append(image)
+            else:
+                logger.info("Skipping " + image.filename + " for target " + name + ": it covers " + `coverage` + " of the target.")
+        if (target_images == []):
+            logger.info("No images cover target " + name)
+            continue
+
+        if (target_config.do_registration):
+            register_images(target_images, target_config)
+
+        if (target_config.do_convolution):
+            convolve_images(target_images, target_config)
+
+        if (target_config.do_resampling):
+            resample_images(target_images, target_config)
+
+        if (target_config.do_seds):
+            output_seds(target_images, target_config)
+
+        if (target_config.regions_file != ''):
+            output_region_seds(target_images, target_config)
+
+def cleanup_output_files(config):
+    """
+    Removes files that have been generated by previous executions of the
+    script.
+
+    Parameters
+    ----------
+    config: Config
+        The parameters of the run.
+
+    """
+
+    logger.info("Cleaning up output files.")
+
+    import shutil
+
+    for d in ('converted', 'registered', 'convolved', 'resampled', 'seds', 'targets', 'cache'):
+        subdir = config.directory + '/' + d
+        if (os.path.isdir(subdir)):
+            logger.info("Removing " + subdir)
+            shutil.rmtree(subdir)
+
+    reset_run_state(config)
+    if (os.path.isfile(get_run_state_filename(config) + '.lock')):
+        os.remove(get_run_state_filename(config) + '.lock')
+
+def find_input_files(config):
+    """
+    Determines which FITS files are to be processed.
+
+    Parameters
+    ----------
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    all_files: list
+        The names of the input FITS files.
+    """
+
+    if (config.catalog_file != ''):
+        # Select the input files from the catalog, restricted to the target
+        # if its position and size are known.
+        if (config.ra_input != '' and config.dec_input != '' and config.phys_size != ''):
+            all_files = select_catalog_files(config.catalog_file, config.instrument_selection, config.band_selection, config.ra_input, config.dec_input, config.phys_size)
+        else:
+            all_files = select_catalog_files(config.catalog_file, config.instrument_selection, config.band_selection)
+    else:
+        # Grab all of the .fits and .fit files in the specified directory,
+        # except for the uncertainty images of the others
+        all_files = [f for f in glob.glob(config.directory + "/*.fit*") if not is_uncertainty_file(f)]
+
+    return all_files
+
+def read_images(all_files, target_boxes, config):
+    """
+    Reads the input FITS files, skipping those that do not sufficiently
+    cover any of the targets, and sorts them by wavelength.
+
+    Parameters
+    ----------
+    all_files: list
+        The names of the input FITS files.
+    target_boxes: list
+        A list of (ra, dec, angular_size) tuples, as returned by
+        get_target_boxes().
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    images_with_headers: list of ImageRecord
+        The input images, sorted by their WAVELENG value.
+    """
+
+    images_with_headers = []
+
+    # The next file is read in the background while the current one is
+    # being processed.
+    for records in prefetch(read_input_images, [(i, target_boxes, config) for i in all_files]):
+        images_with_headers += records
+
+    # Sort the images by their WAVELENG value
+    return sorted(images_with_headers, key=lambda image: image.header['WAVELENG'])
+
+def read_input_images(filename, target_boxes, config):
+    """
+    Returns the images of an input FITS file that sufficiently cover any
+    of the targets, as found by open_input_images(). The image data of a
+    file holding a single image is read; the planes of a file holding
+    several images are read when they are processed.
+    """
+
+    records = open_input_images(filename, target_boxes, config)
+    if (len(records) == 1 and records[0].plane[1] is None):
+        # The path is kept, as the conversion step records the input file.
+        records = [ImageRecord(as_precision(records[0].data, config), records[0].header, records[0].filename, records[0].path, records[0].plane)]
+    return records
+
+def open_input_images(filename, target_boxes, config):
+    """
+    Finds the images of an input FITS file (see get_input_planes()),
+    without reading their image data. Their WAVELENG header value is
+    converted to microns, and their coverage of the targets is checked and
+    recorded in the COVERAGE header keyword.
+
+    Parameters
+    ----------
+    filename: string
+        The name of the input FITS file.
+    target_boxes: list
+        A list of (ra, dec, angular_size) tuples, as returned by
+        get_target_boxes().
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    records: list of ImageRecord
+        The images that sufficiently cover any of the targets, whose data is
+        read from the file when it is used. A file holding a single image
+        gives a record named after the file (without the .fit or .fits
+        extension); the planes of a file holding several images are named
+        <name>_plane001, <name>_plane002, ...
+    """
+
+    hdulist = fits.open(get_input_path(filename))
+    #hdulist.info()
+    planes = get_input_planes(hdulist)
+    records = []
+    for header, hdu_index, index in planes:
+        shape = get_hdu_shape(hdulist[hdu_index])
+        if (index is not None):
+            shape = shape[-2:]
+        # Strip the .fit or .fits extension from the filename so we can append things to it
+        # later on
+        image_filename = strip_fits_extension(filename)
+        if (len(planes) > 1):
+            image_filename += '_plane%03d' % header['INPLANE']
+        # Skip images that do not cover any of the targets before any of
+        # their image data is read.
+        if (target_boxes != []):
+            coverage = max(get_coverage_fraction(header, shape[-1], shape[-2], ra, dec, size) for ra, dec, size in target_boxes)
+            header['COVERAGE'] = (coverage, 'Fraction of the target box covered by the image.')
+            if (not is_sufficient_coverage(coverage, config)):
+                logger.info("Skipping " + image_filename + ": it covers " + `coverage` + " of the target.")
+                continue
+        #wavelength = header['WAVELENG']
+        wavelength, wavelength_units = get_wavelength(header, config.calibrations)
+        #wavelength_units = header.comments['WAVELENG']
+        wavelength_microns = wavelength_to_microns(wavelength, wavelength_units)
+        # NOTETOSELF: don't overwrite the header value here. Either create a new keyword,
+        # say, WLMICRON, or include the original value in a comment.
+        header['WAVELENG'] = (wavelength_microns, 'micron')
+        records.append(ImageRecord(None, header, image_filename, filename, (hdu_index, index, shape)))
+    hdulist.close()
+    return records
+
+def get_scheduled_peak(memory_estimates, config):
+    """
+    Returns the peak memory of a step whose units are run with
+    run_scheduled().
+    """
+
+    if (memory_estimates == []):
+        return 0
+    if (config.max_memory == 0):
+        return max(memory_estimates)
+    return max(max(memory_estimates), min(sum(memory_estimates), config.max_memory * 1024 * 1024))
+
+def plan_target_steps(images_with_headers, shapes, config):
+    """
+    Estimates the output of the registration, convolution, resampling and
+    SED steps requested for a target.
+
+    Parameters
+    ----------
+    images_with_headers: list of ImageRecord
+        The input images covering the target; only their headers are used.
+    shapes: dict
+        The (NAXIS2, NAXIS1) dimensions of each input image, keyed by the
+        filename of its ImageRecord.
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    steps: list
+        A list of (step, number of images, pixels, disk bytes, peak memory
+        bytes, seconds) tuples.
+    """
+
+    steps = []
+    itemsize = np.dtype(config.precision).itemsize
+    num_images = len(images_with_headers)
+    fwhm_input = get_common_fwhm(images_with_headers, config)
+
+    # The registration grid of each image, as created in register_images().
+    grids = {}
+    for image in images_with_headers:
+        native_pixelscale = get_native_pixelscale(image.header, get_instrument(image.header, config.calibrations), config.calibrations)
+        grids[image.filename] = (int(config.phys_size / native_pixelscale), native_pixelscale)
+        print("  " + os.path.basename(image.filename) + ": " + `shapes[image.filename][1]` + "x" + `shapes[image.filename][0]` + " input pixels, " + `grids[image.filename][0]` + "x" + `grids[image.filename][0]` + " registered pixels")
+    registered_pixels = sum(size**2 for size, native_pixelscale in grids.values())
+
+    if (config.do_registration):
+        memory = max(shapes[image.filename][0] * shapes[image.filename][1] * itemsize + 2 * grids[image.filename][0]**2 * itemsize for image in images_with_headers)
+        steps.append(('register', num_images, registered_pixels, 2 * registered_pixels * itemsize, memory, registered_pixels / STEP_THROUGHPUT['register']))
+
+    if (config.do_convolution):
+        # With the fft method, the images sharing a registration grid are
+        # convolved together.
+        batches = {}
+        for image in images_with_headers:
+            batch_key = grids[image.filename]
+            if (config.convolution_method != 'fft'):
+                batch_key = batch_key + (image.filename,)
+            batches[batch_key] = batches.get(batch_key, 0) + 1
+        memory = get_scheduled_peak([estimate_unit_memory('convolve', (key[0], key[0]), config, (3, 3), batches[key]) for key in batches], config)
+        steps.append(('convolve', num_images, registered_pixels, registered_pixels * itemsize, memory, registered_pixels / STEP_THROUGHPUT['convolve']))
+
+    # The common grid of the resampling step, as created in
+    # resample_images().
+    if (fwhm_input != 0):
+        resampled_size = int(config.phys_size / (fwhm_input / NYQUIST_SAMPLING_RATE))
+    else:
+        resampled_size = 0
+    resampled_pixels = num_images * resampled_size**2
+    print("  FWHM: " + `fwhm_input` + "; resampled grid: " + `resampled_size` + "x" + `resampled_size` + " pixels")
+
+    if (config.do_resampling):
+        memory = max(size**2 for size, native_pixelscale in grids.values()) * itemsize + resampled_size**2 * itemsize
+        steps.append(('resample', num_images, resampled_pixels, (num_images + 1) * resampled_size**2 * itemsize, memory, resampled_pixels / STEP_THROUGHPUT['resample']))
+        # A pyramid adds at most a third of the size of the data cube.
+        if (config.pyramid):
+            pyramid_factor = 4. / 3
+        else:
+            pyramid_factor = 1.
+        steps.append(('datacube', 1, resampled_pixels, pyramid_factor * resampled_pixels * itemsize, 2 * resampled_pixels * itemsize, pyramid_factor * resampled_pixels / STEP_THROUGHPUT['datacube']))
+
+    if (config.do_seds):
+        num_seds = resampled_size**2
+        steps.append(('seds', num_seds, resampled_pixels, resampled_pixels * SED_POINT_BYTES[0] + num_seds * SED_PLOT_BYTES, resampled_pixels * SED_POINT_BYTES[1], num_seds * SED_PLOT_SECONDS))
+
+    return steps
+
+def plan_run(config):
+    """
+    Displays the sizes of the images produced by the requested steps, and
+    estimates of the disk space, peak memory and time they need, from the
+    headers of the input images only.
+
+    Parameters
+    ----------
+    config: Config
+        The parameters of the run.
+
+    Returns
+    -------
+    steps: list
+        A list of (step, number of images, pixels, disk bytes, peak memory
+        bytes, seconds) tuples.
+    """
+
+    targets = []
+    if (config.targets_file != ''):
+        targets = read_targets(config.targets_file)
+    # The sizes of the grids of these steps depend on the angular size.
+    if (targets == [] and config.phys_size == '' and (config.do_registration or config.do_convolution or config.do_resampling or config.do_seds)):
+        logger.error("Error: The angular_size parameter is needed to plan the registration, convolution, resampling and SED steps.")
+        sys.exit()
+    all_files = find_input_files(config)
+    target_boxes = get_target_boxes(all_files, targets, config)
+
+    images_with_headers = []
+    shapes = {}
+    for i in all_files:
+        for image in open_input_images(i, target_boxes, config):
+            shapes[image.filename] = image.shape[-2:]
+            images_with_headers.append(image)
+    images_with_headers = sorted(images_with_headers, key=lambda image: image.header['WAVELENG'])
+    print("Planning the processing of " + `len(images_with_headers)` + " images")
+
+    steps = []
+    if (config.do_conversion):
+        input_pixels = sum(shape[0] * shape[1] for shape in shapes.values())
+        memory = get_scheduled_peak([estimate_unit_memory('convert', shape, config) for shape in shapes.values()], config)
+        steps.append(('convert', len(shapes), input_pixels, input_pixels * np.dtype(config.precision).itemsize, memory, input_pixels / STEP_THROUGHPUT['convert']))
+
+    if (targets != []):
+        for name, ra, dec, angular_size in targets:
+            print("Target " + name + ":")
+            target_config = config.for_target(name, ra, dec, angular_size)
+            target_images = [image for image in images_with_headers if is_sufficient_coverage(get_coverage_fraction(image.header, shapes[image.filename][1], shapes[image.filename][0], ra, dec, angular_size), target_config)]
+            if (target_images == []):
+                print("  No images cover target " + name)
+                continue
+            for entry in plan_target_steps(target_images, shapes, target_config):
+                steps.append((entry[0] + " " + name,) + entry[1:])
+    elif (images_with_headers != [] and config.phys_size != ''):
+        steps.extend(plan_target_steps(images_with_headers, shapes, config))
+
+    if (config.compression != ''):
+        print("The images will be compressed, so they will use less disk space than shown.")
+    print("%-24s %8s %14s %12s %12s %10s" % ("Step", "Images", "Pixels", "Disk (MB)", "Memory (MB)", "Time (s)"))
+    for step, num_images, pixels, disk, memory, seconds in steps:
+        print("%-24s %8d %14d %12.1f %12.1f %10.0f" % (step, num_images, pixels, disk / 1024**2, memory / 1024**2, seconds))
+    if (steps != []):
+        print("%-24s %8s %14d %12.1f %12.1f %10.0f" % ("Total", "", sum(entry[2] for entry in steps), sum(entry[3] for entry in steps) / 1024**2, max(entry[4] for entry in steps) / 1024**2, sum(entry[5] for entry in steps)))
+    else:
+        print("No processing steps were requested.")
+    return steps
+
+def make_synthetic_images(directory, ra=10., dec=10., size=600., seed=0):
+    """
+    Writes synthetic MIPS images of a field of point sources, one for each
+    of the SYNTHETIC_BANDS, in MJy/sr.
+
+    Parameters
+    ----------
+    directory: string
+        The directory to write the images to.
+    ra, dec: float
+        The position (in degrees) of the centre of the field.
+    size: float
+        The size (in arcsec) of the field.
+    seed: int
+        The seed of the random number generator, which places the sources
+        and adds noise to the images.
+
+    Returns
+    -------
+    filenames: list
+        The names of the synthetic FITS files.
+    """
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    random = np.random.RandomState(seed)
+    # The sources are kept away from the edges of the field, so that all of
+    # their flux falls in all of the images.
+    num_sources = 20
+    source_x = random.uniform(-0.35, 0.35, num_sources) * size
+    source_y = random.uniform(-0.35, 0.35, num_sources) * size
+    source_flux = random.uniform(0.1, 1., num_sources)
+
+    filenames = []
+    for wavelength, pixelscale, fwhm in SYNTHETIC_BANDS:
+        num_pixels = int(size / pixelscale)
+        header = make_grid_header(num_pixels, pixelscale, ra, dec)
+        header['INSTRUME'] = 'MIPS'
+        header['WAVELENG'] = (wavelength, 'micron')
+        header['PLTSCALE'] = pixelscale
+        header['BUNIT'] = 'MJy/sr'
+        image_wcs = wcs.WCS(header)
+        x, y = image_wcs.wcs_world2pix(ra - source_x / 3600 / math.cos(math.radians(dec)), dec + source_y / 3600, 0)
+
+        # Each source is a gaussian of the band's FWHM, holding its flux
+        # (in Jy) whatever the pixelscale.
+        sigma = fwhm / (2 * math.sqrt(2 * math.log(2)) * pixelscale)
+        grid_y, grid_x = np.mgrid[0:num_pixels, 0:num_pixels]
+        data = np.zeros((num_pixels, num_pixels))
+        for j in range(0, num_sources):
+            data += source_flux[j] / (2 * math.pi * sigma**2) * np.exp(-((grid_x - x[j])**2 + (grid_y - y[j])**2) / (2 * sigma**2))
+        data /= MJY_PER_SR_TO_JY_PER_PIXEL * pixelscale**2
+        data += random.normal(0, 1e-3 * data.max(), data.shape)
+
+        filename = directory + '/synthetic_' + `int(wavelength)` + 'um.fits'
+        logger.info("Creating " + filename)
+        fits.PrimaryHDU(data, header).writeto(filename, clobber=True)
+        filenames.append(filename)
+    return filenames
+
+def get_image_offset(reference, image):
+    """
+    Measures the offset between two images of the same grid from the peak
+    of their cross-correlation.
+
+    Parameters
+    ----------
+    reference, image: numpy array
+        The images to compare. Pixels that are NaN in either image are
+        ignored.
+
+    Returns
+    -------
+    offset: tuple
+        The (y, x) offset (in pixels) of image relative to reference.
+    """
+
+    valid = np.isfinite(reference) & np.isfinite(image)
+    if (not valid.any()):
+        return (np.nan, np.nan)
+    a = np.where(valid, reference - reference[valid].mean(), 0)
+    b = np.where(valid, image - image[valid].mean(), 0)
+    correlation = np.fft.irfft2(np.fft.rfft2(b) * np.conj(np.fft.rfft2(a)), a.shape)
+    peak = np.unravel_index(np.argmax(correlation), correlation.shape)
+
+    # Refine the position of the peak with a parabola through it and its
+    # neighbours along each axis.
+    offset = []
+    for axis in (0, 1):
+        n = correlation.shape[axis]
+        before = list(peak)
+        before[axis] = (peak[axis] - 1) % n
+        after = list(peak)
+        after[axis] = (peak[axis] + 1) % n
+        c_before = correlation[tuple(before)]
+        c_peak = correlation[peak]
+        c_after = correlation[tuple(after)]
+        denominator = c_before - 2 * c_peak + c_after
+        shift = peak[axis]
+        if (denominator != 0):
+            shift += 0.5 * (c_before - c_after) / denominator
+        if (shift > n / 2):
+            shift -= n
+        offset.append(shift)
+    return tuple(offset)
+
+def compare_images(input_filename, reference_filename, candidate_filename):
+    """
+    Compares the outputs of one step produced by two backends from the
+    same input image.
+
+    Parameters
+    ----------
+    input_filename: string
+        The FITS file the step read.
+    reference_filename, candidate_filename: string
+        The FITS files written by the two backends.
+
+    Returns
+    -------
+    comparison: dict
+        The total flux of the input and of the two outputs, the relative
+        difference of the total flux of the outputs ('flux'), the largest
+        relative difference between the total flux of an output and that
+        of the input ('conservation'), the mean, RMS and largest per-pixel
+        differences relative to the peak of the reference ('mean',
+        'residual' and 'max') and the offset between the outputs in pixels
+        ('offset'). The values that cannot be computed (e.g. without any
+        flux, or without any pixel that is valid in both outputs) are NaN,
+        which exceeds any tolerance.
+    """
+
+    input_data = read_fits(input_filename)[0]
+    reference = np.asarray(read_fits(reference_filename)[0], dtype=np.float64)
+    candidate = np.asarray(read_fits(candidate_filename)[0], dtype=np.float64)
+
+    comparison = {}
+    comparison['input_flux'] = np.nansum(input_data)
+    comparison['reference_flux'] = np.nansum(reference)
+    comparison['candidate_flux'] = np.nansum(candidate)
+    if (comparison['reference_flux'] != 0):
+        comparison['flux'] = abs(comparison['candidate_flux'] - comparison['reference_flux']) / abs(comparison['reference_flux'])
+    else:
+        logger.warning("The reference " + reference_filename + " has no flux.")
+        comparison['flux'] = np.nan
+    if (comparison['input_flux'] != 0):
+        comparison['conservation'] = max(abs(comparison['reference_flux'] - comparison['input_flux']), abs(comparison['candidate_flux'] - comparison['input_flux'])) / abs(comparison['input_flux'])
+    else:
+        logger.warning("The input " + input_filename + " has no flux.")
+        comparison['conservation'] = np.nan
+
+    valid = np.isfinite(reference) & np.isfinite(candidate)
+    if (valid.any() and np.abs(reference[valid]).max() > 0):
+        residual = (candidate[valid] - reference[valid]) / np.abs(reference[valid]).max()
+        comparison['mean'] = residual.mean()
+        comparison['residual'] = np.sqrt(np.mean(residual**2))
+        comparison['max'] = np.abs(residual).max()
+    else:
+        logger.warning("The outputs " + reference_filename + " and " + candidate_filename + " have no valid pixels in common, or the reference is 0 on all of them.")
+        comparison['mean'] = comparison['residual'] = comparison['max'] = np.nan
+    dy, dx = get_image_offset(reference, candidate)
+    comparison['offset'] = math.sqrt(dy**2 + dx**2)
+    return comparison
+
+def compare_backends(config):
+    """
+    Runs the registration, convolution and resampling steps with the iraf
+    backend and direct convolution, and with the native backend and fft
+    convolution, and compares their outputs. Both runs of each step read
+    the same input files: the outputs of the previous step of the iraf run.
 
     Parameters
     ----------
-    images_with_headers: zipped list structure
-        A structure containing headers and image data for all FITS input
-        images.
-    keyword: string
-        The header keyword for which the mean value will be calculated.
+    config: Config
+        The parameters of the run.
 
     Returns
     -------
-    return_value: float
-        The mean of the values of the given header keyword for all images
-        with data from Herschel instruments.
+    failures: list
+        A list of (step, image, tolerance name, value) tuples for the
+        comparisons that exceeded their tolerance.
     """
 
-    print("get_herschel_mean(" + keyword + ")")
-    values = []
-    return_value = 0
-    for i in range(0, len(images_with_headers)):
-        instrument = get_instrument(images_with_headers[i][1])
-        if (instrument == 'PACS' or instrument == 'SPIRE'):
-            value = images_with_headers[i][1][keyword]
-            values.append(value)
-    return_value = np.mean(values)
-    return return_value
+    import shutil
 
-# NOTETOSELF: try to do this from the converted_data array first.
-# If that fails, then we can always just read in the _converted.fits files that were
-# also created by convert_images().
-# NOTETOSELF: Sophia told me that we need the single RA/dec value that gets used
-# later (in the resampling step, I believe) in this step as well.
-def register_images(images_with_headers):
+    if (config.phys_size == '' and config.directory != ''):
+        logger.error("Error: The angular_size parameter is needed with compare_backends.")
+        sys.exit()
+    temporary_directory = None
+    if (config.directory == ''):
+        config = copy.copy(config)
+        config.directory = temporary_directory = tempfile.mkdtemp()
+        config.phys_size = 600.
+        config.ra_input = 10.
+        config.dec_input = 10.
+        make_synthetic_images(config.directory, config.ra_input, config.dec_input, config.phys_size)
+
+    try:
+        return compare_backend_steps(config)
+    finally:
+        if (temporary_directory is not None):
+            shutil.rmtree(temporary_directory)
+
+def compare_backend_steps(config):
+    """
+    Runs the comparison of compare_backends() on the images of the
+    directory of the parameters.
     """
-    Registers all of the images to a common WCS
 
-    Parameters
-    ----------
-    images_with_headers: zipped list structure
-        A structure containing headers and image data for all FITS input
-        images.
+    import shutil
 
+    all_files = find_input_files(config)
+    decompress_inputs(all_files, config)
+    images_with_headers = read_images(all_files, [], config)
+    converted_images = convert_images(images_with_headers, config)
+
+    reference = copy.copy(config)
+    reference.target_name = 'compare_iraf'
+    reference.backend = 'iraf'
+    reference.convolution_method = 'direct'
+    reference.resume = False
+    candidate = copy.copy(reference)
+    candidate.target_name = 'compare_native'
+    candidate.backend = 'native'
+    candidate.convolution_method = 'fft'
+
+    failures = []
+    steps = [('register', register_images, 'converted', 'registered'), ('convolve', convolve_images, 'registered', 'convolved'), ('resample', resample_images, 'convolved', 'resampled')]
+    for step, function, input_step, output_step in steps:
+        if (input_step != 'converted'):
+            # Give both runs the same input files: those of the reference.
+            for image in converted_images:
+                original_filename = os.path.basename(image.filename)
+                original_directory = os.path.dirname(image.filename)
+                input_filename = get_target_directory(original_directory, reference) + "/" + input_step + "/" + original_filename + "_" + input_step + ".fits"
+                shutil.copy(input_filename, get_target_directory(original_directory, candidate) + "/" + input_step + "/")
+
+        times = []
+        for run_config in (reference, candidate):
+            start = time.time()
+            function(converted_images, run_config)
+            times.append(time.time() - start)
+        print(step + ": " + `round(times[0], 2)` + " s with " + reference.backend + "/" + reference.convolution_method + ", " + `round(times[1], 2)` + " s with " + candidate.backend + "/" + candidate.convolution_method)
+
+        for image in converted_images:
+            original_filename = os.path.basename(image.filename)
+            original_directory = os.path.dirname(image.filename)
+            if (input_step == 'converted'):
+                input_filename = original_directory + "/converted/" + original_filename + "_converted.fits"
+            else:
+                input_filename = get_target_directory(original_directory, reference) + "/" + input_step + "/" + original_filename + "_" + input_step + ".fits"
+            output_filenames = [get_target_directory(original_directory, run_config) + "/" + output_step + "/" + original_filename + "_" + output_step + ".fits" for run_config in (reference, candidate)]
+            comparison = compare_images(input_filename, output_filenames[0], output_filenames[1])
+            print("  " + original_filename + ": flux " + `comparison['input_flux']` + " -> " + `comparison['reference_flux']` + " / " + `comparison['candidate_flux']` + " (conservation " + `comparison['conservation']` + "); residual mean " + `comparison['mean']` + ", RMS " + `comparison['residual']` + ", max " + `comparison['max']` + "; offset " + `comparison['offset']` + " pixels")
+            for name in sorted(config.tolerances):
+                if (not comparison[name] <= config.tolerances[name]):
+                    failures.append((step, original_filename, name, comparison[name]))
+
+    for step, filename, name, value in failures:
+        logger.warning("Tolerance exceeded: " + step + " " + filename + " " + name + " = " + `value` + " > " + `config.tolerances[name]`)
+    if (failures == []):
+        print("All of the comparisons are within the tolerances.")
+    return failures
+
+class Pipeline(object):
     """
+    Runs the imagecube processing steps with a given set of parameters.
+    This is what the command line script uses, and it can also be used
+    from other Python code, e.g.
 
-    print("Registering images")
-    print("phys_size: " + `phys_size`)
+        pipeline = Pipeline(Config(directory='ngc1569', phys_size=300.))
+        images = pipeline.read_images()
+        converted = pipeline.convert(images)
+        registered = pipeline.register(converted)
 
-    if (ra_input != ''):
-        lngref_input = ra_input
-    else:
-        lngref_input = get_herschel_mean(images_with_headers, 'CRVAL1')
+    Each step takes the image records returned by the previous one (or by
+    read_images()) and returns new records for its own output. As all of
+    the parameters are held by the pipeline's Config, several pipelines
+    can be used in the same process.
 
-    if (dec_input != ''):
-        latref_input = dec_input
-    else:
-        latref_input = get_herschel_mean(images_with_headers, 'CRVAL2')
+    Parameters
+    ----------
+    config: Config
+        The parameters of the run.
 
-    for i in range(0, len(images_with_headers)):
+    """
 
-        native_pixelscale = get_native_pixelscale(images_with_headers[i][1], get_instrument(images_with_headers[i][1]))
-        print("Native pixel scale: " + `native_pixelscale`)
-        print("Instrument: " + `get_instrument(images_with_headers[i][1])`)
-        print("BUNIT: " + `images_with_headers[i][1]['BUNIT']`)
+    def __init__(self, config):
+        self.config = config
 
-        original_filename = os.path.basename(images_with_headers[i][2])
-        original_directory = os.path.dirname(images_with_headers[i][2])
-        new_directory = original_directory + "/registered/"
-        artificial_filename = new_directory + original_filename + "_pixelgrid.fits"
-        registered_filename = new_directory + original_filename  + "_registered.fits"
-        input_directory = original_directory + "/converted/"
-        input_filename = input_directory + original_filename  + "_converted.fits"
-        print("Artificial filename: " + artificial_filename)
-        print("Registered filename: " + registered_filename)
-        print("Input filename: " + input_filename)
-        if not os.path.exists(new_directory):
-            os.makedirs(new_directory)
+    def read_images(self, all_files=None, targets=None):
+        """
+        Reads the input images; see read_images(). If all_files is not
+        given, the input files are found with find_input_files().
+        """
 
-        # First we create an artificial fits image
-        # unlearn some iraf tasks
-        iraf.unlearn('mkpattern')
+        if (all_files is None):
+            all_files = find_input_files(self.config)
+        if (targets is None):
+            targets = []
+        decompress_inputs(all_files, self.config)
+        return read_images(all_files, get_target_boxes(all_files, targets, self.config), self.config)
 
-        # create an artificial image to which we will register the FITS image.
-        artdata.mkpattern(input=artificial_filename, output=artificial_filename, pattern="constant", pixtype="double", ndim=2, ncols=phys_size/native_pixelscale, nlines=phys_size/native_pixelscale)
-        #note that in the exact above line, the "ncols" and "nlines" should be wisely chosen, depending on the input images - they provide the pixel-grid 
-        #for each input fits image, we will create the corresponding artificial one - therefore we can tune these values such that we cover, for instance, XXarcsecs of the target - so the best is that user provides us with such a value
+    def convert(self, images_with_headers):
+        return convert_images(images_with_headers, self.config)
 
-        # Then, we tag the desired WCS in this fake image:
-        # unlearn some iraf tasks
-        iraf.unlearn('ccsetwcs')
+    def register(self, images_with_headers):
+        return register_images(images_with_headers, self.config)
 
-        # tag the desired WCS in the artificial image.
-        iraf.ccsetwcs(images=artificial_filename, database="", solution="", xref=(phys_size/native_pixelscale)/2, yref=(phys_size/native_pixelscale)/2, xmag=native_pixelscale, ymag=native_pixelscale, xrotati=0.,yrotati=0.,lngref=lngref_input, latref=latref_input, lngunit="degrees", latunit="degrees", transpo="no", project="tan", coosyst="j2000", update="yes", pixsyst="logical", verbose="yes")
-        #note that the "xref" and "yref" are actually half the above "ncols", "nlines", respectively, so that we center each image
-        #note also that "xmag" and "ymag" is the pixel-scale, which in the current step ought to be the same as the native pixel-scale of the input image, for each input image - so we check the corresponding header value in each image
-        #note that "lngref" and "latref" can be grabbed by the fits header, it is actually the center of the target (e.g. ngc1569)
-        #note that we should make sure that the coordinate system is in coosyst="j2000" by checking the header info, otherwise we need to adjust that
+    def convolve(self, images_with_headers):
+        return convolve_images(images_with_headers, self.config)
 
-        # Then, register the fits file of interest to the WCS of the fake fits file
-        # unlearn some iraf tasks
-        iraf.unlearn('wregister')
+    def resample(self, images_with_headers):
+        return resample_images(images_with_headers, self.config)
 
-        # register the science fits image
-        iraf.wregister(input=input_filename, reference=artificial_filename, output=registered_filename, fluxconserve="no")
+    def create_data_cube(self, images_with_headers):
+        return create_data_cube(images_with_headers, self.config)
 
-# NOTETOSELF: This function requires a PSF kernel. Not sure where it should go, but
-# here it is just in case we still need it. It is NOT ready to be run yet.
-def convolve_images_psf(images_with_headers):
-    print("Convolving images (not implemented yet)")
+    def output_seds(self, images_with_headers):
+        return output_seds(images_with_headers, self.config)
 
-    for i in range(0, len(images_with_headers)):
+    def output_region_seds(self, images_with_headers):
+        return output_region_seds(images_with_headers, self.config)
 
-        original_filename = os.path.basename(images_with_headers[i][2])
-        original_directory = os.path.dirname(images_with_headers[i][2])
-        new_directory = original_directory + "/convolved/"
-        #artificial_filename = new_directory + original_filename + "_pixelgrid.fits"
-        #registered_filename = new_directory + original_filename  + "_registered.fits"
-        input_directory = original_directory + "/registered/"
-        input_filename = input_directory + original_filename  + "_registered.fits"
-        print("Artificial filename: " + artificial_filename)
-        print("Registered filename: " + registered_filename)
-        print("Input filename: " + input_filename)
-        if not os.path.exists(new_directory):
-            os.makedirs(new_directory)
+    def run(self):
+        """
+        Reads the input images and runs the processing steps that were
+        requested with the parameters.
+        """
 
-        #reading the science image:
-        science_image = fits.getdata(input_filename)
+        config = self.config
 
-        # if using a kernel image, then we first regrid the kernel to the same as in the science image, and we re-center the kernel:
+        if (config.do_cleanup):
+            cleanup_output_files(config)
+            return
 
-        # create a fake image "apixel_kernel.fits"
-        # the original kernel has a grid of 3645*3645 pixels and centered at (1822, 1822)
-        # ncols = nlines = initial_number_of_rows * initial_pixelsize_of_the_kernel  / science_image_pixelsize
-        # in the current case: 3645* 0.25 (arcsecs per pixel) / 2 (arcsecs per pixel) = 455.62
-        artdata.mkpattern(input="apixel_kernel.fits", output="apixel_kernel.fits", pattern="constant", option="replace",v1=0., v2=1., size=1, title="", pixtype="real", ndim=2, ncols=455,nlines=455,n3=1, n4=1, n5=1, n6=1, n7=1, header="")
+        if (config.build_catalog_directory != ''):
+            build_catalog(config.build_catalog_directory, config.catalog_file, config.calibrations)
+            return
 
-        #Then, tag the desired WCS in this fake image:
-        #
-        # unlearn some iraf tasks
-        iraf.unlearn('ccsetwcs')
-        #xref = yref = ncols/2 = nlines/2
-        #xmag, ymag = pixel scale of science image
-        iraf.ccsetwcs(images="apixel_kernel.fits", database="", solution="", xref=227.5, yref=227.5, xmag=2, ymag=2, xrotati=0.,yrotati=0.,lngref=0, latref=0, lngunit="hours", latunit="degrees", transpo="no", project="tan", coosyst="j2000", update="yes", pixsyst="logical", verbose="yes")
+        if (config.plan):
+            plan_run(config)
+            return
 
-        # Then, register the fits file of interest to the WCS of the fake fits file
-        #
-        # unlearn some iraf tasks
-        iraf.unlearn('wregister')
+        if (config.synthetic_directory != ''):
+            make_synthetic_images(config.synthetic_directory)
+            return
 
-        iraf.wregister(input="Kernel_HiRes_PACS_70_to_SPIRE_500.fits", reference="apixel_kernel.fits", output="Kernel_P70_2_S500.fits", fluxconserve="yes")
+        if (config.compare_backends):
+            if (compare_backends(config) != []):
+                sys.exit(1)
+            return
 
-        # then we get the data from the kernel
-        kernel_image = pyfits.getdata('Kernel_P70_2_S500.fits')
+        if (config.add_band_file != ''):
+            add_band(config.add_band_file, config)
+            return
 
-        #several ways to do the convolution, but is best to use number 3 or 4:
+        if (config.query != ''):
+            output_sed_query(config)
+            return
 
-        #3. 
-        result3 = astropy.nddata.convolution.convolve.convolve(science_image, kernel_image) # got a segmentation fault - it needs an odd number of columns/rows for the kernel
-        pyfits.writeto('science_image_convolved_3.fits',result3)
+        if (config.queue_status):
+            print_queue_status(config)
+            return
 
-        #4. 
-        result4 = astropy.nddata.convolution.convolve.convolve_fft(science_image,kernel_image) # worked OK - was the fastest thus far
-        pyfits.writeto('science_image_convolved_4.fits',result4) 
+        if (config.check_queue):
+            if (check_queue_workers(config) != []):
+                sys.exit(1)
+            return
 
-def convolve_images(images_with_headers):
-    """
-    Convolves all of the images to a common resolution using a simple
-    gaussian kernel.
+        if (config.enqueue):
+            enqueue_units(config)
+            return
 
-    Parameters
-    ----------
-    images_with_headers: zipped list structure
-        A structure containing headers and image data for all FITS input
-        images.
+        if (config.worker):
+            if (run_queue_workers(config) > 0):
+                sys.exit(1)
+            return
 
-    """
+        if (not config.resume):
+            reset_run_state(config)
 
-    print("Convolving images")
-    fwhm_input = get_fwhm_value(images_with_headers)
-    print("fwhm_input = " + `fwhm_input`)
+        targets = []
+        if (config.targets_file != ''):
+            targets = read_targets(config.targets_file)
 
-    for i in range(0, len(images_with_headers)):
+        images_with_headers = self.read_images(targets=targets)
 
-        native_pixelscale = get_native_pixelscale(images_with_headers[i][1], get_instrument(images_with_headers[i][1]))
-        sigma_input = fwhm_input / (2* math.sqrt(2*math.log (2) ) * native_pixelscale)
-        print("Native pixel scale: " + `native_pixelscale`)
-        print("Instrument: " + `get_instrument(images_with_headers[i][1])`)
+        #if (config.conversion_factors):
+            #output_conversion_factors(images_with_headers, config.calibrations)
 
-        original_filename = os.path.basename(images_with_headers[i][2])
-        original_directory = os.path.dirname(images_with_headers[i][2])
-        new_directory = original_directory + "/convolved/"
-        convolved_filename = new_directory + original_filename  + "_convolved.fits"
-        input_directory = original_directory + "/registered/"
-        input_filename = input_directory + original_filename  + "_registered.fits"
-        print("Convolved filename: " + convolved_filename)
-        print("Input filename: " + input_filename)
-        if not os.path.exists(new_directory):
-            os.makedirs(new_directory)
+        if (config.do_conversion):
+            self.convert(images_with_headers)
 
-        # NOTETOSELF: there has been a loss of data from the data cubes at an earlier
-        # step. The presence of 'EXTEND' and 'DSETS___' keywords in the header no
-        # longer means that there is any data in hdulist[1].data. I am using a
-        # workaround for now, but this needs to be looked at.
-        hdulist = fits.open(input_filename)
-        header = hdulist[0].header
-        image_data = hdulist[0].data
-        #if ('EXTEND' in header and 'DSETS___' in header):
-            #image_data = hdulist[1].data
-        #else:
-            #image_data = hdulist[0].data
-        hdulist.close()
+        # With a list of targets, the images read and converted above are shared
+        # by all of the targets; only the remaining steps are run per target.
+        if (config.targets_file != ''):
+            process_targets(images_with_headers, targets, config)
+            return
 
-        gaus_kernel_inp = make_kernel([3,3], kernelwidth=sigma_input, kerneltype='gaussian', trapslope=None, force_odd=True)
+        if (config.do_registration):
+            self.register(images_with_headers)
 
-        # Do the convolution and save it as a new .fits file
-        conv_result = convolve(image_data, gaus_kernel_inp)
-        header['FWHM'] = (fwhm_input, 'The FWHM value used in the convolution step.')
+        if (config.do_convolution):
+            self.convolve(images_with_headers)
 
-        hdu = fits.PrimaryHDU(conv_result, header)
-        print("Creating " + convolved_filename)
-        hdu.writeto(convolved_filename, clobber=True)
+        if (config.do_resampling):
+            self.resample(images_with_headers)
 
-def create_data_cube(images_with_headers):
-    """
-    Creates a data cube from the provided images.
+        if (config.do_seds):
+            self.output_seds(images_with_headers)
 
+        if (config.regions_file != ''):
+            self.output_region_seds(images_with_headers)
+
+def open_queue(queue_filename):
+    """
+    Opens the SQLite file of a work queue, creating its tables if needed.
+    Transactions are started explicitly, so that a unit is claimed by a
+    single worker.
 
     Parameters
     ----------
-    images_with_headers: zipped list structure
-        A structure containing headers and image data for all FITS input
-        images.
+    queue_filename: string
+        The name of the queue file.
 
-    Notes
-    -----
-    Currently we are just using the header of the first input image.
-    This should be changed to something more appropriate.
+    Returns
+    -------
+    connection: sqlite3.Connection
+        The connection to the queue.
     """
-    print("Creating a data cube.")
-    resampled_images = []
-    resampled_headers = []
 
-    new_directory = directory + "/datacube/"
-    print("New directory: " + new_directory)
-    if not os.path.exists(new_directory):
-        os.makedirs(new_directory)
+    connection = sqlite3.connect(queue_filename, timeout=60, isolation_level=None)
+    connection.execute("CREATE TABLE IF NOT EXISTS units (id INTEGER PRIMARY KEY, target TEXT, images TEXT, stage TEXT, arguments TEXT, status TEXT, attempts INTEGER, max_attempts INTEGER, worker TEXT, lease_expires REAL, started REAL, finished REAL, duration REAL, error TEXT)")
+    connection.execute("CREATE TABLE IF NOT EXISTS dependencies (unit INTEGER, depends_on INTEGER)")
+    connection.execute("CREATE INDEX IF NOT EXISTS units_status ON units (status)")
+    connection.execute("CREATE INDEX IF NOT EXISTS dependencies_unit ON dependencies (unit)")
+    return connection
 
-    for i in range(0, len(images_with_headers)):
-        original_filename = os.path.basename(images_with_headers[i][2])
-        original_directory = os.path.dirname(images_with_headers[i][2])
-        resampled_filename = original_directory + "/resampled/" + original_filename  + "_resampled.fits"
-
-        hdulist = fits.open(resampled_filename)
-        header = hdulist[0].header
-        resampled_headers.append(header)
-        image = hdulist[0].data
-        resampled_images.append(image)
-        hdulist.close()
+def get_unique_filenames(input_images):
+    """
+    Returns the names of the input files of a list of (filename, image,
+    naxis1, naxis2) tuples, once each, in the order of the list.
+    """
 
-    fits.writeto(new_directory + '/' + 'datacube.fits', np.copy(resampled_images), resampled_headers[0], clobber=True)
+    filenames = []
+    for image in input_images:
+        if (image[0] not in filenames):
+            filenames.append(image[0])
+    return filenames
 
-def resample_images(images_with_headers):
+def enqueue_units(config):
     """
-    Resamples all of the images to a common pixel grid.
+    Splits the run described by the parameters into units and adds them to
+    the work queue, with their dependencies (see the queue parameter).
 
     Parameters
     ----------
-    images_with_headers: zipped list structure
-        A structure containing headers and image data for all FITS input
-        images.
+    config: Config
+        The parameters of the run.
 
+    Returns
+    -------
+    num_units: int
+        The number of units added to the queue.
     """
 
-    print("Resampling images.")
+    all_files = find_input_files(config)
+    decompress_inputs(all_files, config)
+    targets = []
+    if (config.targets_file != ''):
+        targets = read_targets(config.targets_file)
+
+    # Only the headers are needed to split the run.
+    target_boxes = get_target_boxes(all_files, targets, config)
+    input_images = []
+    for filename in all_files:
+        for image in open_input_images(filename, target_boxes, config):
+            input_images.append((filename, image, image.shape[-1], image.shape[-2]))
+    input_images.sort(key=lambda image: image[1].header['WAVELENG'])
+
+    connection = open_queue(config.queue_file)
+    connection.execute("BEGIN IMMEDIATE")
+
+    def add_unit(target, filenames, stage, arguments, dependencies):
+        unit_id = connection.execute("INSERT INTO units (target, images, stage, arguments, status, attempts, max_attempts) VALUES (?, ?, ?, ?, 'pending', 0, ?)", (json.dumps(target), json.dumps(filenames), stage, json.dumps(arguments), config.max_attempts)).lastrowid
+        connection.executemany("INSERT INTO dependencies VALUES (?, ?)", [(unit_id, d) for d in dependencies])
+        return unit_id
+
+    convert_units = {}
+    if (config.do_conversion):
+        # The images of an input file holding several of them are processed
+        # by the same units.
+        for filename in get_unique_filenames(input_images):
+            convert_units[filename] = add_unit(None, [filename], 'convert', config.arguments, [])
+
+    if (targets == []):
+        targets = [None]
+    for target in targets:
+        if (target is None):
+            target_config = config
+            target_images = input_images
+        else:
+            name, ra, dec, angular_size = target
+            target_config = config.for_target(name, ra, dec, angular_size)
+            target_images = [image for image in input_images if is_sufficient_coverage(get_coverage_fraction(image[1].header, image[2], image[3], ra, dec, angular_size), target_config)]
+            if (target_images == []):
+                logger.info("No images cover target " + name)
+                continue
+
+        # The parameters that depend on all of the images of the target are
+        # determined here, as each unit only sees its own image.
+        arguments = list(config.arguments)
+        if (target_config.do_convolution or target_config.do_resampling):
+            arguments += ['--fwhm', `get_common_fwhm([image[1] for image in target_images], target_config)`]
+        if (target is None and (config.do_registration or config.do_resampling)):
+            lngref_input, latref_input = get_target_center([image[1] for image in target_images], target_config)
+            # Without Herschel images, the centre is not defined, and every
+            # unit would fail on it.
+            if (np.isnan(lngref_input) or np.isnan(latref_input)):
+                connection.execute("ROLLBACK")
+                connection.close()
+                logger.error("Error: The centre of the target cannot be determined from the images; give it with the ra and dec parameters.")
+                sys.exit()
+            arguments += ['--ra', `lngref_input`, '--dec', `latref_input`]
+
+        last_units = []
+        for filename in get_unique_filenames(target_images):
+            last_unit = convert_units.get(filename)
+            for stage, enabled in (('register', config.do_registration), ('convolve', config.do_convolution), ('resample', config.do_resampling)):
+                if (enabled):
+                    last_unit = add_unit(target, [filename], stage, arguments, [last_unit] if last_unit is not None else [])
+            if (last_unit is not None):
+                last_units.append(last_unit)
+
+        filenames = get_unique_filenames(target_images)
+        if (config.do_resampling):
+            last_units = [add_unit(target, filenames, 'datacube', arguments, last_units)]
+        if (config.do_seds):
+            add_unit(target, filenames, 'seds', arguments, last_units)
+        if (config.regions_file != ''):
+            add_unit(target, filenames, 'regions', arguments, last_units)
+
+    num_units = connection.execute("SELECT COUNT(*) FROM units WHERE status = 'pending'").fetchone()[0]
+    connection.execute("COMMIT")
+    connection.close()
+    logger.info(`num_units` + " units are waiting in the queue " + config.queue_file)
+    return num_units
+
+def claim_unit(connection, worker, lease_seconds):
+    """
+    Claims the oldest pending unit of the work queue whose dependencies are
+    done. Units whose lease has expired are made pending again (or failed,
+    after their last attempt), and units that depend on a failed unit are
+    marked as failed.
 
-    # First we create an artificial fits image, 
-    # The difference with the registration step is that the artificial image is now created only once, and it is common for all the input_images_convolved (or imput_images_gaussian_convolved)
-    # unlearn some iraf tasks
-    iraf.unlearn('mkpattern')
-    
-    # create a fake image "grid_final_resample.fits", to which we will register all fits images
-    fwhm_input = get_fwhm_value(images_with_headers)
-    print("fwhm: " + `fwhm_input`)
-    # parameter1 & parameter2 depend on the "fwhm" of the convolution step, and following the Nyquist sampling rate. 
-    parameter1 = phys_size / (fwhm_input / NYQUIST_SAMPLING_RATE) 
-    print("ncols, nlines: " + `parameter1`)
-    parameter2 = parameter1
-    artdata.mkpattern(input="grid_final_resample.fits", output="grid_final_resample.fits", pattern="constant", pixtype="double", ndim=2, ncols=parameter1, nlines=parameter2)
+    Parameters
+    ----------
+    connection: sqlite3.Connection
+        The connection to the queue, as returned by open_queue().
+    worker: string
+        The name of the worker.
+    lease_seconds: float
+        The duration of the lease.
 
-    if (ra_input != ''):
-        lngref_input = ra_input
-    else:
-        lngref_input = get_herschel_mean(images_with_headers, 'CRVAL1')
-    if (dec_input != ''):
-        latref_input = dec_input
-    else:
-        latref_input = get_herschel_mean(images_with_headers, 'CRVAL2')
-    
-    # Then, we tag the desired WCS in this fake image:
-    # unlearn some iraf tasks
-    iraf.unlearn('ccsetwcs')
+    Returns
+    -------
+    unit: tuple
+        The (id, target, images, stage, arguments) of the claimed unit, or
+        None if no unit can be run now.
+    """
 
-    # tag the desired WCS in the fake image "apixel.fits"
-    # NOTETOSELF: in the code Sophia gave me, lngunit was given as "hours", but I have
-    # changed it to "degrees".
-    iraf.ccsetwcs(images="grid_final_resample.fits", database="", solution="", xref=parameter1/2, yref=parameter2/2, xmag=fwhm_input/NYQUIST_SAMPLING_RATE, ymag=fwhm_input/NYQUIST_SAMPLING_RATE, xrotati=0.,yrotati=0.,lngref=lngref_input, latref=latref_input, lngunit="degrees", latunit="degrees", transpo="no", project="tan", coosyst="j2000", update="yes", pixsyst="logical", verbose="yes")
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    connection.execute("UPDATE units SET status = CASE WHEN attempts < max_attempts THEN 'pending' ELSE 'failed' END, error = 'the lease of ' || worker || ' expired' WHERE status = 'running' AND lease_expires < ?", (now,))
+    while (connection.execute("UPDATE units SET status = 'failed', error = 'a dependency failed' WHERE status = 'pending' AND id IN (SELECT d.unit FROM dependencies d JOIN units u ON u.id = d.depends_on WHERE u.status = 'failed')").rowcount > 0):
+        pass
+    unit = connection.execute("SELECT id, target, images, stage, arguments FROM units WHERE status = 'pending' AND NOT EXISTS (SELECT 1 FROM dependencies d JOIN units u ON u.id = d.depends_on WHERE d.unit = units.id AND u.status != 'done') ORDER BY id LIMIT 1").fetchone()
+    if (unit is not None):
+        connection.execute("UPDATE units SET status = 'running', worker = ?, lease_expires = ?, attempts = attempts + 1, started = ? WHERE id = ?", (worker, now + lease_seconds, now, unit[0]))
+    connection.execute("COMMIT")
+    return unit
+
+def run_unit(arguments, target, filenames, stage):
+    """
+    Runs a unit of the work queue.
 
-    for i in range(0, len(images_with_headers)):
-        original_filename = os.path.basename(images_with_headers[i][2])
-        original_directory = os.path.dirname(images_with_headers[i][2])
-        new_directory = original_directory + "/resampled/"
-        resampled_filename = new_directory + original_filename  + "_resampled.fits"
-        input_directory = original_directory + "/convolved/"
-        input_filename = input_directory + original_filename  + "_convolved.fits"
-        print("Resampled filename: " + resampled_filename)
-        print("Input filename: " + input_filename)
-        if not os.path.exists(new_directory):
-            os.makedirs(new_directory)
+    Parameters
+    ----------
+    arguments: list
+        The parameters of the run.
+    target: list
+        The (name, ra, dec, angular_size) of the target, or None.
+    filenames: list
+        The input files of the unit: a single image for the stages that are
+        run for each image, all of the images of the target otherwise.
+    stage: string
+        The stage of the unit, among QUEUE_STAGES.
 
-        # Then, register the fits file of interest to the WCS of the fake fits file
-        # unlearn some iraf tasks
-        iraf.unlearn('wregister')
+    """
+
+    config = parse_command_line(arguments)
+    if (target is not None):
+        config = config.for_target(*target)
+    if (stage == 'convert'):
+        convert_images(read_images(filenames, [], config), config)
+        return
+
+    images_with_headers = []
+    for filename in filenames:
+        images_with_headers += open_input_images(filename, [], config)
+    images_with_headers.sort(key=lambda image: image.header['WAVELENG'])
+    if (stage == 'register'):
+        register_images(images_with_headers, config)
+    elif (stage == 'convolve'):
+        convolve_images(images_with_headers, config)
+    elif (stage == 'resample'):
+        resample_images(images_with_headers, config, create_cube=False)
+    elif (stage == 'datacube'):
+        create_data_cube(images_with_headers, config)
+    elif (stage == 'seds'):
+        output_seds(images_with_headers, config)
+    elif (stage == 'regions'):
+        output_region_seds(images_with_headers, config)
+
+def run_queue_worker(config, worker):
+    """
+    Claims and runs units of the work queue until none are left to run.
+    While a unit runs, its lease is renewed in the background.
+
+    Parameters
+    ----------
+    config: Config
+        The parameters of the worker.
+    worker: string
+        The name of the worker.
 
-        # register the science fits image
-        iraf.wregister(input=input_filename, reference="grid_final_resample.fits", output=resampled_filename, fluxconserve="yes")
+    """
 
-    create_data_cube(images_with_headers)
+    connection = open_queue(config.queue_file)
+    while True:
+        unit = claim_unit(connection, worker, config.lease_seconds)
+        if (unit is None):
+            if (connection.execute("SELECT COUNT(*) FROM units WHERE status IN ('pending', 'running')").fetchone()[0] == 0):
+                break
+            time.sleep(QUEUE_POLL_SECONDS)
+            continue
+
+        unit_id, target, filenames, stage, arguments = unit
+        logger.info(worker + ": running unit " + `unit_id` + " (" + stage + " of " + ', '.join(os.path.basename(f) for f in json.loads(filenames)) + ")")
+        finished = threading.Event()
+
+        def renew_lease():
+            lease_connection = open_queue(config.queue_file)
+            while (not finished.wait(config.lease_seconds / 3)):
+                lease_connection.execute("UPDATE units SET lease_expires = ? WHERE id = ? AND worker = ?", (time.time() + config.lease_seconds, unit_id, worker))
+            lease_connection.close()
+
+        lease_thread = threading.Thread(target=renew_lease)
+        lease_thread.daemon = True
+        lease_thread.start()
+        start = time.time()
+        exit_code = run_in_child(run_unit, json.loads(arguments), json.loads(target), json.loads(filenames), stage)
+        finished.set()
+        lease_thread.join()
+
+        duration = time.time() - start
+        if (exit_code == 0):
+            connection.execute("UPDATE units SET status = 'done', finished = ?, duration = ?, error = NULL WHERE id = ? AND worker = ?", (time.time(), duration, unit_id, worker))
+        else:
+            logger.warning(worker + ": unit " + `unit_id` + " failed with exit status " + `exit_code`)
+            connection.execute("UPDATE units SET status = CASE WHEN attempts < max_attempts THEN 'pending' ELSE 'failed' END, finished = ?, duration = ?, error = ? WHERE id = ? AND worker = ?", (time.time(), duration, "exit status " + `exit_code`, unit_id, worker))
+    connection.close()
 
-def output_seds(images_with_headers):
+def run_queue_workers(config):
     """
-    Makes the SEDs.
+    Runs max_jobs workers of the work queue in this process, until no units
+    are left to run.
 
     Parameters
     ----------
-    images_with_headers: zipped list structure
-        A structure containing headers and image data for all FITS input
-        images.
+    config: Config
+        The parameters of the workers.
 
+    Returns
+    -------
+    num_failed: int
+        The number of units of the queue that have failed.
     """
 
-    #print("Outputting SEDs.")
+    name = socket.gethostname() + ":" + `os.getpid()`
+    workers = [threading.Thread(target=run_queue_worker, args=(config, name + ":" + `i`)) for i in range(0, config.max_jobs)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    connection = open_queue(config.queue_file)
+    num_failed = connection.execute("SELECT COUNT(*) FROM units WHERE status = 'failed'").fetchone()[0]
+    connection.close()
+    return num_failed
+
+def print_queue_status(config):
+    """
+    Displays the number of units of the work queue in each state, with
+    their mean and total run times, for each stage.
 
-    all_image_data = []
-    wavelengths = []
+    Parameters
+    ----------
+    config: Config
+        The parameters of the run.
 
-    num_wavelengths = len(images_with_headers)
+    """
 
-    for i in range(0, num_wavelengths):
-        original_filename = os.path.basename(images_with_headers[i][2])
-        original_directory = os.path.dirname(images_with_headers[i][2])
-        new_directory = original_directory + "/seds/"
-        input_directory = original_directory + "/resampled/"
-        input_filename = input_directory + original_filename  + "_resampled.fits"
-        wavelength = get_wavelength(images_with_headers[i][1])[0]
-        wavelengths.append(wavelength)
-        #print("Input filename: " + input_filename)
-        if not os.path.exists(new_directory):
-            os.makedirs(new_directory)
+    connection = open_queue(config.queue_file)
+    rows = connection.execute("SELECT stage, status, COUNT(*), AVG(duration), SUM(duration), SUM(attempts) FROM units GROUP BY stage, status").fetchall()
+    print("%-10s %-8s %6s %10s %10s %9s" % ("stage", "status", "units", "mean (s)", "total (s)", "attempts"))
+    for stage, status, count, mean_duration, total_duration, attempts in sorted(rows, key=lambda row: (QUEUE_STAGES.index(row[0]), row[1])):
+        print("%-10s %-8s %6d %10.2f %10.2f %9d" % (stage, status, count, mean_duration or 0, total_duration or 0, attempts))
+    for unit_id, stage, filenames, error in connection.execute("SELECT id, stage, images, error FROM units WHERE status = 'failed' ORDER BY id"):
+        print("Unit " + `unit_id` + " (" + stage + " of " + ', '.join(os.path.basename(f) for f in json.loads(filenames)) + ") failed: " + str(error))
+    connection.close()
 
-        # Load the data for each image and append it to a master list of
-        # all image data.
-        hdulist = fits.open(input_filename)
-        image_data = hdulist[0].data
-        all_image_data.append(image_data)
-        hdulist.close()
+def check_queue_workers(config):
+    """
+    Runs the conversion, registration, convolution and resampling steps on
+    synthetic images through a work queue with several workers, and checks
+    that every unit succeeded on its first attempt. A unit that only
+    succeeds when it is tried again points to workers getting in each
+    other's way, e.g. through the files they share.
 
-    sed_data = []
+    Parameters
+    ----------
+    config: Config
+        The parameters of the check; at least 8 workers are run, or
+        max_jobs if it is larger.
 
-    for i in range(0, num_wavelengths):
-        #print(`wavelengths[i]`)
-        for j in range(len(all_image_data[i])):
-            for k in range(len(all_image_data[i][j])):
-                sed_data.append((int(j), int(k), wavelengths[i], all_image_data[i][j][k]))
-                #print("(" + `j` + "," + `k` + ")" + '\t' + `all_image_data[i][j][k]` + ' ' + `wavelengths[i]`)
+    Returns
+    -------
+    failures: list
+        The (id, stage, images, status, attempts, error) of the units that
+        did not succeed on their first attempt.
+    """
 
-    #print(`sorted(sed_data)`)
-    data = np.copy(sorted(sed_data))
-    #np.savetxt('test.out', data, delimiter=',')
-    np.savetxt('test.out', data, fmt='%d,%d,%f,%f', header='x, y, wavelength (um), flux units (Jy/pixel)')
-    #print("len(data): " + `len(data)`)
-    num_seds = int(len(data) / num_wavelengths)
-    #print("Number of SEDs to create: " + `num_seds`)
-    # just the wavelengths:
-    #print(`data[:,2]`)
-    # just the z-values:
-    #print(`data[:,3]`)
-    # for one wavelength:
-    #print(`data[:,2][0:num_wavelengths]`)
-    #print(`data[:,3][0:num_wavelengths]`)
+    import shutil
 
-    # for all wavelengths:
-    with console.ProgressBarOrSpinner(num_seds, "Creating SEDs") as bar:
-        for i in range(0, num_seds):
-        #for i in range(0, 5):
-            #print(`i`)
-
-            # change to the desired fonts
-            rc('font', family='Times New Roman')
-            rc('text', usetex=True)
-            
-            # wavelength
-            #a = data[:,2] 								
-            wavelength_values = data[:,2][i*num_wavelengths:(i+1)*num_wavelengths]
-            # flux
-            #b = data[:,1]/1e20							
-            #b = data[:,2]
-            flux_values = data[:,3][i*num_wavelengths:(i+1)*num_wavelengths]
-            #b = data[:,3][i:i+num_wavelengths]
-            x_values = data[:,0][i*num_wavelengths:(i+1)*num_wavelengths]
-            y_values = data[:,1][i*num_wavelengths:(i+1)*num_wavelengths]
-
-            #print("\tx-values (" + `i*num_wavelengths` + "," + `(i+1)*num_wavelengths` + "): " + `x_values`)
-            #print("\ty-values (" + `i*num_wavelengths` + "," + `(i+1)*num_wavelengths` + "): " + `y_values`)
-            #print("\tWavelength (" + `i*num_wavelengths` + "," + `(i+1)*num_wavelengths` + "): " + `wavelength_values`)
-            #print("\tFlux (" + `i*num_wavelengths` + "," + `(i+1)*num_wavelengths` + "): " + `flux_values`)
-
-            #for w in range(0, num_wavelengths):
-                #print(`x_values[w]` + "\t" + `y_values[w]` + "\t" + `wavelength_values[w]` + "\t" + `flux_values[w]`)
-
-            # figure(1)
-            pylab.figure(i)
-            pylab.scatter(wavelength_values,flux_values)
-
-            # axes specific
-            pylab.xlabel(r'log(Wavelength) (um)')					
-            pylab.ylabel(r'Flux (Jy/pixel)')
-            pylab.rc('axes', labelsize=14, linewidth=2, labelcolor='black')
-            pylab.semilogx()
-            pylab.axis([min(wavelength_values),max(wavelength_values),min(flux_values),max(flux_values)])
-
-            pylab.hold(True)
-
-            # load the second data set
-            #data2 = np.loadtxt('Te/SPEC_4.out', comments='%',usecols = (1,2)) 	
-            #a2 = data2[:,0]
-            #b2 = data2[:,1]/1e20
-
-            # overplot in figure(1)
-            #pylab.plot(a2,b2, 'r:',  markersize=3.0, linewidth=2.0, label='Te')	
-
-            # load the third data set
-            #data3 = np.loadtxt('Teff/SPEC_4.out', comments='%',usecols = (1,2)) 	
-            #a3 = data3[:,0]
-            #b3 = data3[:,1]/1e20
-
-            # overplot in figure(1)
-            #pylab.plot(a3,b3, 'b-.',  markersize=3.0, linewidth=2.0, label='Teff')	
-
-            pylab.legend()
-            pylab.savefig(new_directory + '/' + `int(x_values[0])` + '_' + `int(y_values[0])` + '_sed.eps')
-            #pylab.show()
-            bar.update(i)
-
-def cleanup_output_files():
+    directory = tempfile.mkdtemp()
+    # Several copies of each band, so that many units finish at the same
+    # time and record themselves in the same run state.
+    for seed in range(0, 5):
+        for filename in make_synthetic_images(directory + '/synthetic', seed=seed):
+            os.rename(filename, directory + '/' + os.path.basename(filename)[:-len('.fits')] + '_' + `seed` + '.fits')
+    os.rmdir(directory + '/synthetic')
+
+    queue_filename = directory + '/queue.db'
+    arguments = ['--directory', directory, '--angular_size', '600', '--ra', '10', '--dec', '10', '--backend', 'native', '--conversion', '--registration', '--convolution', '--resampling', '--resume', '--queue', queue_filename, '--max_jobs', `max(config.max_jobs, 8)`, '--log_format', config.log_format]
+    if (config.verbose):
+        arguments.append('--verbose')
+    if (config.quiet):
+        arguments.append('--quiet')
+    enqueue_units(parse_command_line(arguments + ['--enqueue']))
+    run_queue_workers(parse_command_line(arguments + ['--worker']))
+
+    connection = open_queue(queue_filename)
+    num_units = connection.execute("SELECT COUNT(*) FROM units").fetchone()[0]
+    failures = connection.execute("SELECT id, stage, images, status, attempts, error FROM units WHERE status != 'done' OR attempts != 1 ORDER BY id").fetchall()
+    connection.close()
+    shutil.rmtree(directory)
+
+    for unit_id, stage, filenames, status, attempts, error in failures:
+        logger.warning("Unit " + `unit_id` + " (" + stage + " of " + ', '.join(os.path.basename(f) for f in json.loads(filenames)) + ") is " + status + " after " + `attempts` + " attempts: " + str(error))
+    if (failures == []):
+        print("All of the " + `num_units` + " units of the queue succeeded on their first attempt.")
+    return failures
+
+class PipelineRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     """
-    Removes files that have been generated by previous executions of the
-    script.
+    Handles the HTTP requests made to the imagecube server: job submission
+    and job status queries.
     """
 
-    print("Cleaning up output files.")
+    def send_json(self, status, value):
+        body = json.dumps(value)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.rstrip('/')
+        with self.server.jobs_lock:
+            if (path == '/jobs'):
+                self.send_json(200, {'queued': self.server.job_queue.qsize(), 'jobs': sorted(self.server.jobs.values(), key=lambda job: job['id'])})
+            elif (path.startswith('/jobs/') and path[len('/jobs/'):].isdigit() and int(path[len('/jobs/'):]) in self.server.jobs):
+                self.send_json(200, self.server.jobs[int(path[len('/jobs/'):])])
+            else:
+                self.send_json(404, {'error': 'unknown job'})
+
+    def do_POST(self):
+        if (self.path.rstrip('/') != '/jobs'):
+            self.send_json(404, {'error': 'unknown path'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+            arguments = [str(x) for x in request['arguments']]
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {'error': 'the request should be a JSON object with a list of arguments'})
+            return
+        with self.server.jobs_lock:
+            job_id = len(self.server.jobs) + 1
+            job = {'id': job_id, 'arguments': arguments, 'status': 'queued', 'exit_code': None, 'submitted': time.time(), 'started': None, 'finished': None}
+            self.server.jobs[job_id] = job
+        self.server.job_queue.put(job_id)
+        self.send_json(202, {'id': job_id})
+
+class PipelineServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    An HTTP server that keeps the Python modules and IRAF loaded and runs
+    the submitted jobs, at most max_jobs at a time.
+    """
 
-    import shutil
+    daemon_threads = True
+
+    def __init__(self, port, num_workers):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), PipelineRequestHandler)
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.job_queue = Queue.Queue()
+        for i in range(0, num_workers):
+            worker = threading.Thread(target=self.run_jobs)
+            worker.daemon = True
+            worker.start()
+
+    def run_jobs(self):
+        while True:
+            job_id = self.job_queue.get()
+            with self.jobs_lock:
+                job = self.jobs[job_id]
+                job['status'] = 'running'
+                job['started'] = time.time()
+                arguments = job['arguments']
+            exit_code = run_job(arguments)
+            with self.jobs_lock:
+                job['exit_code'] = exit_code
+                job['status'] = 'done' if exit_code == 0 else 'failed'
+                job['finished'] = time.time()
+
+def run_job(arguments):
+    """
+    Runs a single job of the server in a child process. The child process
+    is forked from the server, so that it starts with all of the modules and
+    IRAF already loaded, while jobs cannot disturb each other or the
+    server if they fail. A job whose parameters are invalid exits through
+    sys.exit(), and is reported as failed.
 
-    for d in ('converted', 'registered', 'convolved', 'resampled', 'seds'):
-        subdir = directory + '/' + d
-        if (os.path.isdir(subdir)):
-            print("Removing " + subdir)
-            shutil.rmtree(subdir)
+    Parameters
+    ----------
+    arguments: list
+        The command line parameters of the job.
 
-if __name__ == '__main__':
-    phys_size = ''
-    directory = ''
-    ra_input = ''
-    dec_input = ''
-    main_reference_image = ''
-    convolution_reference_image = ''
-    conversion_factors = False
-    do_conversion = False
-    do_registration = False
-    do_convolution = False
-    do_resampling = False
-    do_seds = False
-    do_cleanup = False
-
-    parse_command_line()
-
-    if (do_cleanup):
-        cleanup_output_files()
-        sys.exit()
+    Returns
+    -------
+    exit_code: int
+        The exit status of the job; 0 if it finished successfully.
+    """
 
-    # Grab all of the .fits and .fit files in the specified directory
-    all_files = glob.glob(directory + "/*.fit*")
+    return run_in_child(lambda: Pipeline(parse_command_line(arguments)).run())
 
-    # Lists to store information
-    image_data = []
-    converted_data = []
-    registered_data = []
-    convolved_data = []
-    resampled_data = []
-    headers = []
-    filenames = []
+def run_in_child(function, *arguments):
+    """
+    Calls a function in a forked child process; see run_job().
 
-    for i in all_files:
-        hdulist = fits.open(i)
-        #hdulist.info()
-        header = hdulist[0].header
-        # NOTETOSELF: The check for a data cube needs to be another function due to complexity. Check the
-        # hdulist.info() values to see how much information is contained in the file.
-        # In a data cube, there may be more than one usable science image. We need to make
-        # sure that they are all grabbed.
-        # Check to see if the input file is a data cube before trying to grab the image data
-        if ('EXTEND' in header and 'DSETS___' in header):
-            image = hdulist[1].data
-        else:
-            image = hdulist[0].data
-        #filename = hdulist.filename()
-        # Strip the .fit or .fits extension from the filename so we can append things to it
-        # later on
-        filename = os.path.splitext(hdulist.filename())[0]
-        hdulist.close()
-        #wavelength = header['WAVELENG']
-        wavelength, wavelength_units = get_wavelength(header)
-        #wavelength_units = header.comments['WAVELENG']
-        wavelength_microns = wavelength_to_microns(wavelength, wavelength_units)
-        #print("Wavelength " + `wavelength_microns` + "; Sample image value: " + `image[30][30]`)
-        # NOTETOSELF: don't overwrite the header value here. Either create a new keyword,
-        # say, WLMICRON, or include the original value in a comment.
-        header['WAVELENG'] = (wavelength_microns, 'micron')
-        image_data.append(image)
-        headers.append(header)
-        filenames.append(filename)
+    The server and the queue workers fork from one of several threads, and
+    the child only keeps the thread that forked. A lock held by any other
+    thread at that time would stay locked in the child for good, so the
+    locks that the child may need are taken before forking and released on
+    both sides. Other locks (e.g. those of the modules used) are not
+    covered, but only the threads of the server and of the workers run in
+    the parent, and they do not use them.
 
-    # Sort the lists by their WAVELENG value
-    images_with_headers_unsorted = zip(image_data, headers, filenames)
-    images_with_headers = sorted(images_with_headers_unsorted, key=lambda header: header[1]['WAVELENG'])
+    Returns
+    -------
+    exit_code: int
+        The exit status of the child process; 0 if the function returned
+        normally, and never 0 if it called sys.exit().
+    """
 
-    #if (conversion_factors):
-        #output_conversion_factors(images_with_headers)
+    fork_locks = [iraf_lock, run_state_lock, log_handler.lock]
+    for lock in fork_locks:
+        lock.acquire()
+    try:
+        pid = os.fork()
+    finally:
+        for lock in reversed(fork_locks):
+            lock.release()
+    if (pid == 0):
+        exit_code = 0
+        try:
+            function(*arguments)
+        except SystemExit as e:
+            # The function returns when it succeeds: the error paths call
+            # sys.exit(), most of them without a status, so any exit is a
+            # failure.
+            exit_code = e.code if (isinstance(e.code, int) and e.code != 0) else 1
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            exit_code = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exit_code)
+
+    pid, status = os.waitpid(pid, 0)
+    if (os.WIFEXITED(status)):
+        return os.WEXITSTATUS(status)
+    return 1
+
+def run_server(port, num_workers):
+    """
+    Runs imagecube as a server on the given port of the local host until it
+    is interrupted.
 
-    if (do_conversion):
-        convert_images(images_with_headers)
+    Parameters
+    ----------
+    port: int
+        The port on which the server listens.
+    num_workers: int
+        The number of jobs that are run at the same time.
 
-    if (do_registration):
-        register_images(images_with_headers)
+    """
 
-    if (do_convolution):
-        convolve_images(images_with_headers)
+    server = PipelineServer(port, num_workers)
+    logger.info("imagecube server listening on port " + `port` + " with " + `num_workers` + " concurrent jobs")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
 
-    if (do_resampling):
-        resample_images(images_with_headers)
+if __name__ == '__main__':
+    config = parse_command_line()
 
-    if (do_seds):
-        output_seds(images_with_headers)
+    if (config.server_port != 0):
+        run_server(config.server_port, config.max_jobs)
+    else:
+        Pipeline(config).run()
 
     sys.exit()